@@ -11,20 +11,31 @@ Script per l'elaborazione degli aggiudicatari da Pubblicità Legale:
 - Mostra percentuali di avanzamento per tutti i processi
 """
 
+import argparse
 import os
 import json
-import math
 import sys
+import threading
 import time
-import subprocess
-from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Any
-import requests
+from typing import Callable, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+import http_archive
+from pubblicita_legale_fetch import fetch_pages
+from pg_loader import DB_URL_ENV, PgUpserter, default_dsn
+from supabase_batch import BatchUpserter
+from cig_store import CigStore
+from superset_cig_fetch import fetch_many_cig_details
+from bandi_model import Aggiudicatario, CigDetail, SEZIONE_OGGETTO
+from superset_record import CigRecord
+from normalizzazione import Normalizzatore
+from run_journal import RunJournal, journal_path
+from run_trace import LEVELS, TRACER, print_summary, set_level
+
 # ---------------------------------------------------------------------------
 # CONFIGURAZIONE & COSTANTI
 # ---------------------------------------------------------------------------
@@ -45,19 +56,24 @@ PAGE_SIZE = 100             # Dimensione pagina API
 MAX_WORKERS = 4             # Thread paralleli
 MAX_RESULTS = 9999          # Limite massimo risultati
 BASE_TIMEOUT = 30           # Timeout richieste
+SUPERSET_BATCH_SIZE = 0     # CIG per query Superset (0 = una query per CIG)
+PARALLEL_DAYS = 2           # Giorni elaborati in parallelo nel backfill (--from/--to)
+REFRESH_BUDGET = 20         # CIG in cache scaduti riscaricati per giorno
+LOTTO_LOOKUP_CHUNK = 200    # CIG per query "in" sulla tabella lotto
 
-# Percorsi script e cache
-SCRIPTS_DIR = Path(__file__).parent
-FETCH_SCRIPT = SCRIPTS_DIR / "superset_cig_fetch.py"
-LOCAL_DIR = Path("c:\\Users\\MADEINSICILY1\\Desktop\\BancaDati\\v0\\local")
-CIG_CACHE_DIR = LOCAL_DIR / "cig_completi"
+# Percorsi cache
+LOCAL_DIR = Path(os.getenv("PIPELINE_LOCAL_DIR", "c:\\Users\\MADEINSICILY1\\Desktop\\BancaDati\\v0\\local"))
+# Cache dettagli CIG (SQLite compresso). La vecchia cache a directory
+# "cig_completi" si importa con: python cig_store.py import <dir> --db <file>
+CIG_STORE_PATH = LOCAL_DIR / "cig_completi.sqlite"
 
 # Assicurati che le directory esistano
 LOCAL_DIR.mkdir(parents=True, exist_ok=True)
-CIG_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+cig_store = CigStore(CIG_STORE_PATH)
 
 # Configurazione API Pubblicità Legale
-BASE_URL = "https://pubblicitalegale.anticorruzione.it/api/v0/avvisi"
+BASE_URL = os.getenv("PUBBLICITA_LEGALE_URL", "https://pubblicitalegale.anticorruzione.it/api/v0/avvisi")
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36",
     "Accept": "application/json, text/plain, */*",
@@ -95,50 +111,24 @@ def fetch_esiti_legali(data_pubblicazione: str) -> List[Dict]:
         "dataPubblicazioneStart": formatted_date,
         "dataPubblicazioneEnd": formatted_date,
         "codiceScheda": "7,8a,9",  # Codici per esiti di aggiudicazione
-        "size": PAGE_SIZE,
-        "page": 0
     }
     
-    all_esiti = []
     total_downloaded = 0
     
-    while total_downloaded < MAX_RESULTS:
-        try:
-            response = requests.get(BASE_URL, headers=HEADERS, params=params_base, timeout=BASE_TIMEOUT)
-            response.raise_for_status()
-            
-            payload = response.json()
-            content = payload.get("content", [])
-            
-            if not content:
-                print(f"\n✅ Download completato: nessun risultato alla pagina {params_base['page'] + 1}")
-                break
-            
-            # Limita i risultati per rispettare MAX_RESULTS
-            remaining_slots = MAX_RESULTS - total_downloaded
-            if len(content) > remaining_slots:
-                content = content[:remaining_slots]
-            
-            all_esiti.extend(content)
-            total_downloaded += len(content)
-            
-            # Calcola e mostra percentuale
-            percentage = (total_downloaded / MAX_RESULTS) * 100
-            print(f"\r📥 Scaricamento: {total_downloaded}/{MAX_RESULTS} ({percentage:.1f}%)", end="", flush=True)
-            
-            if total_downloaded >= MAX_RESULTS:
-                print(f"\n✅ Raggiunto limite di {MAX_RESULTS} risultati")
-                break
-                
-            params_base["page"] += 1
-            time.sleep(0.5)  # Anti rate-limit
-            
-        except requests.exceptions.RequestException as e:
-            print(f"\n❌ Errore nel download pagina {params_base['page'] + 1}: {e}")
-            break
-        except Exception as e:
-            print(f"\n❌ Errore imprevisto pagina {params_base['page'] + 1}: {e}")
-            break
+    def _progress(page: int, total_pages: int, n_items: int) -> None:
+        nonlocal total_downloaded
+        total_downloaded += n_items
+        percentage = min(total_downloaded / MAX_RESULTS, 1) * 100
+        print(f"\r📥 Scaricamento: {total_downloaded}/{MAX_RESULTS} ({percentage:.1f}%)", end="", flush=True)
+    
+    # Pagine in parallelo con rate limit; solleva IncompleteDownloadError
+    # se qualche pagina manca anche dopo i retry
+    all_esiti = fetch_pages(BASE_URL, params_base, HEADERS, PAGE_SIZE,
+                            max_items=MAX_RESULTS, timeout=BASE_TIMEOUT,
+                            on_page=_progress)
+    
+    if len(all_esiti) >= MAX_RESULTS:
+        print(f"\n✅ Raggiunto limite di {MAX_RESULTS} risultati")
     
     print(f"\n📊 Totale esiti scaricati: {len(all_esiti)}")
     return all_esiti
@@ -147,51 +137,34 @@ def fetch_esiti_legali(data_pubblicazione: str) -> List[Dict]:
 # SEZIONE 2 – ESTRAZIONE AGGIUDICATARI
 # ---------------------------------------------------------------------------
 
-def extract_aggiudicatari_from_esiti(esiti: List[Dict]) -> Dict[str, List[Dict]]:
+def extract_aggiudicatari_from_esiti(esiti: List[Dict]) -> Dict[str, List[Aggiudicatario]]:
     """
     Estrae i dati degli aggiudicatari dagli esiti, organizzati per CIG.
-    Basato sulla struttura di esiti_aggiudicatari_extractor.py
+    Basato sulla struttura di esiti_aggiudicatari_extractor.py; degli esiti
+    restano solo i campi scritti nella tabella aggiudicatario.
     """
     print("\n🔍 Estrazione aggiudicatari dagli esiti...")
     
-    aggiudicatari_by_cig = {}
+    aggiudicatari_by_cig: Dict[str, List[Aggiudicatario]] = {}
     
     for esito in esiti:
         try:
-            # Naviga la struttura: template[0].template.sections
-            if 'template' in esito and esito['template']:
-                for template_item in esito['template']:
-                    if 'template' in template_item and 'sections' in template_item['template']:
-                        sections = template_item['template']['sections']
+            # Naviga la struttura: template[].template.sections
+            for template_item in esito.get('template') or []:
+                for section in (template_item.get('template') or {}).get('sections') or []:
+                    # Cerca la sezione "SEZ. C - Oggetto"
+                    if section.get('name') != SEZIONE_OGGETTO:
+                        continue
+                    for item in section.get('items') or []:
+                        cig = item.get('cig')
+                        if not cig:
+                            continue
                         
-                        # Cerca la sezione "SEZ. C - Oggetto"
-                        for section in sections:
-                            if section.get('name') == 'SEZ. C - Oggetto' and 'items' in section:
-                                for item in section['items']:
-                                    cig = item.get('cig')
-                                    if not cig:
-                                        continue
-                                    
-                                    # Inizializza la lista per questo CIG se non esiste
-                                    if cig not in aggiudicatari_by_cig:
-                                        aggiudicatari_by_cig[cig] = []
-                                    
-                                    # Estrai i dati degli aggiudicatari
-                                    if 'aggiudicatari_ad' in item:
-                                        for agg in item['aggiudicatari_ad']:
-                                            if 'soggetti' in agg:
-                                                for soggetto in agg['soggetti']:
-                                                    aggiudicatario_data = {
-                                                        'denominazione': soggetto.get('denominazione', ''),
-                                                        'codice_fiscale': soggetto.get('codice_fiscale', ''),
-                                                        'importo': agg.get('importo'),
-                                                        'data_aggiudicazione': esito.get('dataPubblicazione'),
-                                                        'data_pubblicazione': esito.get('dataPubblicazione'),
-                                                        'id_avviso': esito.get('idAvviso'),
-                                                        'id_appalto': esito.get('idAppalto'),
-                                                        'codice_scheda': esito.get('codiceScheda')
-                                                    }
-                                                    aggiudicatari_by_cig[cig].append(aggiudicatario_data)
+                        # Estrai i dati degli aggiudicatari
+                        aggiudicatari = aggiudicatari_by_cig.setdefault(cig, [])
+                        for agg in item.get('aggiudicatari_ad') or []:
+                            for soggetto in agg.get('soggetti') or []:
+                                aggiudicatari.append(Aggiudicatario.from_soggetto(esito, agg, soggetto))
         except Exception as e:
             print(f"⚠️ Errore nell'estrazione aggiudicatario: {e}")
             continue
@@ -203,167 +176,157 @@ def extract_aggiudicatari_from_esiti(esiti: List[Dict]) -> Dict[str, List[Dict]]
 # SEZIONE 3 – GESTIONE DATABASE SUPABASE
 # ---------------------------------------------------------------------------
 
-def get_lotto_id_by_cig(cig: str) -> Optional[str]:
+def _ids_by(table: str, column: str, values: List[str],
+            failed: Optional[List[str]] = None) -> Dict[str, str]:
     """
-    Recupera l'ID del lotto dal database Supabase usando il CIG.
+    Recupera gli ID delle righe di ``table`` per molti valori di ``column``
+    con query ``in`` a blocchi, eseguite in parallelo. Restituisce la mappa
+    valore → id dei valori trovati; i valori dei blocchi falliti anche al
+    secondo tentativo finiscono in ``failed``.
     """
-    try:
-        response = supabase.table('lotto').select('id').eq('cig', cig).execute()
-        
-        if response.data and len(response.data) > 0:
-            return response.data[0]['id']
-        return None
-        
-    except Exception as e:
-        print(f"❌ Errore nel recupero lotto per CIG {cig}: {e}")
-        return None
+    values = list(dict.fromkeys(values))
+    chunks = [values[i:i + LOTTO_LOOKUP_CHUNK] for i in range(0, len(values), LOTTO_LOOKUP_CHUNK)]
+
+    def _lookup(chunk: List[str]) -> Dict[str, str]:
+        for attempt in range(2):
+            try:
+                response = supabase.table(table).select(f'id,{column}').in_(column, chunk).execute()
+                return {row[column]: row['id'] for row in response.data or []}
+            except Exception as e:
+                print(f"❌ Errore nel recupero {table} ({len(chunk)} valori, tentativo {attempt + 1}/2): {e}")
+        if failed is not None:
+            failed.extend(chunk)
+        return {}
+
+    ids: Dict[str, str] = {}
+    if not chunks:
+        return ids
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(chunks))) as executor:
+        for found in executor.map(_lookup, chunks):
+            ids.update(found)
+    return ids
 
-def insert_aggiudicatari_for_lotto(lotto_id: str, aggiudicatari: List[Dict]) -> bool:
+def get_lotto_ids_by_cigs(cigs: List[str], failed: Optional[List[str]] = None) -> Dict[str, str]:
     """
-    Inserisce o aggiorna gli aggiudicatari per un lotto specifico.
+    Recupera gli ID dei lotti per molti CIG (vedi ``_ids_by``). Restituisce la
+    mappa CIG → lotto_id dei CIG trovati; i CIG dei blocchi falliti anche al
+    secondo tentativo finiscono in ``failed``.
     """
-    try:
+    return _ids_by('lotto', 'cig', cigs, failed)
+
+def _aggiudicatario_row(lotto_id: str, aggiudicatario: Aggiudicatario) -> Dict:
+    """Riga della tabella aggiudicatario; codice fiscale vuoto → NULL, così
+    l'indice unico (lotto_id, codice_fiscale) non fa collidere i soggetti senza CF,
+    e in maiuscolo, perché il vincolo distingue le maiuscole."""
+    codice_fiscale = (aggiudicatario.codice_fiscale or '').strip().upper()
+    return {
+        'lotto_id': lotto_id,
+        'denominazione': aggiudicatario.denominazione,
+        'codice_fiscale': codice_fiscale or None,
+        'importo': aggiudicatario.importo,
+        'data_aggiudicazione': aggiudicatario.data_aggiudicazione,
+        'data_pubblicazione': aggiudicatario.data_pubblicazione,
+        'id_avviso': aggiudicatario.id_avviso,
+        'id_appalto': aggiudicatario.id_appalto,
+        'codice_scheda': aggiudicatario.codice_scheda
+    }
+
+def upsert_aggiudicatari(aggiudicatari_by_lotto: Dict[str, List[Aggiudicatario]],
+                         writer: Optional[BatchUpserter] = None) -> List[Dict]:
+    """
+    Scrive gli aggiudicatari di più lotti con upsert a blocchi su
+    (lotto_id, codice_fiscale) – vedi sql/aggiudicatario_unique.sql.
+
+    I duplicati vengono eliminati in memoria: stesso lotto e codice fiscale,
+    oppure, per i soggetti senza codice fiscale, stesso lotto e denominazione
+    (vince l'ultimo). Restituisce un esito per ogni aggiudicatario ricevuto:
+    ``{'lotto_id', 'codice_fiscale', 'denominazione', 'esito', 'errore'}`` con
+    esito ``scritto``, ``duplicato`` o ``errore``. ``writer`` sceglie il
+    backend (default PostgREST; ``pg_loader.PgUpserter`` per COPY diretto).
+    """
+    rows: Dict[Tuple, Dict] = {}
+    outcomes: List[Tuple[Tuple, Dict]] = []
+    last_index: Dict[Tuple, int] = {}         # chiave → esito della riga in uso
+    for lotto_id, aggiudicatari in aggiudicatari_by_lotto.items():
         for aggiudicatario in aggiudicatari:
-            aggiudicatario_data = {
-                'lotto_id': lotto_id,
-                'denominazione': aggiudicatario.get('denominazione', ''),
-                'codice_fiscale': aggiudicatario.get('codice_fiscale', ''),
-                'importo': aggiudicatario.get('importo'),
-                'data_aggiudicazione': aggiudicatario.get('data_aggiudicazione'),
-                'data_pubblicazione': aggiudicatario.get('data_pubblicazione'),
-                'id_avviso': aggiudicatario.get('id_avviso'),
-                'id_appalto': aggiudicatario.get('id_appalto'),
-                'codice_scheda': aggiudicatario.get('codice_scheda')
-            }
-            
-            # Controlla se esiste già un aggiudicatario con stesso lotto_id e codice_fiscale
-            codice_fiscale = aggiudicatario.get('codice_fiscale', '')
-            if codice_fiscale:
-                existing = supabase.table('aggiudicatario').select('id').eq('lotto_id', lotto_id).eq('codice_fiscale', codice_fiscale).execute()
-                
-                if existing.data and len(existing.data) > 0:
-                    # Aggiorna esistente
-                    existing_id = existing.data[0]['id']
-                    result = supabase.table('aggiudicatario').update(aggiudicatario_data).eq('id', existing_id).execute()
-                    if not result.data:
-                        print(f"❌ Errore nell'aggiornamento aggiudicatario {aggiudicatario_data['denominazione']}")
-                        return False
-                else:
-                    # Inserisci nuovo
-                    result = supabase.table('aggiudicatario').insert(aggiudicatario_data).execute()
-                    if not result.data:
-                        print(f"❌ Errore nell'inserimento aggiudicatario {aggiudicatario_data['denominazione']}")
-                        return False
+            row = _aggiudicatario_row(lotto_id, aggiudicatario)
+            if row['codice_fiscale']:
+                key = (lotto_id, row['codice_fiscale'])
             else:
-                # Se non c'è codice fiscale, inserisci sempre nuovo record
-                result = supabase.table('aggiudicatario').insert(aggiudicatario_data).execute()
-                if not result.data:
-                    print(f"❌ Errore nell'inserimento aggiudicatario {aggiudicatario_data['denominazione']}")
-                    return False
-        
-        return True
-        
-    except Exception as e:
-        print(f"❌ Errore nell'inserimento aggiudicatari per lotto {lotto_id}: {e}")
-        return False
+                key = (lotto_id, None, ' '.join((row['denominazione'] or '').upper().split()))
+            if key in last_index:
+                # La riga precedente con la stessa chiave viene sostituita
+                outcomes[last_index[key]][1]['esito'] = 'duplicato'
+            rows[key] = row
+            last_index[key] = len(outcomes)
+            outcomes.append((key, {
+                'lotto_id': lotto_id,
+                'codice_fiscale': row['codice_fiscale'],
+                'denominazione': row['denominazione'],
+                'esito': None,
+                'errore': None,
+            }))
+
+    # La chiave del buffer include la denominazione: le righe senza CF
+    # (codice_fiscale NULL) non devono essere fuse fra loro
+    writer = writer or BatchUpserter(supabase)
+    row_keys: Dict[Tuple, Tuple] = {}
+    for key, row in rows.items():
+        buffer_key = writer.add('aggiudicatario', row, on_conflict='lotto_id,codice_fiscale',
+                                key='lotto_id,codice_fiscale,denominazione')
+        row_keys[buffer_key] = key
+    result = writer.flush('aggiudicatario')
+    failed = {row_keys[k]: error for k, error in result.failed.items()}
+
+    for key, outcome in outcomes:
+        if outcome['esito'] is not None:
+            continue
+        if key in failed:
+            outcome['esito'] = 'errore'
+            outcome['errore'] = failed[key]
+        else:
+            outcome['esito'] = 'scritto'
+    return [outcome for _, outcome in outcomes]
 
 # ---------------------------------------------------------------------------
 # SEZIONE 4 – DOWNLOAD DETTAGLI CIG DA SUPERSET
 # ---------------------------------------------------------------------------
 
-def fetch_cig_details(cig: str) -> Optional[Dict]:
-    """
-    Scarica i dettagli di un CIG utilizzando lo script superset_cig_fetch.py
-    Basato sulla logica di unified_data_pipelineGPT.py
-    """
-    output_file = CIG_CACHE_DIR / f"{cig}.json"
-    
-    # Verifica se il file esiste già
-    if output_file.exists():
-        try:
-            with open(output_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"  ↳ errore lettura cache per CIG {cig}: {e}")
-            # Se c'è un errore nella lettura, procediamo con il download
-    
-    try:
-        # Assicurati che la directory esista
-        os.makedirs(CIG_CACHE_DIR, exist_ok=True)
-        
-        # Converti il percorso in stringa assoluta
-        output_file_str = str(output_file.absolute())
-        
-        # Esegui lo script superset_cig_fetch.py per ottenere i dettagli del CIG
-        result = subprocess.run(
-            [sys.executable, str(FETCH_SCRIPT), cig, output_file_str],
-            check=True,
-            capture_output=True,
-            text=True
-        )
-        
-        # Verifica che il file esista prima di tentare di leggerlo
-        if not output_file.exists():
-            # Cerca il file nella directory principale
-            alt_file = LOCAL_DIR / f"CIG_{cig}.json"
-            if alt_file.exists():
-                try:
-                    with open(alt_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    # Copia il file nella posizione corretta
-                    import shutil
-                    shutil.copy2(alt_file, output_file)
-                    return data
-                except Exception as e:
-                    print(f"  ↳ Errore durante la lettura/copia del file alternativo: {e}")
-            
-            # Se non troviamo il file alternativo, creiamo un file vuoto
-            os.makedirs(os.path.dirname(output_file), exist_ok=True)
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump({}, f)
-            return {}
-        
-        # Leggi il file appena creato
-        with open(output_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-            
-    except subprocess.CalledProcessError as e:
-        print(f"  ↳ errore durante il download del CIG {cig}: {e}")
-        return None
-    except Exception as e:
-        print(f"  ↳ errore generico per CIG {cig}: {e}")
-        return None
-
-def fetch_multiple_cig_details(cigs: List[str]) -> Dict[str, Dict]:
+def fetch_multiple_cig_details(cigs: List[str], batch_size: int = SUPERSET_BATCH_SIZE,
+                               journal: Optional[RunJournal] = None) -> Dict[str, Dict]:
     """
     Scarica i dettagli di più CIG in parallelo da Superset con percentuale di avanzamento.
+    Usa il fetcher in-process di superset_cig_fetch (browser condiviso, cache su disco).
+    I CIG nel giornale del run (``journal``) vengono letti solo dalla cache.
     """
     print(f"\n🔄 Download parallelo dettagli per {len(cigs)} CIG...")
     
-    cig_details = {}
     completed_count = 0
+    scaricati = journal.done("cig", cigs) if journal is not None else set()
+    if scaricati:
+        TRACER.count("ripresa.cig", len(scaricati))
+        cigs = [cig for cig in cigs if cig not in scaricati]
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Invia tutte le richieste
-        future_to_cig = {executor.submit(fetch_cig_details, cig): cig for cig in cigs}
-        
-        # Processa i risultati man mano che arrivano
-        for future in as_completed(future_to_cig):
-            cig = future_to_cig[future]
-            completed_count += 1
-            
-            try:
-                details = future.result()
-                if details:
-                    cig_details[cig] = details
-                
-                # Mostra percentuale di avanzamento
-                percentage = (completed_count / len(cigs)) * 100
-                print(f"\r📥 Download CIG: {completed_count}/{len(cigs)} ({percentage:.1f}%)", end="", flush=True)
-                
-            except Exception as e:
-                print(f"\n❌ Errore nel download CIG {cig}: {e}")
+    def _progress(cig: str, details: Optional[Dict]) -> None:
+        nonlocal completed_count
+        completed_count += 1
+        percentage = (completed_count / len(cigs)) * 100
+        print(f"\r📥 Download CIG: {completed_count}/{len(cigs)} ({percentage:.1f}%)", end="", flush=True)
+        if journal is not None and details is not None:
+            journal.record("cig", [cig])
+    
+    try:
+        results = fetch_many_cig_details(cigs, cache=cig_store,
+                                         concurrency=MAX_WORKERS, on_result=_progress,
+                                         batch_size=batch_size,
+                                         refresh_budget=REFRESH_BUDGET)
+    except Exception as e:
+        print(f"\n❌ Errore nel download dettagli CIG: {e}")
+        results = {}
+    if scaricati:
+        results.update(cig_store.get_many(list(scaricati)))
     
+    cig_details = {cig: details for cig, details in results.items() if details}
     print(f"\n📊 Dettagli scaricati per {len(cig_details)} CIG")
     return cig_details
 
@@ -426,19 +389,24 @@ def get_lookup_maps() -> Tuple[Dict[str, int], Dict[str, int], Dict[str, int], D
     print(f"✔ Recuperate {len(natura_map)} nature, {len(criterio_map)} criteri, {len(stato_map)} stati, {len(cpv_map)} cpv, {len(tipo_procedura_map)} tipi procedura")
     return natura_map, criterio_map, stato_map, cpv_map, tipo_procedura_map
 
-def create_ente_if_needed(denominazione: str, codice_fiscale: str) -> Optional[str]:
+def get_or_create_enti(enti: Dict[str, str], writer: BatchUpserter,
+                       failed: Optional[List[str]] = None) -> Dict[str, str]:
     """
-    Crea un ente se non esiste e restituisce l'ID.
+    Restituisce codice_fiscale → id per gli enti in ``enti`` (codice_fiscale →
+    denominazione). Gli enti già presenti vengono solo letti, così i loro dati
+    non vengono sovrascritti; i mancanti vengono accodati a ``writer`` e
+    scritti in un blocco. I codici fiscali non verificabili per errore del
+    database finiscono in ``failed`` e non vengono creati.
     """
-    try:
-        # Verifica se l'ente esiste già
-        response = supabase.table('ente_appaltante').select('id').eq('codice_fiscale', codice_fiscale).execute()
-        
-        if response.data and len(response.data) > 0:
-            return response.data[0]['id']
-        
-        # Crea nuovo ente
-        ente_data = {
+    unresolved: List[str] = []
+    ids = _ids_by('ente_appaltante', 'codice_fiscale', list(enti), failed=unresolved)
+    if failed is not None:
+        failed.extend(unresolved)
+    skipped = set(unresolved)
+    for codice_fiscale, denominazione in enti.items():
+        if codice_fiscale in ids or codice_fiscale in skipped:
+            continue
+        writer.add('ente_appaltante', {
             'denominazione': denominazione,
             'codice_fiscale': codice_fiscale,
             'partita_iva': '',
@@ -447,237 +415,125 @@ def create_ente_if_needed(denominazione: str, codice_fiscale: str) -> Optional[s
             'indirizzo': '',
             'istat_comune': '',
             'sezione_regionale': ''
-        }
-        
-        response = supabase.table('ente_appaltante').insert(ente_data).execute()
-        
-        if response.data and len(response.data) > 0:
-            print(f"✅ Creato ente: {denominazione}")
-            return response.data[0]['id']
-        else:
-            print(f"❌ Errore nella creazione ente {denominazione}: nessun dato restituito")
-            return None
-        
-    except Exception as e:
-        print(f"❌ Errore nella creazione ente {denominazione}: {e}")
-        return None
+        }, on_conflict='codice_fiscale')
+    created = writer.flush('ente_appaltante', returning=True)
+    if created.ids:
+        print(f"✅ Creati {len(created.ids)} enti")
+    ids.update(created.ids)
+    return ids
 
-def merge_data(cig_data: Dict) -> Dict:
+def merge_data(cig_data: Dict) -> Optional[CigDetail]:
     """
-    Converte i dati CIG dal formato Superset in un formato utilizzabile.
+    Converte i dati CIG dal formato Superset nei soli campi usati per
+    creare gara e lotto (vedi ``bandi_model.CigDetail``).
     Basato su unified_data_pipelineGPT.py
     """
-    merged = {
-        "cig_details": {},
-    }
-    
-    if not cig_data:
-        return merged
-        
-    try:
-        data_items = cig_data.get("result", [{}])[0].get("data", [])
-        if data_items:
-            item = data_items[0]
-            # Alcune colonne sono stringhe con JSON incorporato
-            for k in [
-                "stazione_appaltante",
-                "bando",
-                "categorie_opera",
-                "quadro_economico",
-                "template",
-                "incaricati",
-                "pubblicazioni",
-            ]:
-                val = item.get(k)
-                if isinstance(val, str):
-                    try:
-                        merged["cig_details"][k] = json.loads(val)
-                    except json.JSONDecodeError:
-                        merged["cig_details"][k] = val
-                else:
-                    merged["cig_details"][k] = val
-    except Exception as exc:
-        print(f"⚠️ merge_data: {exc}")
-        
-    return merged
+    return CigDetail.from_record(CigRecord.from_superset(cig_data))
 
-def create_gara_and_lotto(cig_details: Dict, natura_map: Dict, criterio_map: Dict, stato_map: Dict, cpv_map: Dict, tipo_procedura_map: Dict) -> Optional[str]:
+def create_gare_e_lotti(cig_details_map: Dict[str, Dict], natura_map: Dict, criterio_map: Dict, stato_map: Dict,
+                        cpv_map: Dict, tipo_procedura_map: Dict, norm: Optional[Normalizzatore] = None,
+                        writer: Optional[BatchUpserter] = None,
+                        enti_writer: Optional[BatchUpserter] = None) -> Dict[str, str]:
     """
-    Crea gara e lotto nel database e restituisce l'ID del lotto.
-    Basato su unified_data_pipelineGPT.py
+    Crea gare e lotti per i dettagli CIG di ``cig_details_map`` e restituisce
+    la mappa CIG → lotto_id dei CIG creati.
+    Come ``process_gare_e_lotti`` di unified_data_pipelineGPT.py: prima gli
+    enti, poi tutte le gare in un blocco, poi i lotti con il ``gara_id``
+    restituito. ``writer`` sceglie il backend (default PostgREST; con
+    ``pg_loader.PgUpserter`` le righe restano nella transazione del giorno);
+    ``enti_writer`` scrive gli enti, condivisi con gli altri giorni, fuori da
+    quella transazione (default: ``writer``).
+    ``norm`` raccoglie i valori non mappati per un unico riepilogo.
     """
-    try:
-        # Merge dei dati
-        merged = merge_data(cig_details)
-        cig_data = merged.get("cig_details", {})
-        
-        # Estrai dati stazione appaltante
-        sa = cig_data.get("stazione_appaltante", {})
-        if not sa:
-            print("❌ Dati stazione appaltante mancanti")
-            return None
-            
-        denominazione_sa = sa.get('DENOMINAZIONE_AMMINISTRAZIONE_APPALTANTE', '')
-        codice_fiscale_sa = sa.get('CF_AMMINISTRAZIONE_APPALTANTE', '')
-        
-        if not denominazione_sa or not codice_fiscale_sa:
-            print("❌ Denominazione o CF stazione appaltante mancanti")
-            return None
-        
-        # Crea o recupera ente
-        ente_id = create_ente_if_needed(denominazione_sa, codice_fiscale_sa)
+    writer = writer or BatchUpserter(supabase)
+    norm = norm or Normalizzatore()
+
+    details: Dict[str, CigDetail] = {}
+    for cig, cig_data in cig_details_map.items():
+        detail = merge_data(cig_data)
+        if detail is None:
+            print(f"❌ Dettaglio CIG vuoto per {cig}")
+        elif not detail.cig:
+            print(f"❌ CIG mancante nei dati bando per {cig}")
+        elif not detail.ente or not detail.ente.denominazione or not detail.ente.codice_fiscale:
+            print(f"❌ Denominazione o CF stazione appaltante mancanti per CIG {cig}")
+        else:
+            details[cig] = detail
+
+    enti_ids = get_or_create_enti({d.ente.codice_fiscale: d.ente.denominazione
+                                   for d in details.values()}, enti_writer or writer)
+
+    lotto_rows: Dict[str, Dict] = {}     # CIG → riga lotto senza gara_id
+    for cig, detail in details.items():
+        ente_id = enti_ids.get(detail.ente.codice_fiscale)
         if not ente_id:
-            print(f"❌ Impossibile creare/trovare ente per SA {denominazione_sa}")
-            return None
-        
-        # Estrai dati bando
-        bando_data = cig_data.get("bando", {})
-        if not bando_data:
-            print("❌ Dati bando mancanti")
-            return None
-            
-        cig = bando_data.get('CIG')
-        if not cig:
-            print("❌ CIG mancante nei dati bando")
-            return None
-        
-        # Mappa natura principale
-        natura_principale_id = None
-        oggetto_principale = bando_data.get('OGGETTO_PRINCIPALE_CONTRATTO', '').lower()
-        if 'lavori' in oggetto_principale:
-            natura_principale_id = natura_map.get('lavori')
-        elif 'forniture' in oggetto_principale or 'fornitura' in oggetto_principale:
-            natura_principale_id = natura_map.get('forniture')
-        elif 'servizi' in oggetto_principale or 'servizio' in oggetto_principale:
-            natura_principale_id = natura_map.get('servizi')
-        
-        # Mappa criterio aggiudicazione
-        criterio_id = None
-        tipo_scelta = bando_data.get('TIPO_SCELTA_CONTRAENTE', '').lower()
-        if 'economicamente' in tipo_scelta or 'vantaggiosa' in tipo_scelta:
-            criterio_id = criterio_map.get('offerta_economicamente_vantaggiosa')
-        elif 'prezzo' in tipo_scelta or 'ribasso' in tipo_scelta:
-            criterio_id = criterio_map.get('prezzo_piu_basso')
-        
-        # Mappa stato procedura  
-        stato_id = None
-        stato = bando_data.get('STATO', '').lower()
-        if 'aggiudicata' in stato or 'aggiudicato' in stato:
-            stato_id = stato_map.get('aggiudicata')
-        elif 'pubblicata' in stato or 'pubblicato' in stato:
-            stato_id = stato_map.get('pubblicata')
-        
-        # Estrai CPV principale
+            print(f"❌ Impossibile creare/trovare ente per SA {detail.ente.denominazione}")
+            continue
+
+        # Mappa i valori testuali agli ID delle tabelle di lookup
+        # (stesse regole della pipeline dei bandi, vedi normalizzazione.py)
+        natura_principale_id = norm.id("natura", detail.oggetto_principale_contratto, natura_map)
+        criterio_id = norm.id("criterio", detail.criterio_aggiudicazione, criterio_map)
+        stato_id = norm.id("stato", detail.stato, stato_map)
+        # Senza tipo di scelta del contraente si usa comunque 'open'
+        tipo_procedura_id = (norm.id("tipo_procedura", detail.tipo_procedura, tipo_procedura_map)
+                             or tipo_procedura_map.get('open'))
+
+        # CPV principale
         cpv_id = None
-        cpv_list = bando_data.get("CPV", [])
-        if cpv_list and isinstance(cpv_list, list) and len(cpv_list) > 0:
-            cpv_code = cpv_list[0].get("COD_CPV")
-            if cpv_code and cpv_code in cpv_map:
-                cpv_id = cpv_map.get(cpv_code)
-        
-        # Mappa tipo procedura
-        tipo_procedura_id = None
-        tipo_scelta = bando_data.get('TIPO_SCELTA_CONTRAENTE', '').lower()
-        
-        # Dizionario di mappatura per tipo_procedura (come in unified_data_pipelineGPT.py)
-        tipo_procedura_mapping = {
-            "aperta": "open",
-            "open": "open",
-            "ristretta": "restricted",
-            "restricted": "restricted",
-            "negoziata": "negotiated",
-            "negotiated": "negotiated",
-            "dialogo": "competitive_dialogue",
-            "dialogue": "competitive_dialogue",
-            "competitive_dialogue": "competitive_dialogue",
-            "diretto": "direct",
-            "direct": "direct",
-            "affidamento": "direct",
-            "affidamento diretto": "direct"
-        }
-        
-        # Normalizza e cerca nella mappa
-        tipo_scelta_normalized = tipo_scelta.strip().lower()
-        
-        # Prima cerca corrispondenza esatta
-        if tipo_scelta_normalized in tipo_procedura_mapping:
-            mapped_code = tipo_procedura_mapping[tipo_scelta_normalized]
-            tipo_procedura_id = tipo_procedura_map.get(mapped_code)
-        else:
-            # Poi cerca corrispondenza parziale
-            for key, value in tipo_procedura_mapping.items():
-                if key in tipo_scelta_normalized:
-                    mapped_code = value
-                    tipo_procedura_id = tipo_procedura_map.get(mapped_code)
-                    break
-        
-        if not tipo_procedura_id:
-            print(f"  ⚠️ Tipo procedura non mappato: '{tipo_scelta}'")
-            # Usa open come default
-            tipo_procedura_id = tipo_procedura_map.get('open')
-        
-        # Crea gara
-        gara_data = {
+        if detail.cpv:
+            cpv_id = cpv_map.get(detail.cpv[0][0])
+
+        writer.add('gara', {
             'ente_appaltante_id': ente_id,
             'natura_principale_id': natura_principale_id,
             'criterio_aggiudicazione_id': criterio_id,
             'stato_procedura_id': stato_id,
-            'tipo_procedura_id': tipo_procedura_id,  # Campo aggiunto
-            'descrizione': bando_data.get('OGGETTO_GARA', ''),
-            'importo_totale': bando_data.get('IMPORTO_COMPLESSIVO_GARA'),
-            'importo_sicurezza': bando_data.get('IMPORTO_SICUREZZA'),
+            'tipo_procedura_id': tipo_procedura_id,
+            'descrizione': detail.oggetto_gara or '',
+            'importo_totale': detail.importo_complessivo_gara,
+            'importo_sicurezza': detail.importo_sicurezza,
             'valuta': 'EUR',
-            'cig': cig,
-            'cup': bando_data.get('CUP', [{}])[0].get('CUP') if bando_data.get('CUP') else None
-        }
-        
-        # Estrai date di pubblicazione
-        pubblicazioni = cig_data.get("pubblicazioni", {})
-        if pubblicazioni:
-            data_pubblicazione = pubblicazioni.get('DATA_PUBBLICAZIONE')
-            if data_pubblicazione:
-                gara_data['data_pubblicazione'] = data_pubblicazione
-        
-        gara_response = supabase.table('gara').insert(gara_data).execute()
-        
-        if not gara_response.data or len(gara_response.data) == 0:
-            print(f"❌ Errore nella creazione gara per CIG {cig}")
-            return None
-        
-        gara_id = gara_response.data[0]['id']
-        
-        # Crea lotto
-        lotto_data = {
-            'gara_id': gara_id,
-            'cig': cig,
-            'descrizione': bando_data.get('OGGETTO_LOTTO', bando_data.get('OGGETTO_GARA', '')),
+            'cig': detail.cig,
+            'cup': detail.cup,
+            'data_pubblicazione': detail.pubblicazione.data_pubblicazione if detail.pubblicazione else None,
+        }, on_conflict='cig')
+        lotto_rows[detail.cig] = {
+            'cig': detail.cig,
+            'descrizione': detail.oggetto_lotto or detail.oggetto_gara or '',
             'natura_principale_id': natura_principale_id,
-            'valore': bando_data.get('IMPORTO_LOTTO', bando_data.get('IMPORTO_COMPLESSIVO_GARA')),
+            'valore': detail.importo_lotto or detail.importo_complessivo_gara,
             'valuta': 'EUR',
-            'status': bando_data.get('STATO', ''),
+            'status': detail.stato or '',
             'criterio_aggiudicazione_id': criterio_id,
             'cpv_id': cpv_id
         }
-        
-        lotto_response = supabase.table('lotto').insert(lotto_data).execute()
-        
-        if lotto_response.data and len(lotto_response.data) > 0:
-            return lotto_response.data[0]['id']
-        
-        return None
-        
-    except Exception as e:
-        print(f"❌ Errore nella creazione gara/lotto: {e}")
-        return None
+    gara_ids = writer.flush('gara', returning=True).ids
+
+    for cig, row in lotto_rows.items():
+        if cig in gara_ids:
+            writer.add('lotto', {'gara_id': gara_ids[cig], **row}, on_conflict='cig')
+    lotto_ids = writer.flush('lotto', returning=True).ids
+    return {cig: lotto_ids[detail.cig] for cig, detail in details.items() if detail.cig in lotto_ids}
 
 # ---------------------------------------------------------------------------
 # SEZIONE 6 – ELABORAZIONE PRINCIPALE
 # ---------------------------------------------------------------------------
 
-def process_aggiudicatari(aggiudicatari_by_cig: Dict[str, List[Dict]]) -> Dict[str, int]:
+def process_aggiudicatari(aggiudicatari_by_cig: Dict[str, List[Aggiudicatario]],
+                          lookup_maps: Optional[Callable[[], Tuple]] = None,
+                          batch_size: int = SUPERSET_BATCH_SIZE,
+                          writer: Optional[BatchUpserter] = None,
+                          enti_writer: Optional[BatchUpserter] = None,
+                          journal: Optional[RunJournal] = None,
+                          applicati: Optional[List[str]] = None) -> Dict[str, int]:
     """
     Elabora gli aggiudicatari: aggiorna quelli esistenti e crea nuovi CIG se necessario.
     Mostra percentuale di avanzamento durante l'elaborazione.
+    ``lookup_maps`` permette di condividere le mappe di lookup fra più giorni
+    (default: ``get_lookup_maps``, letto da Supabase a ogni chiamata).
+    I CIG i cui aggiudicatari sono stati scritti senza errori finiscono in
+    ``applicati``; ``journal`` registra i dettagli Superset scaricati.
     """
     print(f"\n🔄 Elaborazione {len(aggiudicatari_by_cig)} CIG...")
     
@@ -688,86 +544,80 @@ def process_aggiudicatari(aggiudicatari_by_cig: Dict[str, List[Dict]]) -> Dict[s
         'salvati_pending': 0
     }
     
-    # Verifica CIG esistenti
-    existing_cigs = set()
-    missing_cigs = []
-    
-    processed_count = 0
-    total_cigs = len(aggiudicatari_by_cig)
+    # Verifica CIG esistenti (poche query "in" invece di una select per CIG)
+    unresolved: List[str] = []
+    lotto_ids = get_lotto_ids_by_cigs(list(aggiudicatari_by_cig.keys()), failed=unresolved)
+    skipped = set(unresolved)
+    missing_cigs = [cig for cig in aggiudicatari_by_cig
+                    if cig not in lotto_ids and cig not in skipped]
+    if unresolved:
+        # Esistenza non verificabile: meglio saltarli che duplicare gare e lotti
+        print(f"⚠️  {len(unresolved)} CIG non verificati per errore del database, saltati")
+        stats['errori'] += len(unresolved)
     
-    for cig in aggiudicatari_by_cig.keys():
-        lotto_id = get_lotto_id_by_cig(cig)
-        if lotto_id:
-            existing_cigs.add(cig)
-        else:
-            missing_cigs.append(cig)
-    
-    print(f"📊 CIG esistenti: {len(existing_cigs)}, CIG mancanti: {len(missing_cigs)}")
+    print(f"📊 CIG esistenti: {len(lotto_ids)}, CIG mancanti: {len(missing_cigs)}")
     
-    # Aggiorna CIG esistenti
-    for cig in existing_cigs:
-        try:
-            lotto_id = get_lotto_id_by_cig(cig)
-            if lotto_id and insert_aggiudicatari_for_lotto(lotto_id, aggiudicatari_by_cig[cig]):
-                stats['aggiornati'] += 1
-            else:
-                stats['errori'] += 1
-                
-            processed_count += 1
-            percentage = (processed_count / total_cigs) * 100
-            print(f"\r🔄 Elaborazione: {processed_count}/{total_cigs} ({percentage:.1f}%)", end="", flush=True)
-            
-        except Exception as e:
-            print(f"\n❌ Errore nell'aggiornamento CIG {cig}: {e}")
-            stats['errori'] += 1
+    # Aggiudicatari da scrivere alla fine, in blocco: lotto_id → (CIG, nuovo?)
+    lotti_da_scrivere: Dict[str, Tuple[str, bool]] = {
+        lotto_id: (cig, False) for cig, lotto_id in lotto_ids.items()
+    }
     
     # Scarica dettagli per CIG mancanti
     if missing_cigs:
-        print(f"\n\n📥 Download dettagli per {len(missing_cigs)} CIG mancanti...")
-        cig_details_map = fetch_multiple_cig_details(missing_cigs)
+        print(f"\n📥 Download dettagli per {len(missing_cigs)} CIG mancanti...")
+        cig_details_map = fetch_multiple_cig_details(missing_cigs, batch_size, journal)
         
         # Recupera mappe lookup - CORREZIONE: aggiunto tipo_procedura_map
-        natura_map, criterio_map, stato_map, cpv_map, tipo_procedura_map = get_lookup_maps()
+        natura_map, criterio_map, stato_map, cpv_map, tipo_procedura_map = (lookup_maps or get_lookup_maps)()
+        norm = Normalizzatore()
         
-        # Crea nuovi CIG
+        # CIG non trovati su Superset: in pending per un'elaborazione futura
         for cig in missing_cigs:
-            try:
-                if cig in cig_details_map:
-                    # Crea gara e lotto - CORREZIONE: aggiunto tipo_procedura_map
-                    lotto_id = create_gara_and_lotto(
-                        cig_details_map[cig], 
-                        natura_map, 
-                        criterio_map, 
-                        stato_map,
-                        cpv_map,
-                        tipo_procedura_map
-                    )
-                    
-                    if lotto_id:
-                        # Inserisci aggiudicatari
-                        if insert_aggiudicatari_for_lotto(lotto_id, aggiudicatari_by_cig[cig]):
-                            stats['nuovi_creati'] += 1
-                        else:
-                            stats['errori'] += 1
-                    else:
-                        stats['errori'] += 1
-                else:
-                    # Salva in pending se non trovato su Superset
-                    save_pending_aggiudicatari(cig, aggiudicatari_by_cig[cig])
-                    stats['salvati_pending'] += 1
-                
-                processed_count += 1
-                percentage = (processed_count / total_cigs) * 100
-                print(f"\r🔄 Elaborazione: {processed_count}/{total_cigs} ({percentage:.1f}%)", end="", flush=True)
-                
-            except Exception as e:
-                print(f"\n❌ Errore nella creazione CIG {cig}: {e}")
+            if cig not in cig_details_map:
+                save_pending_aggiudicatari(cig, aggiudicatari_by_cig[cig])
+                stats['salvati_pending'] += 1
+        
+        # Gare e lotti dei CIG scaricati, a blocchi con lo stesso writer degli aggiudicatari
+        da_creare = {cig: cig_details_map[cig] for cig in missing_cigs if cig in cig_details_map}
+        print(f"🔄 Creazione gare/lotti per {len(da_creare)} CIG...")
+        try:
+            creati = create_gare_e_lotti(da_creare, natura_map, criterio_map, stato_map, cpv_map,
+                                         tipo_procedura_map, norm=norm, writer=writer,
+                                         enti_writer=enti_writer)
+        except Exception as e:
+            print(f"❌ Errore nella creazione gare/lotti: {e}")
+            creati = {}
+        for cig, lotto_id in creati.items():
+            lotti_da_scrivere[lotto_id] = (cig, True)
+        stats['errori'] += len(da_creare) - len(creati)
+        norm.riepilogo()
+    
+    # Scrittura aggiudicatari di tutti i lotti in poche richieste
+    if lotti_da_scrivere:
+        print(f"\n💾 Scrittura aggiudicatari per {len(lotti_da_scrivere)} lotti...")
+        outcomes = upsert_aggiudicatari({
+            lotto_id: aggiudicatari_by_cig[cig] for lotto_id, (cig, _) in lotti_da_scrivere.items()
+        }, writer=writer)
+        lotti_in_errore = {o['lotto_id'] for o in outcomes if o['esito'] == 'errore'}
+        for lotto_id, (cig, nuovo) in lotti_da_scrivere.items():
+            if lotto_id in lotti_in_errore:
                 stats['errori'] += 1
+                continue
+            if nuovo:
+                stats['nuovi_creati'] += 1
+            else:
+                stats['aggiornati'] += 1
+            if applicati is not None:
+                applicati.append(cig)
+        esiti: Dict[str, int] = {}
+        for o in outcomes:
+            esiti[o['esito']] = esiti.get(o['esito'], 0) + 1
+        print("📊 Aggiudicatari: " + ", ".join(f"{k} {v}" for k, v in sorted(esiti.items())))
     
     print(f"\n✅ Elaborazione completata")
     return stats
 
-def save_pending_aggiudicatari(cig: str, aggiudicatari: List[Dict]):
+def save_pending_aggiudicatari(cig: str, aggiudicatari: List[Aggiudicatario]):
     """
     Salva gli aggiudicatari in file JSON per elaborazione futura.
     """
@@ -781,7 +631,7 @@ def save_pending_aggiudicatari(cig: str, aggiudicatari: List[Dict]):
         with open(filename, 'w', encoding='utf-8') as f:
             json.dump({
                 'cig': cig,
-                'aggiudicatari': aggiudicatari,
+                'aggiudicatari': [a.to_dict() for a in aggiudicatari],
                 'timestamp': datetime.now().isoformat()
             }, f, indent=2, ensure_ascii=False)
         
@@ -794,54 +644,213 @@ def save_pending_aggiudicatari(cig: str, aggiudicatari: List[Dict]):
 # SEZIONE 7 – FUNZIONE PRINCIPALE
 # ---------------------------------------------------------------------------
 
+def process_day(data_pubblicazione: str,
+                lookup_maps: Optional[Callable[[], Tuple]] = None,
+                batch_size: int = SUPERSET_BATCH_SIZE,
+                db_url: Optional[str] = None,
+                journal: Optional[RunJournal] = None) -> Optional[Dict[str, int]]:
+    """
+    Esegue l'intero processo per una data: download esiti, estrazione e
+    aggiornamento aggiudicatari. Restituisce le statistiche (None se non c'è
+    nulla da elaborare). Con ``db_url`` enti, gare, lotti e aggiudicatari
+    vengono scritti con COPY diretto su PostgreSQL (``pg_loader``), in una
+    transazione per giorno; gli enti, condivisi con gli altri giorni, in
+    transazioni brevi confermate subito.
+    Con ``journal`` i CIG già applicati e i giorni già completati da un run
+    interrotto vengono saltati (``--resume``).
+    """
+    if journal is not None and journal.done("giorno", [data_pubblicazione]):
+        print(f"\n↷ {data_pubblicazione} già completato dal run interrotto: saltato")
+        TRACER.count("ripresa.giorni")
+        return None
+    print(f"\n📅 Elaborazione per data: {data_pubblicazione}")
+    
+    # Step 1: Scarica esiti
+    with TRACER.span("esiti.fetch"):
+        esiti = fetch_esiti_legali(data_pubblicazione)
+    TRACER.count("esiti", len(esiti or []))
+    
+    if not esiti:
+        print(f"❌ Nessun esito trovato per la data {data_pubblicazione}")
+        return None
+    
+    # Step 2: Estrai aggiudicatari (gli esiti completi non servono più)
+    aggiudicatari_by_cig = extract_aggiudicatari_from_esiti(esiti)
+    del esiti
+    
+    if not aggiudicatari_by_cig:
+        print(f"❌ Nessun aggiudicatario estratto per la data {data_pubblicazione}")
+        return None
+    
+    if journal is not None:
+        ripresi = journal.done("aggiudicatari", aggiudicatari_by_cig, giorno=data_pubblicazione)
+        if ripresi:
+            for cig in ripresi:
+                del aggiudicatari_by_cig[cig]
+            TRACER.count("ripresa.aggiudicatari", len(ripresi))
+            print(f"↷ {len(ripresi)} CIG già applicati dal run interrotto, "
+                  f"{len(aggiudicatari_by_cig)} da elaborare")
+    
+    # Step 3: Elabora aggiudicatari (nel giornale solo dopo il commit)
+    applicati: List[str] = []
+    if not db_url:
+        stats = process_aggiudicatari(aggiudicatari_by_cig, lookup_maps, batch_size,
+                                      journal=journal, applicati=applicati)
+    else:
+        # Enti confermati subito: i giorni in parallelo non si attendono a vicenda
+        with PgUpserter.connect(db_url) as writer, \
+                PgUpserter.connect(db_url, transaction=False) as enti_writer:
+            stats = process_aggiudicatari(aggiudicatari_by_cig, lookup_maps, batch_size, writer=writer,
+                                          enti_writer=enti_writer, journal=journal,
+                                          applicati=applicati)
+    if journal is not None:
+        journal.record("aggiudicatari", applicati, giorno=data_pubblicazione)
+        if stats['errori'] == 0:
+            journal.record("giorno", [data_pubblicazione])
+    return stats
+
+def print_stats(stats: Dict[str, int], title: str = "STATISTICHE FINALI"):
+    """
+    Stampa il riepilogo delle statistiche di elaborazione.
+    """
+    print("\n" + "="*50)
+    print(f"📊 {title}")
+    print("="*50)
+    print(f"✅ CIG aggiornati: {stats['aggiornati']}")
+    print(f"🆕 CIG nuovi creati: {stats['nuovi_creati']}")
+    print(f"💾 CIG salvati in pending: {stats['salvati_pending']}")
+    print(f"❌ Errori: {stats['errori']}")
+    print(f"📈 Totale elaborati: {sum(stats.values())}")
+    print("="*50)
+    
+    if stats['salvati_pending'] > 0:
+        print(f"\n💡 {stats['salvati_pending']} CIG salvati in 'aggiudicatari_pending' per elaborazione futura")
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Aggiornamento aggiudicatari da Pubblicità Legale")
+    parser.add_argument("--date", help="Data pubblicazione YYYY-MM-DD (default: ieri; "
+                                       "chiesta a terminale se interattivo)")
+    parser.add_argument("--from", dest="date_from", help="Backfill: primo giorno (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", help="Backfill: ultimo giorno incluso (default: ieri)")
+    parser.add_argument("--parallel-days", type=int, default=PARALLEL_DAYS, metavar="N",
+                        help="Giorni elaborati in parallelo durante il backfill")
+    parser.add_argument("--superset-batch", type=int, default=SUPERSET_BATCH_SIZE, metavar="N",
+                        help="Richiedi a Superset N CIG per query (0 = una query per CIG)")
+    parser.add_argument("--loader", choices=("postgrest", "pg"), default="postgrest",
+                        help="Backend di scrittura (enti, gare, lotti, aggiudicatari): API PostgREST "
+                             "o COPY diretto su PostgreSQL, una transazione per giorno")
+    parser.add_argument("--db-url", default=default_dsn(),
+                        help=f"Connection string PostgreSQL per --loader pg (default: ${DB_URL_ENV})")
+    parser.add_argument("--resume", action="store_true",
+                        help="Riprende un run interrotto con le stesse date: salta giorni, CIG "
+                             "scaricati e aggiudicatari già scritti (vedi run_journal.py)")
+    parser.add_argument("--log-level", choices=sorted(LEVELS, key=LEVELS.get), default=None,
+                        help="Livello dei messaggi (default: $PIPELINE_LOG_LEVEL o info)")
+    parser.add_argument("--report", type=Path, metavar="FILE",
+                        help="Report JSON del run (default: aggiudicatari_report_<data-ora>.json in LOCAL_DIR)")
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument("--record", type=Path, metavar="FILE",
+                         help="Registra le risposte di Pubblicità Legale e Superset in un archivio "
+                              "(vedi http_archive.py)")
+    archive.add_argument("--replay", type=Path, metavar="FILE",
+                         help="Riproduce le risposte da un archivio registrato, senza rete")
+    args = parser.parse_args()
+    if args.date and (args.date_from or args.date_to):
+        parser.error("--date non è combinabile con --from/--to")
+    if args.date_to and not args.date_from:
+        parser.error("--to richiede --from")
+    if args.loader == "pg" and not args.db_url:
+        parser.error(f"--loader pg richiede --db-url o la variabile {DB_URL_ENV}")
+    for value in (args.date, args.date_from, args.date_to):
+        if value:
+            try:
+                datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                parser.error(f"data non valida: {value} (usa YYYY-MM-DD)")
+    if args.replay and not args.replay.exists():
+        parser.error(f"archivio non trovato: {args.replay}")
+    return args
+
 def main():
     """
     Funzione principale che coordina l'intero processo.
     """
+    args = parse_args()
+    db_url = args.db_url if args.loader == "pg" else None
+    if args.log_level:
+        set_level(args.log_level)
+    TRACER.reset()
+    http_archive.configure("record" if args.record else "replay" if args.replay else None,
+                           args.record or args.replay)
+    journal = None
     try:
         print("🚀 Avvio Aggiudicatari Updater")
         print(f"📊 Configurazione: MAX_RESULTS={MAX_RESULTS}, MAX_WORKERS={MAX_WORKERS}")
         
         # Data di default: ieri
         yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
-        data_pubblicazione = input(f"Inserisci data pubblicazione (YYYY-MM-DD) [default: {yesterday}]: ").strip()
-        
-        if not data_pubblicazione:
-            data_pubblicazione = yesterday
-        
-        print(f"\n📅 Elaborazione per data: {data_pubblicazione}")
-        
-        # Step 1: Scarica esiti
-        esiti = fetch_esiti_legali(data_pubblicazione)
-        
-        if not esiti:
-            print("❌ Nessun esito trovato per la data specificata")
-            return
-        
-        # Step 2: Estrai aggiudicatari
-        aggiudicatari_by_cig = extract_aggiudicatari_from_esiti(esiti)
         
-        if not aggiudicatari_by_cig:
-            print("❌ Nessun aggiudicatario estratto")
+        if not args.date_from:
+            data_pubblicazione = args.date
+            if not data_pubblicazione and sys.stdin.isatty():
+                data_pubblicazione = input(f"Inserisci data pubblicazione (YYYY-MM-DD) [default: {yesterday}]: ").strip()
+            
+            data_pubblicazione = data_pubblicazione or yesterday
+            journal = RunJournal(journal_path(LOCAL_DIR, "aggiudicatari", data_pubblicazione,
+                                              data_pubblicazione), resume=args.resume)
+            stats = process_day(data_pubblicazione, batch_size=args.superset_batch,
+                                db_url=db_url, journal=journal)
+            if stats is None:
+                return
+            print_stats(stats)
+            print("\n🎉 Processo completato con successo!")
             return
         
-        # Step 3: Elabora aggiudicatari
-        stats = process_aggiudicatari(aggiudicatari_by_cig)
-        
-        # Step 4: Mostra statistiche finali
-        print("\n" + "="*50)
-        print("📊 STATISTICHE FINALI")
-        print("="*50)
-        print(f"✅ CIG aggiornati: {stats['aggiornati']}")
-        print(f"🆕 CIG nuovi creati: {stats['nuovi_creati']}")
-        print(f"💾 CIG salvati in pending: {stats['salvati_pending']}")
-        print(f"❌ Errori: {stats['errori']}")
-        print(f"📈 Totale elaborati: {sum(stats.values())}")
-        print("="*50)
-        
-        if stats['salvati_pending'] > 0:
-            print(f"\n💡 {stats['salvati_pending']} CIG salvati in 'aggiudicatari_pending' per elaborazione futura")
-        
+        # Backfill: le mappe di lookup vengono lette una sola volta
+        start = datetime.strptime(args.date_from, '%Y-%m-%d')
+        end = datetime.strptime(args.date_to or yesterday, '%Y-%m-%d')
+        days = [(start + timedelta(days=i)).strftime('%Y-%m-%d')
+                for i in range((end - start).days + 1)]
+        if not days:
+            print("❌ --from deve precedere --to")
+            sys.exit(1)
+        print(f"📅 Backfill di {len(days)} giorni ({days[0]} → {days[-1]}), {args.parallel_days} in parallelo")
+        journal = RunJournal(journal_path(LOCAL_DIR, "aggiudicatari", days[0], days[-1]),
+                             resume=args.resume)
+        
+        maps_lock = threading.Lock()
+        shared_maps: List[Tuple] = []
+        
+        def _shared_lookup_maps() -> Tuple:
+            with maps_lock:
+                if not shared_maps:
+                    shared_maps.append(get_lookup_maps())
+                return shared_maps[0]
+        
+        totals = {'aggiornati': 0, 'nuovi_creati': 0, 'errori': 0, 'salvati_pending': 0}
+        failed_days = []
+        with ThreadPoolExecutor(max_workers=max(1, args.parallel_days)) as executor:
+            future_to_day = {
+                executor.submit(process_day, day, _shared_lookup_maps, args.superset_batch, db_url,
+                                journal): day
+                for day in days
+            }
+            for future in as_completed(future_to_day):
+                day = future_to_day[future]
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    print(f"\n❌ Errore per la data {day}: {e}")
+                    failed_days.append(day)
+                    continue
+                for key, value in (stats or {}).items():
+                    totals[key] += value
+        
+        print_stats(totals, f"STATISTICHE BACKFILL ({len(days)} giorni)")
+        if failed_days:
+            print(f"\n❌ Date da rieseguire: {', '.join(sorted(failed_days))}")
+            print("💡 Con --resume e le stesse date si riprende da dove il run si è fermato")
+            sys.exit(2)
         print("\n🎉 Processo completato con successo!")
         
     except KeyboardInterrupt:
@@ -849,6 +858,18 @@ def main():
     except Exception as e:
         print(f"\n❌ Errore critico: {e}")
         raise
+    finally:
+        if journal is not None:
+            journal.close()
+        http_archive.close()
+        report_path = args.report or LOCAL_DIR / f"aggiudicatari_report_{time.strftime('%Y%m%d_%H%M%S')}.json"
+        try:
+            report = TRACER.write_report(report_path, argv=sys.argv[1:])
+        except OSError as exc:
+            print(f"⚠️ Report del run non salvato: {exc}")
+        else:
+            print_summary(report)
+            print(f"📄 Report del run salvato in {report_path}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+avvisi_watermark.py
+===================
+
+Registro locale degli avvisi di Pubblicità Legale già caricati su Supabase,
+per l'ingestione incrementale della pipeline dei bandi.
+
+Per ogni ``idAvviso`` scritto in ``avviso_gara`` si salva un'impronta dei
+campi letti dall'avviso (``impronta``). Quando lo stesso giorno viene
+rieseguito, gli avvisi con la stessa impronta non vengono più riscaricati da
+Superset né riscritti: il run costa in proporzione alle sole pubblicazioni
+nuove o modificate (una rettifica cambia l'impronta e l'avviso viene
+rielaborato). L'impronta non copre il dettaglio Superset del CIG: un avviso
+invariato il cui dettaglio in cache è scaduto viene comunque rielaborato
+dalla pipeline, così il refresh arriva a gara e lotto.
+
+Un avviso viene registrato solo dopo che la sua riga ``avviso_gara`` è stata
+scritta (con ``--loader pg`` dopo il commit), quindi un run interrotto o una
+riga rifiutata non lo fanno saltare la volta successiva. Con ``--full`` la
+pipeline ignora il registro, per esempio dopo una correzione delle
+mappature.
+
+Usage
+-----
+python avvisi_watermark.py stats [--db avvisi_watermark.sqlite]
+python avvisi_watermark.py forget <YYYY-MM-DD> [--db avvisi_watermark.sqlite]
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from bandi_model import Avviso
+
+DEFAULT_DB = Path("avvisi_watermark.sqlite")
+SQLITE_MAX_VARS = 900       # Parametri per query IN (limite SQLite: 999)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS avviso_caricato (
+    id_avviso    TEXT PRIMARY KEY,
+    impronta     TEXT NOT NULL,
+    giorno       TEXT,
+    caricato_at  REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS avviso_caricato_giorno ON avviso_caricato (giorno);
+"""
+
+
+def impronta(avviso: Avviso) -> str:
+    """Hash dei campi dell'avviso usati dalla pipeline."""
+    raw = json.dumps(asdict(avviso), sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class AvvisiWatermark:
+    """id_avviso → impronta degli avvisi caricati, thread-safe."""
+
+    def __init__(self, path: Path = DEFAULT_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30,
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, str]:
+        ids = list(dict.fromkeys(ids))
+        found: Dict[str, str] = {}
+        with self._lock:
+            for i in range(0, len(ids), SQLITE_MAX_VARS):
+                chunk = ids[i:i + SQLITE_MAX_VARS]
+                marks = ",".join("?" * len(chunk))
+                found.update(self._conn.execute(
+                    f"SELECT id_avviso, impronta FROM avviso_caricato WHERE id_avviso IN ({marks})",
+                    chunk,
+                ).fetchall())
+        return found
+
+    def classify(self, avvisi: Iterable[Avviso]) -> Tuple[List[Avviso], List[Avviso], List[Avviso]]:
+        """Divide gli avvisi in (invariati, modificati, mai registrati)."""
+        avvisi = list(avvisi)
+        known = self.get_many(a.id_avviso for a in avvisi if a.id_avviso)
+        unchanged: List[Avviso] = []
+        changed: List[Avviso] = []
+        unknown: List[Avviso] = []
+        for avviso in avvisi:
+            previous = known.get(avviso.id_avviso) if avviso.id_avviso else None
+            if previous is None:
+                unknown.append(avviso)
+            elif previous == impronta(avviso):
+                unchanged.append(avviso)
+            else:
+                changed.append(avviso)
+        return unchanged, changed, unknown
+
+    def mark(self, avvisi: Iterable[Avviso]) -> int:
+        """Registra gli avvisi come caricati con l'impronta attuale."""
+        now = time.time()
+        rows = [(a.id_avviso, impronta(a), (a.data_pubblicazione or "")[:10] or None, now)
+                for a in avvisi if a.id_avviso]
+        if rows:
+            with self._lock:
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO avviso_caricato (id_avviso, impronta, giorno, caricato_at) "
+                        "VALUES (?, ?, ?, ?)", rows)
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        return len(rows)
+
+    def forget(self, giorno: str) -> int:
+        """Dimentica gli avvisi pubblicati in ``giorno`` (YYYY-MM-DD)."""
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM avviso_caricato WHERE giorno = ?", (giorno,)
+            ).rowcount
+
+    def stats(self) -> List[Tuple[str, int]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT giorno, COUNT(*) FROM avviso_caricato GROUP BY giorno ORDER BY giorno"
+            ).fetchall()
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Registro degli avvisi già caricati")
+    parser.add_argument("--db", type=Path, default=DEFAULT_DB)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("stats", help="Avvisi registrati per giorno di pubblicazione")
+    p_forget = sub.add_parser("forget", help="Fa rielaborare un giorno al prossimo run")
+    p_forget.add_argument("giorno", help="Data di pubblicazione YYYY-MM-DD")
+    args = parser.parse_args()
+
+    store = AvvisiWatermark(args.db)
+    if args.cmd == "stats":
+        rows = store.stats()
+        for giorno, n in rows:
+            print(f"{giorno or '-':<12} {n:>8}")
+        print(f"{'totale':<12} {sum(n for _, n in rows):>8}")
+    elif args.cmd == "forget":
+        print(f"🗑  {store.forget(args.giorno)} avvisi dimenticati per {args.giorno}")
+
+
+if __name__ == "__main__":
+    main()
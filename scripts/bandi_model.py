@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+bandi_model.py
+==============
+
+Modello compatto dei dati che le pipeline scaricano e caricano su Supabase.
+
+Gli avvisi di Pubblicità Legale e le risposte Superset sono JSON molto
+annidati (template completo dell'avviso, colonne JSON incorporate) di cui si
+usa una piccola parte. Le classi qui sotto sono dataclass con ``__slots__``
+che conservano solo i campi effettivamente scritti nel database: la
+conversione avviene subito dopo il download (``Avviso.from_api``,
+``CigDetail.from_record``, ``Aggiudicatario.from_soggetto``) e il JSON
+originale può essere liberato.
+
+``GaraPayload`` e ``LottoPayload`` sono le righe delle tabelle ``gara`` e
+``lotto`` (senza ``gara_id``, assegnato dopo l'upsert delle gare).
+
+``Bando`` (avviso + dettaglio CIG) è il record unito che finisce nei file
+``bandi_completi*.ndjson.gz``: ``to_dict`` / ``from_dict`` lo convertono in
+JSON e ritorno; ``from_dict`` legge anche il vecchio formato
+``{"bando_info", "cig_details"}``.
+"""
+from __future__ import annotations
+
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from superset_record import CigRecord
+
+SEZIONE_OGGETTO = "SEZ. C - Oggetto"
+
+
+def _sezione_oggetto(raw: Dict[str, Any]) -> List[List[Dict[str, Any]]]:
+    """Item delle sezioni "SEZ. C - Oggetto" del template di un avviso."""
+    template = (raw.get("template") or [{}])[0] or {}
+    sections = (template.get("template") or {}).get("sections") or []
+    return [section.get("items") or [] for section in sections
+            if section.get("name") == SEZIONE_OGGETTO]
+
+
+# ---------------------------------------------------------------------------
+# PUBBLICITÀ LEGALE
+# ---------------------------------------------------------------------------
+
+@dataclass(slots=True)
+class Avviso:
+    """Campi di un avviso di Pubblicità Legale usati dalla pipeline."""
+    id_avviso: Optional[str] = None
+    id_appalto: Optional[str] = None
+    codice_scheda: Optional[str] = None
+    data_pubblicazione: Optional[str] = None
+    data_scadenza: Optional[str] = None
+    data_pcp: Optional[str] = None
+    attivo: bool = True
+    cig: Optional[str] = None
+    natura_principale: Optional[str] = None
+    criterio_aggiudicazione: Optional[str] = None
+    documenti_di_gara_link: Optional[str] = None
+
+    @classmethod
+    def from_api(cls, raw: Dict[str, Any]) -> "Avviso":
+        sezioni = _sezione_oggetto(raw)
+        cig = next((item.get("cig") or item.get("CIG") for items in sezioni for item in items
+                    if item.get("cig") or item.get("CIG")), None)
+        # Come in origine: vale il primo item dell'ultima sezione Oggetto
+        oggetto = next((items[0] for items in reversed(sezioni) if items), {})
+        template = (raw.get("template") or [{}])[0] or {}
+        return cls(
+            id_avviso=raw.get("idAvviso"),
+            id_appalto=raw.get("idAppalto"),
+            codice_scheda=raw.get("codiceScheda"),
+            data_pubblicazione=raw.get("dataPubblicazione"),
+            data_scadenza=raw.get("dataScadenza"),
+            data_pcp=(template.get("avviso") or [{}])[0].get("dataPCP"),
+            attivo=raw.get("attivo", True),
+            cig=cig.replace(" ", "") if cig else None,
+            natura_principale=oggetto.get("natura_principale"),
+            criterio_aggiudicazione=oggetto.get("criteri_aggiudicazione"),
+            documenti_di_gara_link=oggetto.get("documenti_di_gara_link"),
+        )
+
+    def avviso_row(self, affidamento_diretto: bool = False) -> Dict[str, Any]:
+        """Riga della tabella ``avviso_gara`` (senza ``gara_id``)."""
+        return {
+            "id": self.id_avviso,
+            "id_appalto": self.id_appalto,
+            "codice_scheda": self.codice_scheda,
+            "data_pubblicazione": self.data_pubblicazione,
+            # Per affidamenti diretti, non impostare data scadenza
+            "data_scadenza": None if affidamento_diretto else self.data_scadenza,
+            "data_pcp": self.data_pcp,
+            "attivo": self.attivo,
+        }
+
+
+@dataclass(slots=True)
+class Aggiudicatario:
+    """Soggetto aggiudicatario estratto da un esito."""
+    denominazione: str = ""
+    codice_fiscale: str = ""
+    importo: Optional[float] = None
+    data_aggiudicazione: Optional[str] = None
+    data_pubblicazione: Optional[str] = None
+    id_avviso: Optional[str] = None
+    id_appalto: Optional[str] = None
+    codice_scheda: Optional[str] = None
+
+    @classmethod
+    def from_soggetto(cls, esito: Dict[str, Any], aggiudicazione: Dict[str, Any],
+                      soggetto: Dict[str, Any]) -> "Aggiudicatario":
+        return cls(
+            denominazione=soggetto.get("denominazione", ""),
+            codice_fiscale=soggetto.get("codice_fiscale", ""),
+            importo=aggiudicazione.get("importo"),
+            data_aggiudicazione=esito.get("dataPubblicazione"),
+            data_pubblicazione=esito.get("dataPubblicazione"),
+            id_avviso=esito.get("idAvviso"),
+            id_appalto=esito.get("idAppalto"),
+            codice_scheda=esito.get("codiceScheda"),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+# ---------------------------------------------------------------------------
+# SUPERSET
+# ---------------------------------------------------------------------------
+
+@dataclass(slots=True)
+class Ente:
+    codice_fiscale: str
+    denominazione: str
+    citta: str = ""
+    regione: str = ""
+
+
+@dataclass(slots=True)
+class Rup:
+    """Riga della tabella ``rup`` (senza ``gara_id``)."""
+    nome: str = ""
+    cognome: str = ""
+    email: str = ""
+    telefono: str = ""
+
+
+@dataclass(slots=True)
+class Pubblicazione:
+    """Riga della tabella ``pubblicazione`` (senza ``gara_id``)."""
+    data_creazione: Optional[str] = None
+    data_pubblicazione: Optional[str] = None
+    data_guri: Optional[str] = None
+    link_sito_committente: Optional[str] = None
+    scadenza_invito: Optional[str] = None
+
+
+@dataclass(slots=True)
+class CigDetail:
+    """Campi del dettaglio Superset di un CIG usati per gare, lotti ed enti."""
+    cig: Optional[str] = None
+    cup: Optional[str] = None
+    oggetto_gara: Optional[str] = None
+    oggetto_lotto: Optional[str] = None
+    oggetto_principale_contratto: Optional[str] = None
+    tipo_procedura: Optional[str] = None
+    criterio_aggiudicazione: Optional[str] = None
+    stato: Optional[str] = None
+    importo_complessivo_gara: Optional[float] = None
+    importo_lotto: Optional[float] = None
+    importo_sicurezza: Optional[float] = None
+    data_scadenza_offerta: Optional[str] = None
+    luogo_istat: Optional[str] = None
+    ente: Optional[Ente] = None
+    cpv: List[Tuple[str, Optional[str]]] = field(default_factory=list)  # (codice, descrizione)
+    categorie: List[Tuple[str, str]] = field(default_factory=list)      # (codice, ruolo P/S)
+    rup: Optional[Rup] = None
+    pubblicazione: Optional[Pubblicazione] = None
+    invito_in_pubblicazioni: bool = False   # "SCADENZA INVITO" fra le pubblicazioni
+
+    @classmethod
+    def from_record(cls, record: CigRecord) -> Optional["CigDetail"]:
+        """Estrae i campi persistiti; ``None`` se il record è vuoto."""
+        if not record:
+            return None
+        bando = record.get_dict("bando")
+        sa = record.get_dict("stazione_appaltante")
+
+        ente = None
+        cf = sa.get("CF_AMMINISTRAZIONE_APPALTANTE") or sa.get("codice_fiscale")
+        denominazione = (sa.get("DENOMINAZIONE_AMMINISTRAZIONE_APPALTANTE")
+                         or sa.get("denominazione_amministrazione"))
+        if cf:
+            ente = Ente(cf, denominazione or "", sa.get("CITTA") or "", sa.get("REGIONE") or "")
+
+        rup = None
+        for inc in record.get_list("incaricati"):
+            if not isinstance(inc, dict):
+                continue
+            if inc.get("COD_RUOLO") == "RUP" or "RUP" in str(inc.get("DESCRIZIONE_RUOLO", "")).upper():
+                rup = Rup(inc.get("NOME", ""), inc.get("COGNOME", ""),
+                          inc.get("EMAIL", ""), inc.get("TELEFONO", ""))
+                break
+
+        pubblicazioni = record.get_dict("pubblicazioni")
+        pubblicazione = None
+        if pubblicazioni:
+            pubblicazione = Pubblicazione(
+                data_creazione=pubblicazioni.get("DATA_CREAZIONE"),
+                data_pubblicazione=pubblicazioni.get("DATA_PUBBLICAZIONE"),
+                data_guri=pubblicazioni.get("DATA_GURI"),
+                link_sito_committente=pubblicazioni.get("LINK_SITO_COMMITTENTE"),
+                scadenza_invito=pubblicazioni.get("SCADENZA_INVITO"),
+            )
+
+        categorie = []
+        for c in record.get_list("categorie_opera"):
+            if not isinstance(c, dict):
+                continue
+            code = c.get("ID_CATEGORIA") or c.get("id_categoria")
+            ruolo_raw = c.get("COD_TIPO_CATEGORIA") or c.get("cod_tipo_categoria")
+            if code:
+                categorie.append((code, "P" if (ruolo_raw or "").upper() == "P" else "S"))
+
+        cup = record.nested_list("bando", "CUP")
+        return cls(
+            cig=bando.get("CIG") or bando.get("cig"),
+            cup=cup[0].get("CUP") if cup and isinstance(cup[0], dict) else None,
+            oggetto_gara=bando.get("OGGETTO_GARA"),
+            oggetto_lotto=bando.get("OGGETTO_LOTTO"),
+            oggetto_principale_contratto=bando.get("OGGETTO_PRINCIPALE_CONTRATTO"),
+            tipo_procedura=(bando.get("TIPO_SCELTA_CONTRAENTE")
+                            or bando.get("tipo_procedura_aggiudicazione")),
+            criterio_aggiudicazione=bando.get("CRITERIO_AGGIUDICAZIONE"),
+            stato=bando.get("STATO"),
+            importo_complessivo_gara=bando.get("IMPORTO_COMPLESSIVO_GARA"),
+            importo_lotto=bando.get("IMPORTO_LOTTO"),
+            importo_sicurezza=bando.get("IMPORTO_SICUREZZA"),
+            data_scadenza_offerta=bando.get("DATA_SCADENZA_OFFERTA"),
+            luogo_istat=bando.get("LUOGO_ISTAT"),
+            ente=ente,
+            cpv=[(c.get("COD_CPV"), c.get("DESCRIZIONE_CPV"))
+                 for c in record.nested_list("bando", "CPV")
+                 if isinstance(c, dict) and c.get("COD_CPV")],
+            categorie=categorie,
+            rup=rup,
+            pubblicazione=pubblicazione,
+            invito_in_pubblicazioni=any("SCADENZA INVITO" in str(v) for v in pubblicazioni.values()),
+        )
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CigDetail":
+        data = dict(data)
+        for name, kind in (("ente", Ente), ("rup", Rup), ("pubblicazione", Pubblicazione)):
+            if data.get(name):
+                data[name] = kind(**data[name])
+        data["cpv"] = [tuple(c) for c in data.get("cpv") or []]
+        data["categorie"] = [tuple(c) for c in data.get("categorie") or []]
+        return cls(**data)
+
+
+# ---------------------------------------------------------------------------
+# RIGHE GARA / LOTTO
+# ---------------------------------------------------------------------------
+
+@dataclass(slots=True)
+class GaraPayload:
+    cig: str
+    ente_appaltante_id: int
+    cup: Optional[str] = None
+    descrizione: Optional[str] = None
+    data_pubblicazione: Optional[str] = None
+    scadenza_offerta: Optional[str] = None
+    importo_totale: Optional[float] = None
+    importo_sicurezza: Optional[float] = None
+    valuta: str = "EUR"
+    natura_principale_id: Optional[int] = None
+    criterio_aggiudicazione_id: Optional[int] = None
+    stato_procedura_id: Optional[int] = None
+    tipo_procedura_id: Optional[int] = None
+    documenti_di_gara_link: Optional[str] = None
+
+    def to_row(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass(slots=True)
+class LottoPayload:
+    cig: str
+    descrizione: Optional[str] = None
+    valore: Optional[float] = None
+    valuta: str = "EUR"
+    termine_ricezione: Optional[str] = None
+    luogo_istat: Optional[str] = None
+    cpv_id: Optional[int] = None
+
+    def to_row(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+# ---------------------------------------------------------------------------
+# RECORD UNITO
+# ---------------------------------------------------------------------------
+
+@dataclass(slots=True)
+class Bando:
+    """Avviso di Pubblicità Legale con il dettaglio Superset del suo CIG."""
+    avviso: Avviso
+    detail: Optional[CigDetail] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Bando":
+        if "bando_info" in data:
+            # Formato precedente: avviso e colonne Superset complete
+            return cls(Avviso.from_api(data.get("bando_info") or {}),
+                       CigDetail.from_record(CigRecord.wrap(data.get("cig_details"))))
+        detail = data.get("detail")
+        return cls(Avviso(**data["avviso"]), CigDetail.from_dict(detail) if detail else None)
@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+"""
+bench_pipeline.py
+=================
+
+Benchmark end-to-end delle pipeline contro servizi locali finti, senza
+toccare ``pubblicitalegale.anticorruzione.it``, ``dati.anticorruzione.it`` né
+Supabase.
+
+Vengono avviati tre server HTTP locali:
+
+*   **avvisi** – API paginata di Pubblicità Legale (avvisi ed esiti);
+*   **superset** – bootstrap della sessione (dashboard + ``csrf_token``) ed
+    endpoint ``chart/data``, anche con filtro IN per ``--superset-batch``;
+*   **postgrest** – sink compatibile PostgREST in memoria: select con filtri
+    ``eq``/``in``, insert/upsert con ``on_conflict`` e la RPC
+    ``upsert_tenders``.
+
+Ogni server può aggiungere latenza (``--latency-ms``) e rispondere con errori
+5xx a una frazione delle richieste (``--error-rate``), per misurare anche
+retry e backoff (attenzione: un errore Superset costa i 5-10 s di attesa del
+fetcher, quindi con ``--error-rate`` i tempi sono dominati dai backoff). I dati sono generati in modo deterministico (``--seed``).
+
+Per ogni dimensione (``--sizes``) si misurano ``unified_data_pipelineGPT.main``
+(un giorno, cache CIG vuota) e ``aggiudicatari_updater.process_day`` (metà dei
+CIG già presenti come lotti, metà da creare da Superset): avvisi/s, CIG/s e
+righe scritte/s, più le fasi più lente dal report del run (vedi
+``run_trace``).
+
+Il benchmark importa le pipeline nello stesso processo dopo aver puntato le
+variabili d'ambiente (``NEXT_PUBLIC_SUPABASE_URL``, ``PUBBLICITA_LEGALE_URL``,
+``SUPERSET_BASE_URL``, ``PIPELINE_LOCAL_DIR``, ...) ai server locali.
+
+Usage
+-----
+python bench_pipeline.py [--sizes 100,500,2000] [--targets pipeline,aggiudicatari]
+                         [--latency-ms 0] [--error-rate 0] [--superset-batch 0]
+                         [--loader postgrest|rpc] [--page-rate 4] [--out bench.json]
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+BENCH_DATE = "2025-06-02"
+LOOKUP_ROWS = {
+    "natura_principale": ["works", "goods", "services"],
+    "criterio_aggiudicazione": ["price", "quality"],
+    "stato_procedura": ["planning", "active", "complete", "cancelled", "unsuccessful"],
+    "tipo_procedura": ["open", "restricted", "negotiated", "competitive_dialogue",
+                       "direct", "manifestazione_interesse"],
+    "categoria_opera": ["OG1", "OG2", "OG3", "OS1", "OS3", "OS28", "OS30"],
+}
+# Valori realistici (vedi normalizzazione.CAMPIONE) per i campi testuali
+NATURE = ["LAVORI", "SERVIZI", "FORNITURE"]
+TIPI = ["PROCEDURA APERTA", "AFFIDAMENTO DIRETTO", "PROCEDURA NEGOZIATA SENZA PREVIA PUBBLICAZIONE",
+        "PROCEDURA RISTRETTA"]
+CRITERI = ["Minor prezzo", "Offerta economicamente vantaggiosa"]
+STATI = ["ATTIVO", "PUBBLICATA", "AGGIUDICATA"]
+CPV = [("45000000-7", "Lavori di costruzione"), ("72000000-5", "Servizi informatici"),
+       ("33600000-6", "Prodotti farmaceutici"), ("90910000-9", "Servizi di pulizia")]
+
+
+# ---------------------------------------------------------------------------
+# DATI SINTETICI
+# ---------------------------------------------------------------------------
+
+def _cig(i: int) -> str:
+    return f"B{i:09X}"[:10]
+
+
+def _oggetto(cig: str, i: int, **extra: Any) -> Dict[str, Any]:
+    return {
+        "cig": cig,
+        "natura_principale": NATURE[i % len(NATURE)].title(),
+        "criteri_aggiudicazione": CRITERI[i % len(CRITERI)],
+        "documenti_di_gara_link": f"https://example.invalid/gare/{cig}",
+        **extra,
+    }
+
+
+def _avviso(i: int, cig: str, codice_scheda: str, **oggetto: Any) -> Dict[str, Any]:
+    return {
+        "idAvviso": f"00000000-bench-{codice_scheda}-{i:08d}",
+        "idAppalto": f"00000000-appalto-{i:08d}",
+        "codiceScheda": codice_scheda,
+        "dataPubblicazione": f"{BENCH_DATE}T06:00:00",
+        "dataScadenza": "2025-07-01T12:00:00",
+        "attivo": True,
+        "template": [{
+            "avviso": [{"dataPCP": f"{BENCH_DATE}T00:00:00"}],
+            "template": {"sections": [
+                {"name": "SEZ. A - Amministrazione", "items": [{}]},
+                {"name": "SEZ. C - Oggetto", "items": [_oggetto(cig, i, **oggetto)]},
+            ]},
+        }],
+    }
+
+
+def _superset_row(cig: str, i: int) -> Dict[str, Any]:
+    """Riga DETTAGLIO_CIG con le colonne JSON incorporate come stringhe."""
+    cod_cpv, desc_cpv = CPV[i % len(CPV)]
+    ente = i % 97
+    return {
+        "stazione_appaltante": json.dumps({
+            "CF_AMMINISTRAZIONE_APPALTANTE": f"{80000000000 + ente:011d}",
+            "DENOMINAZIONE_AMMINISTRAZIONE_APPALTANTE": f"COMUNE DI PROVA {ente}",
+            "CITTA": "Palermo", "REGIONE": "Sicilia",
+        }),
+        "bando": json.dumps({
+            "CIG": cig,
+            "CUP": json.dumps([{"CUP": f"J{i:014d}"}]),
+            "OGGETTO_GARA": f"Gara di prova {i} per il benchmark della pipeline",
+            "OGGETTO_LOTTO": f"Lotto unico {i}",
+            "OGGETTO_PRINCIPALE_CONTRATTO": NATURE[i % len(NATURE)],
+            "TIPO_SCELTA_CONTRAENTE": TIPI[i % len(TIPI)],
+            "CRITERIO_AGGIUDICAZIONE": CRITERI[i % len(CRITERI)],
+            "STATO": STATI[i % len(STATI)],
+            "IMPORTO_COMPLESSIVO_GARA": 10000.0 + i,
+            "IMPORTO_LOTTO": 10000.0 + i,
+            "IMPORTO_SICUREZZA": 100.0,
+            "DATA_SCADENZA_OFFERTA": "2025-07-01T12:00:00",
+            "LUOGO_ISTAT": "082053",
+            "CPV": json.dumps([{"COD_CPV": cod_cpv, "DESCRIZIONE_CPV": desc_cpv}]),
+        }),
+        "categorie_opera": json.dumps([
+            {"ID_CATEGORIA": LOOKUP_ROWS["categoria_opera"][i % 7], "COD_TIPO_CATEGORIA": "P"},
+            {"ID_CATEGORIA": LOOKUP_ROWS["categoria_opera"][(i + 3) % 7], "COD_TIPO_CATEGORIA": "S"},
+        ]),
+        "incaricati": json.dumps([{"COD_RUOLO": "RUP", "NOME": "Mario", "COGNOME": f"Rossi{i}",
+                                   "EMAIL": "rup@example.invalid", "TELEFONO": ""}]),
+        "pubblicazioni": json.dumps({"DATA_CREAZIONE": f"{BENCH_DATE}T00:00:00",
+                                     "DATA_PUBBLICAZIONE": f"{BENCH_DATE}T06:00:00",
+                                     "LINK_SITO_COMMITTENTE": "https://example.invalid"}),
+        "template": None,
+        "quadro_economico": None,
+    }
+
+
+@dataclass
+class Dataset:
+    """Avvisi, esiti e dettagli Superset per una dimensione del benchmark."""
+    avvisi: List[Dict[str, Any]]
+    esiti: List[Dict[str, Any]]
+    superset: Dict[str, Dict[str, Any]]
+    lotti_esistenti: List[str]
+
+    @classmethod
+    def generate(cls, size: int) -> "Dataset":
+        # Un avviso su cinque condivide il CIG con il precedente (rettifiche)
+        cig_avvisi = [_cig(i - (i % 5 == 4)) for i in range(size)]
+        avvisi = [_avviso(i, cig, "P1_16") for i, cig in enumerate(cig_avvisi)]
+        # Esiti: metà su CIG già caricati come lotti, metà su CIG nuovi
+        cig_esiti = [_cig(i) if i % 2 == 0 else _cig(10_000_000 + i) for i in range(size)]
+        esiti = [_avviso(i, cig, "P7_1", aggiudicatari_ad=[{
+            "importo": 9000.0 + i,
+            "soggetti": [{"denominazione": f"IMPRESA {i} SRL", "codice_fiscale": f"{10000000000 + i:011d}"}],
+        }]) for i, cig in enumerate(cig_esiti)]
+        superset = {cig: _superset_row(cig, n)
+                    for n, cig in enumerate(dict.fromkeys(cig_avvisi + cig_esiti))}
+        return cls(avvisi, esiti, superset, [cig for i, cig in enumerate(cig_esiti) if i % 2 == 0])
+
+
+# ---------------------------------------------------------------------------
+# SERVER LOCALI
+# ---------------------------------------------------------------------------
+
+class Faults:
+    """Latenza e risposte d'errore iniettate, uguali per tutti gli handler."""
+
+    def __init__(self, latency_ms: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def apply(self) -> bool:
+        """Attende la latenza; True se la richiesta deve fallire."""
+        with self._lock:
+            self.requests += 1
+            jitter = self._rng.random()
+            fail = self._rng.random() < self.error_rate
+            self.errors += fail
+        if self.latency:
+            time.sleep(self.latency * (0.5 + jitter))
+        return fail
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive come i server veri
+    disable_nagle_algorithm = True  # header e body sono due write: evita ~40 ms di ACK ritardato
+    stub: "Stub"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _dispatch(self, method: str) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.stub.faults.apply():
+            self.send_json(503, {"message": "errore iniettato dal benchmark"})
+            return
+        url = urlsplit(self.path)
+        try:
+            self.stub.handle(self, method, url.path, parse_qs(url.query), body)
+        except Exception as exc:
+            self.send_json(500, {"message": f"{type(exc).__name__}: {exc}"})
+
+    def do_GET(self) -> None:
+        self._dispatch("GET")
+
+    def do_POST(self) -> None:
+        self._dispatch("POST")
+
+    def do_PATCH(self) -> None:
+        self._dispatch("PATCH")
+
+    def send_json(self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        data = b"" if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Stub:
+    """Server HTTP locale su una porta libera, in un thread."""
+
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        handler = type(f"{type(self).__name__}Handler", (_Handler,), {"stub": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handle(self, req: _Handler, method: str, path: str, query: Dict[str, List[str]],
+               body: bytes) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AvvisiStub(Stub):
+    """API Spring-Page di Pubblicità Legale: esiti se ``codiceScheda`` contiene 7."""
+
+    dataset: Optional[Dataset] = None
+
+    def handle(self, req, method, path, query, body):
+        items = self.dataset.esiti if "7" in query.get("codiceScheda", [""])[0] else self.dataset.avvisi
+        page = int(query.get("page", ["0"])[0])
+        size = int(query.get("size", ["100"])[0])
+        content = items[page * size:(page + 1) * size]
+        req.send_json(200, {
+            "content": content,
+            "totalElements": len(items),
+            "number": page,
+            "last": (page + 1) * size >= len(items),
+        })
+
+
+class SupersetStub(Stub):
+    """Bootstrap sessione guest e ``chart/data`` per uno o più CIG."""
+
+    dataset: Optional[Dataset] = None
+
+    def handle(self, req, method, path, query, body):
+        if path.startswith("/superset/dashboard/"):
+            req.send_json(200, {}, {"Set-Cookie": "session=bench; Path=/"})
+        elif path.startswith("/api/v1/security/csrf_token"):
+            req.send_json(200, {"result": "bench-csrf"})
+        elif path.startswith("/api/v1/chart/data"):
+            q = json.loads(body)["queries"][0]
+            cigs = next((f["val"] for f in q.get("filters") or [] if f.get("op") == "IN"),
+                        [q.get("url_params", {}).get("cig")])
+            rows = [self.dataset.superset[c] for c in cigs if c in self.dataset.superset]
+            req.send_json(200, {"result": [{"data": rows, "rowcount": len(rows)}]})
+        else:
+            req.send_json(404, {"message": path})
+
+
+class PostgrestStub(Stub):
+    """Sink in memoria con la semantica PostgREST usata dalle pipeline."""
+
+    def __init__(self, faults: Faults):
+        super().__init__(faults)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with getattr(self, "_lock", threading.Lock()):
+            self.tables: Dict[str, Dict[int, Dict]] = {}
+            self.indexes: Dict[Tuple[str, Tuple[str, ...]], Dict[Tuple, int]] = {}
+            self.ids = itertools.count(1)
+            self.written: Dict[str, int] = {}
+
+    def seed(self, table: str, rows: List[Dict]) -> None:
+        with self._lock:
+            for row in rows:
+                self._insert(table, dict(row), count=False)
+
+    @property
+    def rows_written(self) -> int:
+        return sum(self.written.values())
+
+    # -- storage -----------------------------------------------------------
+    def _index(self, table: str, cols: Tuple[str, ...]) -> Dict[Tuple, int]:
+        index = self.indexes.get((table, cols))
+        if index is None:
+            index = self.indexes[(table, cols)] = {
+                tuple(row.get(c) for c in cols): rid for rid, row in self.tables.get(table, {}).items()
+            }
+        return index
+
+    def _insert(self, table: str, row: Dict, conflict: Tuple[str, ...] = (), count: bool = True) -> Dict:
+        rows = self.tables.setdefault(table, {})
+        key = tuple(row.get(c) for c in conflict)
+        # Come in PostgreSQL, un NULL nella chiave non va mai in conflitto
+        rid = self._index(table, conflict).get(key) if conflict and None not in key else None
+        if rid is None:
+            rid = row.get("id") or next(self.ids)
+            row = {**row, "id": rid}
+        else:
+            row = {**rows[rid], **row, "id": rid}
+        rows[rid] = row
+        for (t, cols), index in self.indexes.items():
+            if t == table:
+                index[tuple(row.get(c) for c in cols)] = rid
+        if count:
+            self.written[table] = self.written.get(table, 0) + 1
+        return row
+
+    def _select(self, table: str, query: Dict[str, List[str]]) -> List[Dict]:
+        filters = []
+        for col, values in query.items():
+            if col in ("select", "columns", "on_conflict", "limit", "order", "offset"):
+                continue
+            op, _, arg = values[0].partition(".")
+            if op == "eq":
+                filters.append((col, {arg}))
+            elif op == "in":
+                filters.append((col, {v.strip().strip('"') for v in arg.strip("()").split(",")}))
+        rows = [row for row in self.tables.get(table, {}).values()
+                if all(str(row.get(col)) in allowed for col, allowed in filters)]
+        columns = query.get("select", ["*"])[0]
+        if columns != "*":
+            keep = [c.strip() for c in columns.split(",")]
+            rows = [{c: row.get(c) for c in keep} for row in rows]
+        return rows
+
+    def _upsert_tenders(self, tenders: List[Dict]) -> List[Dict]:
+        written = []
+        for doc in tenders:
+            gara = self._insert("gara", doc["gara"], ("cig",))
+            for name in ("rup", "pubblicazione"):
+                if doc.get(name):
+                    self._insert(name, {**doc[name], "gara_id": gara["id"]}, ("gara_id",))
+            for avviso in doc.get("avvisi") or []:
+                self._insert("avviso_gara", {**avviso, "gara_id": gara["id"]}, ("id",))
+            lotto = None
+            if doc.get("lotto"):
+                lotto = self._insert("lotto", {**doc["lotto"], "gara_id": gara["id"]}, ("cig",))
+                for cat in doc.get("categorie") or []:
+                    self._insert("lotto_categoria_opera", {**cat, "lotto_id": lotto["id"]},
+                                 ("lotto_id", "categoria_opera_id"))
+            written.append({"cig": gara["cig"], "gara_id": gara["id"],
+                            "lotto_id": lotto["id"] if lotto else None})
+        return written
+
+    # -- HTTP --------------------------------------------------------------
+    def handle(self, req, method, path, query, body):
+        if not path.startswith("/rest/v1/"):
+            req.send_json(404, {"message": path})
+            return
+        table = unquote(path[len("/rest/v1/"):])
+        payload = json.loads(body) if body else None
+        with self._lock:
+            if table.startswith("rpc/"):
+                if table != "rpc/upsert_tenders":
+                    req.send_json(404, {"message": f"funzione {table} non disponibile"})
+                    return
+                result = self._upsert_tenders(payload["tenders"])
+            elif method == "GET":
+                result = self._select(table, query)
+            else:
+                rows = payload if isinstance(payload, list) else [payload]
+                conflict = tuple(c.strip() for c in query.get("on_conflict", [""])[0].split(",") if c.strip())
+                result = [self._insert(table, row, conflict) for row in rows]
+        if "return=minimal" in (req.headers.get("Prefer") or ""):
+            req.send_json(201, None)
+        else:
+            req.send_json(200 if method == "GET" else 201, result)
+
+
+# ---------------------------------------------------------------------------
+# RUNNER
+# ---------------------------------------------------------------------------
+
+@dataclass
+class BenchResult:
+    target: str
+    size: int
+    wall_s: float
+    avvisi: int
+    cigs: int
+    rows: int
+    exit_ok: bool
+    requests: Dict[str, int] = field(default_factory=dict)
+    slowest: List[Tuple[str, float]] = field(default_factory=list)
+    errors: Dict[str, Dict[str, int]] = field(default_factory=dict)
+
+    def rate(self, n: int) -> float:
+        return n / self.wall_s if self.wall_s else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "target": self.target, "size": self.size, "wall_s": round(self.wall_s, 3),
+            "avvisi_s": round(self.rate(self.avvisi), 1), "cig_s": round(self.rate(self.cigs), 1),
+            "rows_s": round(self.rate(self.rows), 1), "rows": self.rows, "ok": self.exit_ok,
+            "requests": self.requests, "slowest_spans": self.slowest, "errors": self.errors,
+        }
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.workdir = Path(tempfile.mkdtemp(prefix="bench_pipeline_"))
+        self.faults = {name: Faults(args.latency_ms, args.error_rate, args.seed + n)
+                       for n, name in enumerate(("avvisi", "superset", "postgrest"))}
+        self.avvisi = AvvisiStub(self.faults["avvisi"])
+        self.superset = SupersetStub(self.faults["superset"])
+        self.sink = PostgrestStub(self.faults["postgrest"])
+        os.environ.update({
+            "NEXT_PUBLIC_SUPABASE_URL": self.sink.url,
+            "NEXT_PUBLIC_SUPABASE_ANON_KEY": "eyJhbGciOiJIUzI1NiJ9.e30.bench",
+            "PUBBLICITA_LEGALE_URL": f"{self.avvisi.url}/api/v0/avvisi",
+            "SUPERSET_BASE_URL": self.superset.url,
+            "SUPERSET_TOKEN_CACHE": str(self.workdir / "superset_session.json"),
+            "PIPELINE_LOCAL_DIR": str(self.workdir),
+            "PIPELINE_LOG_LEVEL": "debug" if args.verbose else "warning",
+        })
+        # Import dopo le variabili d'ambiente: i moduli le leggono all'import
+        import pubblicita_legale_fetch
+        pubblicita_legale_fetch.PAGE_RATE = args.page_rate
+
+    def _reset(self, dataset: Dataset, run_dir: Path) -> None:
+        for faults in self.faults.values():
+            faults.requests = faults.errors = 0
+        AvvisiStub.dataset = SupersetStub.dataset = dataset
+        self.sink.reset()
+        for table, codes in LOOKUP_ROWS.items():
+            column = "id_categoria" if table == "categoria_opera" else "codice"
+            self.sink.seed(table, [{column: code} for code in codes])
+        run_dir.mkdir(parents=True, exist_ok=True)
+        # Cache CIG e token vuoti: ogni run scarica tutto dai server locali
+        Path(os.environ["SUPERSET_TOKEN_CACHE"]).unlink(missing_ok=True)
+
+    def _result(self, target: str, size: int, wall: float, avvisi: int, cigs: int, ok: bool) -> BenchResult:
+        from run_trace import TRACER
+        report = TRACER.snapshot()
+        slowest = sorted(((name, s["total_s"]) for name, s in report["spans"].items()),
+                         key=lambda kv: kv[1], reverse=True)[:5]
+        return BenchResult(target, size, wall, avvisi, cigs, self.sink.rows_written, ok,
+                           {name: f.requests for name, f in self.faults.items()},
+                           slowest, report["errors"])
+
+    def run_pipeline(self, size: int, dataset: Dataset) -> BenchResult:
+        import unified_data_pipelineGPT as pipeline
+        from cig_store import CigStore
+
+        run_dir = self.workdir / f"pipeline_{size}"
+        self._reset(dataset, run_dir)
+        pipeline.cig_store = CigStore(run_dir / "cig.sqlite")
+        # Registro incrementale e indice delle righe vuoti: ogni run scrive tutto
+        pipeline.WATERMARK_PATH = run_dir / "avvisi_watermark.sqlite"
+        pipeline.CHANGE_INDEX_PATH = run_dir / "righe_scritte.sqlite"
+        argv = ["unified_data_pipelineGPT.py", "--date", BENCH_DATE, "--refresh-budget", "0",
+                "--superset-batch", str(self.args.superset_batch), "--loader", self.args.loader,
+                "--report", str(run_dir / "run_report.json")]
+        saved, sys.argv = sys.argv, argv
+        start = time.perf_counter()
+        try:
+            pipeline.main()
+            code = 0
+        except SystemExit as exc:
+            code = exc.code or 0
+        finally:
+            sys.argv = saved
+        wall = time.perf_counter() - start
+        cigs = len({pipeline.extract_cig_from_bando(pipeline.Avviso.from_api(a)) for a in dataset.avvisi})
+        return self._result("pipeline", size, wall, len(dataset.avvisi), cigs, code == 0)
+
+    def run_aggiudicatari(self, size: int, dataset: Dataset) -> BenchResult:
+        import aggiudicatari_updater as updater
+        from cig_store import CigStore
+        from run_trace import TRACER
+
+        run_dir = self.workdir / f"aggiudicatari_{size}"
+        self._reset(dataset, run_dir)
+        self.sink.seed("lotto", [{"cig": cig} for cig in dataset.lotti_esistenti])
+        updater.cig_store = CigStore(run_dir / "cig.sqlite")
+        TRACER.reset()
+        start = time.perf_counter()
+        try:
+            stats = updater.process_day(BENCH_DATE, batch_size=self.args.superset_batch)
+            ok = bool(stats) and not stats.get("errori")
+        except Exception as exc:
+            print(f"❌  aggiudicatari ({size}): {exc}")
+            ok = False
+        wall = time.perf_counter() - start
+        cigs = len({item["cig"] for e in dataset.esiti
+                    for s in e["template"][0]["template"]["sections"] for item in s["items"] if item})
+        return self._result("aggiudicatari", size, wall, len(dataset.esiti), cigs, ok)
+
+    def close(self) -> None:
+        for stub in (self.avvisi, self.superset, self.sink):
+            stub.close()
+
+
+def _print_results(results: List[BenchResult]) -> None:
+    print()
+    print(f"{'target':<14} {'size':>6} {'wall s':>8} {'avvisi/s':>9} {'CIG/s':>8} "
+          f"{'righe/s':>9} {'righe':>7}  fasi più lente")
+    for r in results:
+        slowest = ", ".join(f"{name} {total:.2f}s" for name, total in r.slowest[:3])
+        flag = "" if r.exit_ok else " ❌"
+        print(f"{r.target:<14} {r.size:>6} {r.wall_s:>8.2f} {r.rate(r.avvisi):>9.1f} "
+              f"{r.rate(r.cigs):>8.1f} {r.rate(r.rows):>9.1f} {r.rows:>7}  {slowest}{flag}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end con servizi locali finti")
+    parser.add_argument("--sizes", default="100,500,2000",
+                        help="Avvisi (ed esiti) per giorno, separati da virgola")
+    parser.add_argument("--targets", default="pipeline,aggiudicatari",
+                        help="pipeline, aggiudicatari o entrambi")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="Latenza media aggiunta a ogni risposta (±50%%)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Frazione di richieste che ricevono un errore 503")
+    parser.add_argument("--superset-batch", type=int, default=0, metavar="N",
+                        help="CIG per query Superset (0 = una query per CIG)")
+    parser.add_argument("--loader", choices=("postgrest", "rpc"), default="postgrest")
+    parser.add_argument("--page-rate", type=float, default=4.0,
+                        help="Limite richieste/s verso l'API avvisi (come in produzione)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", type=Path, help="Salva i risultati in JSON")
+    parser.add_argument("--verbose", action="store_true", help="Log delle pipeline a livello debug")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    unknown = set(targets) - {"pipeline", "aggiudicatari"}
+    if unknown:
+        parser.error(f"target sconosciuti: {', '.join(sorted(unknown))}")
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    bench = Bench(args)
+    print(f"🧪  Server locali: avvisi {bench.avvisi.url}, superset {bench.superset.url}, "
+          f"postgrest {bench.sink.url} (dati in {bench.workdir})")
+    results: List[BenchResult] = []
+    runners: Dict[str, Callable[[int, Dataset], BenchResult]] = {
+        "pipeline": bench.run_pipeline,
+        "aggiudicatari": bench.run_aggiudicatari,
+    }
+    try:
+        for size in sizes:
+            dataset = Dataset.generate(size)
+            for target in targets:
+                print(f"\n🧪  {target}: {size} avvisi")
+                results.append(runners[target](size, dataset))
+    finally:
+        bench.close()
+
+    _print_results(results)
+    if args.out:
+        args.out.write_text(json.dumps({
+            "args": {k: str(v) for k, v in vars(args).items()},
+            "results": [r.to_dict() for r in results],
+        }, indent=2), encoding="utf-8")
+        print(f"📄  Risultati salvati in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+change_index.py
+===============
+
+Indice locale delle righe già scritte su Supabase, per non riscrivere quelle
+che non sono cambiate.
+
+Per ogni riga scritta con ``supabase_batch.BatchUpserter`` (o
+``pg_loader.PgUpserter``, o un documento di ``rpc_batched``) si salva un hash
+del contenuto con chiave (tabella, chiave naturale): CIG per gara e lotto,
+``gara_id`` per RUP e pubblicazione, id per ``avviso_gara``, coppia
+lotto/categoria per ``lotto_categoria_opera``. Al ``flush`` successivo le
+righe con lo stesso hash non vengono inviate: l'id restituito a suo tempo dal
+database viene riusato, così le tabelle che dipendono da ``gara_id`` o
+``lotto_id`` si compongono come prima. Meno upsert significa meno scritture
+e meno WAL su Supabase quando gli stessi bandi vengono ricaricati.
+
+L'hash viene registrato solo dopo la scrittura (per ``PgUpserter`` dopo il
+commit). L'indice descrive ciò che questa macchina ha scritto: se il
+database viene modificato da altri o ripristinato, ``--full`` sulla pipeline
+lo ignora (continuando ad aggiornarlo) oppure ``forget`` lo svuota.
+
+Usage
+-----
+python change_index.py stats [--db righe_scritte.sqlite]
+python change_index.py forget [<tabella>] [--db righe_scritte.sqlite]
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+DEFAULT_DB = Path("righe_scritte.sqlite")
+SQLITE_MAX_VARS = 900       # Parametri per query IN (limite SQLite: 999)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS riga_scritta (
+    tabella     TEXT NOT NULL,
+    chiave      TEXT NOT NULL,
+    hash        TEXT NOT NULL,
+    row_id      TEXT,
+    scritta_at  REAL NOT NULL,
+    PRIMARY KEY (tabella, chiave)
+) WITHOUT ROWID;
+"""
+
+
+def row_hash(row: Any) -> str:
+    """Hash stabile del contenuto di una riga (o di un documento annidato)."""
+    raw = json.dumps(row, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _key_text(key: Hashable) -> str:
+    return json.dumps(key, ensure_ascii=False, default=str)
+
+
+class ChangeIndex:
+    """(tabella, chiave naturale) → (hash, id) delle righe scritte, thread-safe.
+
+    Con ``skip_unchanged=False`` ``unchanged`` non trova mai nulla ma le
+    scritture vengono comunque registrate (run completi, ``--full``).
+    """
+
+    def __init__(self, path: Path = DEFAULT_DB, skip_unchanged: bool = True):
+        self.path = Path(path)
+        self.skip_unchanged = skip_unchanged
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30,
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def unchanged(self, table: str, hashes: Dict[Hashable, str],
+                  need_id: bool = False) -> Dict[Hashable, Any]:
+        """Chiavi con lo stesso hash già registrato → id salvato.
+
+        Con ``need_id`` le righe registrate senza id (scritte senza
+        ``returning``) non contano come invariate.
+        """
+        if not self.skip_unchanged or not hashes:
+            return {}
+        by_text = {_key_text(key): key for key in hashes}
+        texts = list(by_text)
+        found: Dict[Hashable, Any] = {}
+        with self._lock:
+            for i in range(0, len(texts), SQLITE_MAX_VARS):
+                chunk = texts[i:i + SQLITE_MAX_VARS]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT chiave, hash, row_id FROM riga_scritta "
+                    f"WHERE tabella = ? AND chiave IN ({marks})",
+                    [table, *chunk],
+                ).fetchall()
+                for text, digest, row_id in rows:
+                    key = by_text[text]
+                    if digest != hashes[key] or (need_id and row_id is None):
+                        continue
+                    found[key] = json.loads(row_id) if row_id is not None else None
+        return found
+
+    def record(self, table: str, entries: Iterable[Tuple[Hashable, str, Any]]) -> None:
+        """Registra (chiave, hash, id) delle righe appena scritte."""
+        now = time.time()
+        rows = [(table, _key_text(key), digest,
+                 json.dumps(row_id, default=str) if row_id is not None else None, now)
+                for key, digest, row_id in entries]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO riga_scritta (tabella, chiave, hash, row_id, scritta_at) "
+                    "VALUES (?, ?, ?, ?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def forget(self, table: Optional[str] = None) -> int:
+        with self._lock:
+            if table:
+                return self._conn.execute("DELETE FROM riga_scritta WHERE tabella = ?", (table,)).rowcount
+            return self._conn.execute("DELETE FROM riga_scritta").rowcount
+
+    def stats(self) -> List[Tuple[str, int]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT tabella, COUNT(*) FROM riga_scritta GROUP BY tabella ORDER BY tabella"
+            ).fetchall()
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Indice delle righe già scritte su Supabase")
+    parser.add_argument("--db", type=Path, default=DEFAULT_DB)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("stats", help="Righe registrate per tabella")
+    p_forget = sub.add_parser("forget", help="Svuota l'indice (tutto o una tabella)")
+    p_forget.add_argument("tabella", nargs="?")
+    args = parser.parse_args()
+
+    index = ChangeIndex(args.db)
+    if args.cmd == "stats":
+        rows = index.stats()
+        for table, n in rows:
+            print(f"{table:<28} {n:>10}")
+        print(f"{'totale':<28} {sum(n for _, n in rows):>10}")
+    elif args.cmd == "forget":
+        print(f"🗑  {index.forget(args.tabella)} righe dimenticate")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+cig_store.py
+============
+
+Cache dei dettagli CIG scaricati da Superset in un unico file SQLite.
+
+Ogni risposta Superset è salvata come blob compresso (zstd se il pacchetto
+``zstandard`` è installato, altrimenti zlib) con chiave il CIG. Le scritture
+avvengono in transazione, quindi una voce parziale non finisce mai in cache;
+la lettura per chiave primaria resta costante anche con centinaia di migliaia
+di CIG, a differenza di una directory con un file JSON per CIG.
+
+Ogni voce ha una scadenza che dipende dallo stato della procedura: le gare
+ancora attive (soprattutto se vicine alla scadenza offerte) vanno riscaricate
+spesso, quelle concluse quasi mai. ``stale_cigs`` restituisce le voci scadute
+in ordine di priorità; il refresh vero e proprio lo fa il fetcher Superset
+(``refresh_budget`` di ``fetch_many_cig_details`` oppure il comando
+``refresh`` qui sotto).
+
+I CIG che Superset non restituisce (o che falliscono dopo tutti i retry)
+finiscono nella cache negativa ``cig_miss`` con motivo e numero di tentativi:
+vengono ritentati solo quando scade ``next_retry``, con attesa che raddoppia
+a ogni fallimento, invece di costare minuti di timeout a ogni esecuzione.
+
+Usage
+-----
+python cig_store.py import <directory_json> [--db cig_completi.sqlite]
+python cig_store.py stats [--db cig_completi.sqlite]
+python cig_store.py show <CIG> [--db cig_completi.sqlite]
+python cig_store.py refresh [--budget 100] [--db cig_completi.sqlite]
+python cig_store.py misses [--due] [--db cig_completi.sqlite]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # zstd è opzionale: senza il pacchetto si usa zlib
+    zstandard = None
+
+DEFAULT_DB = Path("cig_completi.sqlite")
+SQLITE_MAX_VARS = 900       # Parametri per query IN (limite SQLite: 999)
+IMPORT_CHUNK = 1000         # File importati per transazione
+
+# Politica di freschezza (secondi)
+TTL_TERMINAL = 90 * 86400        # Procedure concluse, aggiudicate, annullate
+TTL_ACTIVE = 2 * 86400           # Procedure in corso
+TTL_NEAR_DEADLINE = 12 * 3600    # In corso con scadenza offerte vicina
+NEAR_DEADLINE = 7 * 86400        # Finestra "vicina alla scadenza"
+# Cache negativa: attesa prima del nuovo tentativo = base * 2^(tentativi-1)
+MISS_RETRY_BASE = 6 * 3600
+MISS_RETRY_MAX = 30 * 86400
+MISS_NOT_FOUND = "not_found"     # Superset risponde ma senza righe
+MISS_ERROR = "error"             # Timeout/errori anche dopo i retry
+
+TERMINAL_STATES = ("aggiudicat", "conclus", "annullat", "revocat",
+                   "cancellat", "senza esito", "desert")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cig_detail (
+    cig         TEXT PRIMARY KEY,
+    codec       TEXT NOT NULL,
+    payload     BLOB NOT NULL,
+    fetched_at  REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS cig_miss (
+    cig           TEXT PRIMARY KEY,
+    reason        TEXT NOT NULL,
+    detail        TEXT,
+    attempts      INTEGER NOT NULL,
+    first_failed  REAL NOT NULL,
+    last_failed   REAL NOT NULL,
+    next_retry    REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Colonne aggiunte dopo la prima versione: (nome, tipo)
+_FRESHNESS_COLUMNS = [
+    ("stato", "TEXT"),
+    ("deadline", "REAL"),
+    ("terminal", "INTEGER NOT NULL DEFAULT 0"),
+    ("expires_at", "REAL NOT NULL DEFAULT 0"),
+]
+
+
+def _compress(data: dict) -> Tuple[str, bytes]:
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(raw)
+    return "zlib", zlib.compress(raw, 6)
+
+
+def _decompress(codec: str, payload: bytes) -> dict:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("voce compressa con zstd: installa il pacchetto 'zstandard'")
+        raw = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == "zlib":
+        raw = zlib.decompress(payload)
+    else:
+        raise ValueError(f"codec sconosciuto: {codec}")
+    return json.loads(raw)
+
+
+def _parse_deadline(value: Any) -> Optional[float]:
+    """Timestamp di DATA_SCADENZA_OFFERTA ('2025-07-15', '2025-07-15T12:00:00',
+    '2025-07-15 12:00:00.0', ...); None se assente o illeggibile."""
+    if not isinstance(value, str) or len(value) < 10:
+        return None
+    try:
+        return datetime.strptime(value[:10], "%Y-%m-%d").timestamp()
+    except ValueError:
+        return None
+
+
+def freshness(data: dict, fetched_at: float) -> Tuple[Optional[str], Optional[float], int, float]:
+    """(stato, scadenza offerte, terminale, scade_il) di una risposta Superset."""
+    bando: Any = {}
+    try:
+        bando = (data.get("result") or [{}])[0].get("data", [{}])[0].get("bando") or {}
+        if isinstance(bando, str):
+            bando = json.loads(bando)
+    except (AttributeError, IndexError, json.JSONDecodeError):
+        bando = {}
+    if not isinstance(bando, dict):
+        bando = {}
+
+    stato = bando.get("STATO") if isinstance(bando.get("STATO"), str) else None
+    deadline = _parse_deadline(bando.get("DATA_SCADENZA_OFFERTA"))
+    terminal = int(bool(stato) and any(s in stato.lower() for s in TERMINAL_STATES))
+
+    if terminal:
+        ttl = TTL_TERMINAL
+    elif deadline is not None and fetched_at <= deadline <= fetched_at + NEAR_DEADLINE:
+        ttl = TTL_NEAR_DEADLINE
+    else:
+        ttl = TTL_ACTIVE
+    return stato, deadline, terminal, fetched_at + ttl
+
+
+def miss_delay(attempts: int) -> float:
+    """Attesa prima di ritentare un CIG fallito ``attempts`` volte."""
+    return min(MISS_RETRY_MAX, MISS_RETRY_BASE * 2 ** max(0, attempts - 1))
+
+
+def _chunks(items: List[str], size: int) -> Iterator[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class CigStore:
+    """Cache chiave-valore CIG → risposta Superset, thread-safe.
+
+    Più processi possono condividere lo stesso file: il database usa il
+    journal WAL e attende (``busy_timeout``) invece di fallire sui lock.
+    """
+
+    def __init__(self, path: Path = DEFAULT_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30,
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        """Aggiunge le colonne di freschezza ai database creati prima e le
+        calcola per le voci già presenti."""
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(cig_detail)")}
+        missing = [(name, kind) for name, kind in _FRESHNESS_COLUMNS if name not in existing]
+        if missing:
+            with self._transaction():
+                for name, kind in missing:
+                    self._conn.execute(f"ALTER TABLE cig_detail ADD COLUMN {name} {kind}")
+            rows = self._conn.execute(
+                "SELECT cig, codec, payload, fetched_at FROM cig_detail"
+            ).fetchall()
+            updates = []
+            for cig, codec, payload, fetched_at in rows:
+                try:
+                    updates.append((*freshness(_decompress(codec, payload), fetched_at), cig))
+                except Exception:
+                    continue
+            with self._transaction():
+                self._conn.executemany(
+                    "UPDATE cig_detail SET stato = ?, deadline = ?, terminal = ?, expires_at = ? "
+                    "WHERE cig = ?",
+                    updates,
+                )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cig_detail_expires ON cig_detail (expires_at)"
+        )
+
+    def __enter__(self) -> "CigStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cig_detail").fetchone()[0]
+
+    def __contains__(self, cig: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM cig_detail WHERE cig = ?", (cig,)
+            ).fetchone()
+        return row is not None
+
+    def get(self, cig: str) -> Optional[dict]:
+        return self.get_many([cig]).get(cig)
+
+    def get_many(self, cigs: Iterable[str]) -> Dict[str, dict]:
+        """Legge più CIG con query IN a blocchi; i CIG assenti o illeggibili
+        non compaiono nel risultato."""
+        result: Dict[str, dict] = {}
+        for chunk in _chunks(list(dict.fromkeys(cigs)), SQLITE_MAX_VARS):
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT cig, codec, payload FROM cig_detail WHERE cig IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+            for cig, codec, payload in rows:
+                try:
+                    result[cig] = _decompress(codec, payload)
+                except Exception as exc:
+                    print(f"  ↳ errore lettura cache per CIG {cig}: {exc}")
+        return result
+
+    def put(self, cig: str, data: dict) -> None:
+        self.put_many({cig: data})
+
+    def put_many(self, items: Dict[str, dict],
+                 fetched_at: Optional[Dict[str, float]] = None) -> None:
+        """Scrive più CIG in un'unica transazione (tutto o niente).
+        ``fetched_at`` (CIG → timestamp) serve all'import; default: adesso."""
+        now = time.time()
+        fetched_at = fetched_at or {}
+        rows = []
+        for cig, data in items.items():
+            ts = fetched_at.get(cig, now)
+            rows.append((cig, *_compress(data), ts, *freshness(data, ts)))
+        if not rows:
+            return
+        with self._lock:
+            with self._transaction():
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO cig_detail "
+                    "(cig, codec, payload, fetched_at, stato, deadline, terminal, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.executemany(
+                    "DELETE FROM cig_miss WHERE cig = ?", [(row[0],) for row in rows]
+                )
+
+    def record_misses(self, misses: Dict[str, Tuple[str, Optional[str]]],
+                      now: Optional[float] = None) -> None:
+        """Registra i CIG falliti (CIG → (motivo, dettaglio)) e pianifica il
+        prossimo tentativo con backoff esponenziale sul numero di fallimenti."""
+        if not misses:
+            return
+        now = now or time.time()
+        cigs = list(misses)
+        with self._lock:
+            with self._transaction():
+                attempts: Dict[str, Tuple[int, float]] = {}
+                for chunk in _chunks(cigs, SQLITE_MAX_VARS):
+                    placeholders = ",".join("?" * len(chunk))
+                    for cig, n, first in self._conn.execute(
+                        f"SELECT cig, attempts, first_failed FROM cig_miss "
+                        f"WHERE cig IN ({placeholders})", chunk,
+                    ):
+                        attempts[cig] = (n, first)
+                rows = []
+                for cig, (reason, detail) in misses.items():
+                    n, first = attempts.get(cig, (0, now))
+                    n += 1
+                    rows.append((cig, reason, detail, n, first, now, now + miss_delay(n)))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO cig_miss "
+                    "(cig, reason, detail, attempts, first_failed, last_failed, next_retry) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+
+    def record_miss(self, cig: str, reason: str, detail: Optional[str] = None) -> None:
+        self.record_misses({cig: (reason, detail)})
+
+    def deferred_cigs(self, cigs: Iterable[str], now: Optional[float] = None) -> Dict[str, float]:
+        """CIG della cache negativa non ancora da ritentare → ``next_retry``."""
+        now = now or time.time()
+        deferred: Dict[str, float] = {}
+        for chunk in _chunks(list(dict.fromkeys(cigs)), SQLITE_MAX_VARS):
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                deferred.update(self._conn.execute(
+                    f"SELECT cig, next_retry FROM cig_miss "
+                    f"WHERE next_retry > ? AND cig IN ({placeholders})",
+                    [now, *chunk],
+                ).fetchall())
+        return deferred
+
+    def misses(self, due_only: bool = False, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Contenuto della cache negativa, dai CIG con più fallimenti."""
+        now = now or time.time()
+        query = ("SELECT cig, reason, detail, attempts, first_failed, last_failed, next_retry "
+                 "FROM cig_miss")
+        params: Tuple[Any, ...] = ()
+        if due_only:
+            query += " WHERE next_retry <= ?"
+            params = (now,)
+        with self._lock:
+            rows = self._conn.execute(
+                query + " ORDER BY attempts DESC, last_failed DESC", params
+            ).fetchall()
+        keys = ("cig", "reason", "detail", "attempts", "first_failed", "last_failed", "next_retry")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def stale_cigs(self, cigs: Optional[Iterable[str]] = None,
+                   limit: Optional[int] = None,
+                   now: Optional[float] = None) -> List[str]:
+        """CIG scaduti in ordine di priorità di refresh: prima le procedure
+        attive con scadenza offerte entro ``NEAR_DEADLINE``, poi le altre
+        attive, infine quelle concluse; a parità, le voci più vecchie.
+        Con ``cigs`` la ricerca è limitata a quei CIG."""
+        now = now or time.time()
+        query = (
+            "SELECT cig, "
+            "  CASE WHEN terminal THEN 2 "
+            "       WHEN deadline BETWEEN :now AND :near THEN 0 "
+            "       ELSE 1 END AS priority, "
+            "  fetched_at "
+            "FROM cig_detail WHERE expires_at < :now"
+        )
+        params: Dict[str, Any] = {"now": now, "near": now + NEAR_DEADLINE}
+        candidates: List[Tuple[str, int, float]] = []
+        if cigs is None:
+            with self._lock:
+                candidates = self._conn.execute(query, params).fetchall()
+        else:
+            for chunk in _chunks(list(dict.fromkeys(cigs)), SQLITE_MAX_VARS):
+                names = [f":c{i}" for i in range(len(chunk))]
+                chunk_params = {**params, **{n[1:]: c for n, c in zip(names, chunk)}}
+                with self._lock:
+                    candidates.extend(self._conn.execute(
+                        f"{query} AND cig IN ({','.join(names)})", chunk_params
+                    ).fetchall())
+        candidates.sort(key=lambda row: (row[1], row[2]))
+        stale = [row[0] for row in candidates]
+        return stale[:limit] if limit is not None else stale
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            count, size, stale = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0), "
+                "COALESCE(SUM(expires_at < ?), 0) FROM cig_detail",
+                (time.time(),),
+            ).fetchone()
+            misses, deferred = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(next_retry > ?), 0) FROM cig_miss",
+                (time.time(),),
+            ).fetchone()
+        return {"cig": count, "compressed_bytes": size, "stale": stale,
+                "misses": misses, "deferred": deferred}
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+
+def import_directory(store: CigStore, directory: Path) -> Tuple[int, int]:
+    """Importa i file ``<CIG>.json`` della vecchia cache a directory.
+
+    I file vuoti (``{}``) scritti dalle versioni precedenti per i CIG non
+    trovati vengono saltati. Restituisce (importati, saltati).
+    """
+    imported = skipped = 0
+    batch: Dict[str, dict] = {}
+    mtimes: Dict[str, float] = {}
+    for path in sorted(Path(directory).glob("*.json")):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as exc:
+            print(f"  ↳ file non valido {path.name}: {exc}")
+            skipped += 1
+            continue
+        if not data:
+            skipped += 1
+            continue
+        cig = path.stem.upper()
+        batch[cig] = data
+        mtimes[cig] = path.stat().st_mtime
+        if len(batch) >= IMPORT_CHUNK:
+            store.put_many(batch, fetched_at=mtimes)
+            imported += len(batch)
+            batch, mtimes = {}, {}
+            print(f"\r📥 Importati: {imported}", end="", flush=True)
+    if batch:
+        store.put_many(batch, fetched_at=mtimes)
+        imported += len(batch)
+    print(f"\r📥 Importati: {imported}")
+    return imported, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cache SQLite dei dettagli CIG")
+    parser.add_argument("--db", type=Path, default=DEFAULT_DB, help="File SQLite della cache")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="Importa una directory di file <CIG>.json")
+    imp.add_argument("directory", type=Path)
+    sub.add_parser("stats", help="Numero di CIG e dimensione compressa")
+    show = sub.add_parser("show", help="Stampa la risposta Superset di un CIG")
+    show.add_argument("cig")
+    refresh = sub.add_parser("refresh", help="Riscarica le voci scadute, in ordine di priorità")
+    refresh.add_argument("--budget", type=int, default=100,
+                         help="Numero massimo di richieste Superset")
+    misses = sub.add_parser("misses", help="Elenca i CIG nella cache negativa")
+    misses.add_argument("--due", action="store_true",
+                        help="Solo quelli già da ritentare")
+    args = parser.parse_args()
+
+    with CigStore(args.db) as store:
+        if args.command == "import":
+            if not args.directory.is_dir():
+                print(f"Errore: {args.directory} non è una directory")
+                sys.exit(1)
+            imported, skipped = import_directory(store, args.directory)
+            print(f"✔  {imported} CIG importati, {skipped} file saltati in {args.db}")
+        elif args.command == "stats":
+            stats = store.stats()
+            print(f"CIG in cache: {stats['cig']} ({stats['stale']} da aggiornare), "
+                  f"dimensione compressa: {stats['compressed_bytes'] / 1e6:.1f} MB")
+            print(f"CIG non trovati/falliti: {stats['misses']} "
+                  f"({stats['deferred']} in attesa di nuovo tentativo)")
+        elif args.command == "show":
+            data = store.get(args.cig.strip().upper())
+            if data is None:
+                print(f"CIG {args.cig} non presente in cache")
+                sys.exit(2)
+            print(json.dumps(data, indent=2, ensure_ascii=False))
+        elif args.command == "refresh":
+            stale = store.stale_cigs(limit=args.budget)
+            if not stale:
+                print("Nessuna voce da aggiornare")
+                return
+            # Import ritardato: superset_cig_fetch dipende da questo modulo
+            from superset_cig_fetch import fetch_many_cig_details
+            fetch_many_cig_details(stale, cache=store, refresh_budget=len(stale))
+            refreshed = len(stale) - len(store.stale_cigs(stale))
+            print(f"✔  {refreshed}/{len(stale)} voci aggiornate")
+        elif args.command == "misses":
+            rows = store.misses(due_only=args.due)
+            if not rows:
+                print("Cache negativa vuota")
+                return
+            fmt = "%Y-%m-%d %H:%M"
+            print(f"{'CIG':<12} {'motivo':<10} {'tent.':>5}  {'ultimo errore':<16}  "
+                  f"{'prossimo tentativo':<18}  dettaglio")
+            for row in rows:
+                print(f"{row['cig']:<12} {row['reason']:<10} {row['attempts']:>5}  "
+                      f"{datetime.fromtimestamp(row['last_failed']).strftime(fmt):<16}  "
+                      f"{datetime.fromtimestamp(row['next_retry']).strftime(fmt):<18}  "
+                      f"{row['detail'] or ''}")
+            by_reason: Dict[str, int] = {}
+            for row in rows:
+                by_reason[row["reason"]] = by_reason.get(row["reason"], 0) + 1
+            print(f"Totale: {len(rows)} CIG ("
+                  + ", ".join(f"{k}: {v}" for k, v in sorted(by_reason.items())) + ")")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+http_archive.py
+===============
+
+Registrazione e riproduzione delle risposte HTTP di Pubblicità Legale e di
+Superset, per rielaborare giorni passati senza rete.
+
+Con ``configure("record", path)`` ogni risposta 200 delle sessioni
+``requests`` passate a ``mount`` viene salvata in un archivio SQLite (corpo
+compresso, zstd se disponibile altrimenti zlib) con chiave la richiesta;
+con ``configure("replay", path)`` le stesse richieste vengono servite
+dall'archivio e una richiesta assente solleva ``ReplayMiss`` invece di
+andare in rete. Le risposte non cambiano fra un run e l'altro, quindi
+rielaborare un mese dopo una correzione delle mappature richiede solo il
+tempo di normalizzazione e scrittura.
+
+La chiave di default è metodo + path + parametri ordinati (+ hash del corpo):
+host e header non ne fanno parte, così un archivio resta valido anche se
+cambiano gli URL di base o i token. Le richieste il cui corpo contiene dati
+variabili (UUID, timestamp) o che raggruppano più oggetti registrano una
+``Route`` propria: ad esempio ``superset_cig_fetch`` salva le risposte
+``chart/data`` per CIG, quindi un archivio registrato con ``--superset-batch``
+si può riprodurre anche a richieste singole e viceversa.
+
+Cookie e token di sessione non vengono mai archiviati: in replay il fetcher
+Superset non apre sessioni (vedi ``replaying``).
+
+Usage
+-----
+python http_archive.py stats <archivio.sqlite>
+python http_archive.py keys <archivio.sqlite> [--prefix GET]
+python http_archive.py show <archivio.sqlite> <chiave>
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from run_trace import TRACER
+
+try:
+    import zstandard
+except ImportError:  # zstd è opzionale: senza il pacchetto si usa zlib
+    zstandard = None
+
+MODES = ("record", "replay")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS http_response (
+    key           TEXT PRIMARY KEY,
+    status        INTEGER NOT NULL,
+    content_type  TEXT,
+    codec         TEXT NOT NULL,
+    body          BLOB NOT NULL,
+    recorded_at   REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class ReplayMiss(requests.exceptions.ConnectionError):
+    """Richiesta non presente nell'archivio durante il replay."""
+
+
+def _pack(body: bytes) -> Tuple[str, bytes]:
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(body)
+    return "zlib", zlib.compress(body, 6)
+
+
+def _unpack(codec: str, payload: bytes) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("voce compressa con zstd: installa il pacchetto 'zstandard'")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if codec == "zlib":
+        return zlib.decompress(payload)
+    raise ValueError(f"codec sconosciuto: {codec}")
+
+
+def request_key(request: requests.PreparedRequest) -> str:
+    """Chiave di default: ``GET /path?a=1&b=2`` più l'hash del corpo, se c'è."""
+    url = urlsplit(request.url)
+    query = urlencode(sorted(parse_qsl(url.query, keep_blank_values=True)))
+    key = f"{request.method} {url.path}" + (f"?{query}" if query else "")
+    body = request.body
+    if body:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        key += f" #{hashlib.sha1(body).hexdigest()[:16]}"
+    return key
+
+
+class Route:
+    """Come una famiglia di richieste viene archiviata.
+
+    ``split`` riceve una risposta registrata e restituisce le voci da
+    salvare (chiave → corpo); ``join`` ricompone il corpo della risposta
+    dalle voci trovate in archivio, oppure ``None`` se mancano.
+    """
+
+    def matches(self, request: requests.PreparedRequest) -> bool:
+        return True
+
+    def keys(self, request: requests.PreparedRequest) -> List[str]:
+        return [request_key(request)]
+
+    def split(self, request: requests.PreparedRequest, body: bytes) -> Dict[str, bytes]:
+        return {request_key(request): body}
+
+    def join(self, request: requests.PreparedRequest, found: Dict[str, bytes]) -> Optional[bytes]:
+        return found.get(request_key(request))
+
+
+_DEFAULT_ROUTE = Route()
+_ROUTES: List[Route] = []
+
+
+def register(route: Route) -> None:
+    """Aggiunge una ``Route`` specifica (consultata prima di quella di default)."""
+    _ROUTES.append(route)
+
+
+def _route(request: requests.PreparedRequest) -> Route:
+    return next((r for r in _ROUTES if r.matches(request)), _DEFAULT_ROUTE)
+
+
+class HttpArchive:
+    """Archivio chiave → risposta HTTP in un file SQLite, thread-safe."""
+
+    def __init__(self, path: Path, mode: str):
+        if mode not in MODES:
+            raise ValueError(f"modalità sconosciuta: {mode}")
+        self.path = Path(path)
+        self.mode = mode
+        if mode == "replay" and not self.path.exists():
+            raise FileNotFoundError(f"archivio HTTP non trovato: {self.path}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30,
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def get_many(self, keys: List[str]) -> Dict[str, Tuple[str, bytes]]:
+        """Voci presenti fra ``keys``: chiave → (content_type, corpo)."""
+        marks = ",".join("?" * len(keys))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, content_type, codec, body FROM http_response WHERE key IN ({marks})",
+                keys,
+            ).fetchall()
+        return {key: (ctype, _unpack(codec, body)) for key, ctype, codec, body in rows}
+
+    def put_many(self, entries: Dict[str, bytes], status: int, content_type: Optional[str]) -> None:
+        now = time.time()
+        rows = [(key, status, content_type, *_pack(body), now) for key, body in entries.items()]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO http_response "
+                "(key, status, content_type, codec, body, recorded_at) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            count, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM http_response"
+            ).fetchone()
+        return {"risposte": count, "byte_compressi": size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ArchiveAdapter(BaseAdapter):
+    """Transport ``requests`` che registra le risposte o le riproduce.
+
+    L'archivio attivo viene letto a ogni richiesta: le sessioni create prima
+    di ``configure`` (per esempio quelle per thread) seguono la modalità
+    corrente; senza archivio le richieste passano invariate a ``inner``.
+    """
+
+    def __init__(self, inner: BaseAdapter):
+        super().__init__()
+        self.inner = inner
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        archive = ARCHIVE
+        if archive is None:
+            return self.inner.send(request, **kwargs)
+        route = _route(request)
+        if archive.mode == "replay":
+            return self._replay(archive, request, route)
+        response = self.inner.send(request, **kwargs)
+        if response.status_code == 200:
+            entries = route.split(request, response.content)
+            if entries:
+                archive.put_many(entries, response.status_code,
+                                 response.headers.get("Content-Type"))
+                TRACER.count("http.registrate", len(entries))
+        return response
+
+    def _replay(self, archive: HttpArchive, request: requests.PreparedRequest,
+                route: Route) -> requests.Response:
+        keys = route.keys(request)
+        found = archive.get_many(keys)
+        body = route.join(request, {key: entry[1] for key, entry in found.items()})
+        if body is None:
+            TRACER.count("http.assenti")
+            raise ReplayMiss(f"risposta non archiviata: {keys[0]}", request=request)
+        TRACER.count("http.riprodotte")
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        content_type = next((entry[0] for entry in found.values() if entry[0]), "application/json")
+        response.headers = CaseInsensitiveDict({"Content-Type": content_type,
+                                                "Content-Length": str(len(body))})
+        response._content = body
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self) -> None:
+        self.inner.close()
+
+
+# ---------------------------------------------------------------------------
+# CONFIGURAZIONE DEL PROCESSO
+# ---------------------------------------------------------------------------
+
+ARCHIVE: Optional[HttpArchive] = None
+
+
+def configure(mode: Optional[str], path: Optional[Path]) -> None:
+    """Attiva registrazione o replay per tutto il processo (``None`` = rete)."""
+    global ARCHIVE
+    if ARCHIVE is not None:
+        ARCHIVE.close()
+        ARCHIVE = None
+    if mode:
+        ARCHIVE = HttpArchive(path, mode)
+        verb = "Registrazione" if mode == "record" else "Replay"
+        print(f"📼  {verb} delle risposte HTTP: {ARCHIVE.path}")
+
+
+def replaying() -> bool:
+    return ARCHIVE is not None and ARCHIVE.mode == "replay"
+
+
+def mount(session: requests.Session) -> requests.Session:
+    """Fa passare le richieste della sessione dall'archivio HTTP (se attivo)."""
+    for prefix in ("https://", "http://"):
+        adapter = session.get_adapter(prefix)
+        if not isinstance(adapter, ArchiveAdapter):
+            session.mount(prefix, ArchiveAdapter(adapter))
+    return session
+
+
+def close() -> None:
+    configure(None, None)
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Archivio delle risposte HTTP registrate")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_stats = sub.add_parser("stats", help="Numero e dimensione delle risposte")
+    p_stats.add_argument("archive", type=Path)
+    p_keys = sub.add_parser("keys", help="Elenca le chiavi")
+    p_keys.add_argument("archive", type=Path)
+    p_keys.add_argument("--prefix", default="")
+    p_show = sub.add_parser("show", help="Stampa una risposta")
+    p_show.add_argument("archive", type=Path)
+    p_show.add_argument("key")
+    args = parser.parse_args()
+
+    archive = HttpArchive(args.archive, "replay")
+    if args.cmd == "stats":
+        stats = archive.stats()
+        print(f"{stats['risposte']} risposte, {stats['byte_compressi'] / 1e6:.1f} MB compressi")
+    elif args.cmd == "keys":
+        with archive._lock:
+            rows = archive._conn.execute(
+                "SELECT key FROM http_response WHERE key >= ? ORDER BY key", (args.prefix,)
+            ).fetchall()
+        for (key,) in rows:
+            if not key.startswith(args.prefix):
+                break
+            print(key)
+    elif args.cmd == "show":
+        found = archive.get_many([args.key])
+        if not found:
+            print(f"❌  {args.key} non presente")
+            return
+        body = found[args.key][1]
+        try:
+            print(json.dumps(json.loads(body), ensure_ascii=False, indent=2))
+        except ValueError:
+            print(body.decode("utf-8", "replace"))
+    archive.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+merged_ndjson.py
+================
+
+File dei bandi uniti (``bandi_completi*.ndjson.gz``) in formato NDJSON
+compresso: un record JSON per riga, scritto man mano che il merge procede.
+
+A differenza del vecchio ``bandi_completi.json`` (un unico array scritto con
+``json.dump`` alla fine) il file non va tenuto tutto in memoria né per
+scriverlo né per leggerlo: ``iter_records`` restituisce un record alla volta
+e si può interrompere in qualsiasi punto. Il file viene scritto con un nome
+temporaneo e rinominato solo a scrittura completata, quindi un run interrotto
+non lascia un file troncato al posto di quello precedente.
+
+``iter_records`` legge anche i vecchi array ``.json`` (caricandoli interi),
+così i merge già salvati restano utilizzabili con ``--upload-only``.
+
+Usage
+-----
+python merged_ndjson.py count <file>
+python merged_ndjson.py convert <file.json> [<file.ndjson.gz>]
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import io
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+SUFFIX = ".ndjson.gz"
+COMPRESS_LEVEL = 5          # gzip: buon compromesso velocità/dimensione
+
+
+def _open_text(path: Path, mode: str, compressed: bool) -> io.TextIOBase:
+    if compressed:
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=COMPRESS_LEVEL)
+    return path.open(mode, encoding="utf-8")
+
+
+def _encode(obj: Any) -> Any:
+    """Oggetti con ``to_dict`` (es. ``bandi_model.Bando``) come dict."""
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError(f"{type(obj).__name__} non serializzabile in JSON")
+
+
+class NdjsonWriter:
+    """Scrive record NDJSON (compressi se il nome finisce in ``.gz``)."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.count = 0
+        self._tmp = self.path.with_name(self.path.name + ".part")
+        self._fp: Optional[io.TextIOBase] = None
+
+    def __enter__(self) -> "NdjsonWriter":
+        self._fp = _open_text(self._tmp, "w", self.path.name.endswith(".gz"))
+        return self
+
+    def write(self, record: Dict) -> None:
+        self._fp.write(json.dumps(record, ensure_ascii=False, separators=(",", ":"),
+                                  default=_encode))
+        self._fp.write("\n")
+        self.count += 1
+
+    def write_many(self, records: Iterable[Dict]) -> None:
+        for record in records:
+            self.write(record)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._fp.close()
+        if exc_type is None:
+            os.replace(self._tmp, self.path)
+        else:
+            self._tmp.unlink(missing_ok=True)
+
+
+def iter_records(path: Path) -> Iterator[Dict]:
+    """Legge un file di bandi uniti un record alla volta."""
+    path = Path(path)
+    if path.suffix == ".json":
+        # Formato precedente: un unico array JSON
+        with path.open(encoding="utf-8") as fp:
+            yield from json.load(fp)
+        return
+    with _open_text(path, "r", path.name.endswith(".gz")) as fp:
+        for n, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as exc:
+                raise ValueError(f"{path}:{n}: riga NDJSON non valida ({exc})") from None
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="File NDJSON dei bandi uniti")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_count = sub.add_parser("count", help="Conta i record di un file")
+    p_count.add_argument("file", type=Path)
+    p_conv = sub.add_parser("convert", help="Converte un vecchio array .json in NDJSON compresso")
+    p_conv.add_argument("file", type=Path)
+    p_conv.add_argument("out", type=Path, nargs="?")
+    args = parser.parse_args()
+
+    if args.cmd == "count":
+        print(sum(1 for _ in iter_records(args.file)))
+    elif args.cmd == "convert":
+        out = args.out or args.file.with_name(args.file.stem + SUFFIX)
+        with NdjsonWriter(out) as writer:
+            writer.write_many(iter_records(args.file))
+        print(f"✅  {writer.count} record scritti in {out}")
+
+
+if __name__ == "__main__":
+    main()
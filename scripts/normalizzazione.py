@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+normalizzazione.py
+==================
+
+Normalizzazione dei valori testuali di natura principale, criterio di
+aggiudicazione, stato e tipo di procedura verso i codici delle tabelle di
+lookup (``natura_principale``, ``criterio_aggiudicazione``,
+``stato_procedura``, ``tipo_procedura``).
+
+Le regole sono le stesse per la pipeline dei bandi e per l'updater degli
+aggiudicatari. Ogni tabella di sinonimi viene preparata una volta sola: un
+dizionario per il confronto esatto e una tupla ordinata per quello parziale
+(vince il primo sinonimo della tabella contenuto nel valore). L'esito per
+ogni stringa distinta viene memorizzato: i valori reali sono poche decine,
+ripetuti su migliaia di record, quindi la scansione parziale gira una volta
+sola per valore.
+
+``Normalizzatore`` conta i valori non mappati, così invece di una riga di
+log per record si stampa un riepilogo a fine elaborazione.
+
+Usage
+-----
+python normalizzazione.py mappa <dimensione> <valore>...
+python normalizzazione.py bench [--n 100000]
+"""
+from __future__ import annotations
+
+import argparse
+import timeit
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Optional
+
+from run_trace import TRACER
+
+CACHE_SIZE = 4096           # Stringhe distinte memorizzate per dimensione
+
+# Sinonimi (minuscolo) → codice della tabella di lookup, in ordine di priorità
+NATURA = {
+    "lavori": "works",
+    "work": "works",
+    "works": "works",
+    "forniture": "goods",
+    "fornitura": "goods",
+    "good": "goods",
+    "goods": "goods",
+    "servizi": "services",
+    "servizio": "services",
+    "service": "services",
+    "services": "services",
+}
+
+CRITERIO = {
+    "prezzo": "price",
+    "price": "price",
+    "ribasso": "price",
+    "qualità": "quality",
+    "qualita": "quality",
+    "quality": "quality",
+    "costo": "quality",
+    "cost": "quality",
+    "economicamente vantaggiosa": "quality",  # Spesso si riferisce a qualità-prezzo
+    "offerta economicamente vantaggiosa": "quality",
+}
+
+STATO = {
+    "programmazione": "planning",
+    "planning": "planning",
+    "attivo": "active",
+    "in corso": "active",
+    "active": "active",
+    "pubblicata": "active",
+    "pubblicato": "active",
+    "concluso": "complete",
+    "conclusa": "complete",
+    "complete": "complete",
+    "aggiudicata": "complete",
+    "aggiudicato": "complete",
+    "annullato": "cancelled",
+    "annullata": "cancelled",
+    "cancelled": "cancelled",
+    "senza esito": "unsuccessful",
+    "unsuccessful": "unsuccessful",
+}
+
+TIPO_PROCEDURA = {
+    "aperta": "open",
+    "open": "open",
+    "ristretta": "restricted",
+    "restricted": "restricted",
+    "negoziata": "negotiated",
+    "negotiated": "negotiated",
+    "competitiva": "competitive_dialogue",
+    "competitive": "competitive_dialogue",
+    "dialogo": "competitive_dialogue",
+    "dialogue": "competitive_dialogue",
+    "competitive_dialogue": "competitive_dialogue",
+    "diretto": "direct",
+    "direct": "direct",
+    "affidamento": "direct",
+    "affidamento diretto": "direct",
+}
+
+
+@dataclass(frozen=True, slots=True)
+class Mappatura:
+    """Esito della normalizzazione di un valore.
+
+    ``codice`` è il codice di lookup (o il default della dimensione se il
+    valore non è mappato); ``esatta`` indica un sinonimo uguale al valore,
+    ``trovata`` un sinonimo uguale o contenuto.
+    """
+    codice: Optional[str]
+    esatta: bool = False
+    trovata: bool = False
+
+
+class Regole:
+    """Tabella di sinonimi compilata per una dimensione."""
+
+    def __init__(self, nome: str, sinonimi: Dict[str, str], default: Optional[str] = None):
+        self.nome = nome
+        self.default = default
+        self._esatte = dict(sinonimi)
+        self._parziali = tuple(sinonimi.items())
+        self.mappa = lru_cache(maxsize=CACHE_SIZE)(self._mappa)
+
+    def _mappa(self, valore: str) -> Mappatura:
+        testo = valore.strip().lower()
+        codice = self._esatte.get(testo)
+        if codice is not None:
+            return Mappatura(codice, esatta=True, trovata=True)
+        for chiave, codice in self._parziali:
+            if chiave in testo:
+                return Mappatura(codice, trovata=True)
+        return Mappatura(self.default)
+
+
+REGOLE: Dict[str, Regole] = {
+    "natura": Regole("natura", NATURA),
+    "criterio": Regole("criterio", CRITERIO),
+    "stato": Regole("stato", STATO, default="active"),
+    "tipo_procedura": Regole("tipo_procedura", TIPO_PROCEDURA, default="open"),
+}
+
+
+class Normalizzatore:
+    """Normalizza i valori di un'elaborazione e raccoglie quelli non mappati."""
+
+    def __init__(self):
+        self.non_mappati: Dict[str, Counter] = {nome: Counter() for nome in REGOLE}
+
+    def mappa(self, dimensione: str, valore: Optional[str]) -> Optional[Mappatura]:
+        """``None`` se il valore manca, altrimenti l'esito (memorizzato)."""
+        if not valore:
+            return None
+        esito = REGOLE[dimensione].mappa(valore)
+        if not esito.trovata:
+            self.non_mappati[dimensione][valore.strip()] += 1
+        return esito
+
+    def id(self, dimensione: str, valore: Optional[str], lookup: Dict[str, int]) -> Optional[int]:
+        """ID della tabella di lookup per ``valore`` (``None`` se non mappato
+        e senza default)."""
+        esito = self.mappa(dimensione, valore)
+        if esito is None or esito.codice is None:
+            return None
+        return lookup.get(esito.codice)
+
+    def riepilogo(self) -> None:
+        """Stampa i valori non mappati, raggruppati per dimensione."""
+        for nome, contatore in self.non_mappati.items():
+            if not contatore:
+                continue
+            TRACER.count(f"non_mappati.{nome}", sum(contatore.values()))
+            default = REGOLE[nome].default
+            suffisso = f", usato '{default}'" if default else ""
+            valori = ", ".join(f"'{v}' ×{n}" for v, n in contatore.most_common(10))
+            altri = len(contatore) - 10
+            if altri > 0:
+                valori += f" e altri {altri}"
+            print(f"  ⚠️ {nome} non mappato in {sum(contatore.values())} record{suffisso}: {valori}")
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+# Valori tipici di ANAC / Pubblicità Legale per il micro-benchmark
+CAMPIONE = {
+    "natura": ["LAVORI", "Forniture", "SERVIZI", "Servizi di ingegneria e architettura",
+               "Fornitura di beni", "Lavori pubblici", "ALTRO"],
+    "criterio": ["Offerta economicamente vantaggiosa", "Minor prezzo", "PREZZO PIU' BASSO",
+                 "Massimo ribasso", "Costo fisso", "Altro criterio"],
+    "stato": ["ATTIVO", "PUBBLICATA", "AGGIUDICATA", "Annullata", "SENZA ESITO", "IN ESECUZIONE"],
+    "tipo_procedura": ["PROCEDURA APERTA", "AFFIDAMENTO DIRETTO", "PROCEDURA NEGOZIATA SENZA PREVIA PUBBLICAZIONE",
+                       "Procedura ristretta", "DIALOGO COMPETITIVO", "PROCEDURA SELETTIVA EX ART 238",
+                       "AFFIDAMENTO DIRETTO IN ADESIONE AD ACCORDO QUADRO/CONVENZIONE"],
+}
+
+
+def _scansione_lineare(sinonimi: Dict[str, str], valore: str) -> Optional[str]:
+    """Vecchio algoritmo: dizionario ricostruito e scansione delle chiavi."""
+    tabella = dict(sinonimi)
+    testo = valore.lower()
+    if testo in tabella:
+        return tabella[testo]
+    for chiave, codice in tabella.items():
+        if chiave in testo:
+            return codice
+    return None
+
+
+def _bench(n: int) -> None:
+    tabelle = {"natura": NATURA, "criterio": CRITERIO, "stato": STATO, "tipo_procedura": TIPO_PROCEDURA}
+    record = [(nome, valore) for nome, valori in CAMPIONE.items() for valore in valori]
+    giri = max(1, n // len(record))
+
+    # Le due versioni devono dare lo stesso codice (a parte i default)
+    for nome, valore in record:
+        atteso = _scansione_lineare(tabelle[nome], valore) or REGOLE[nome].default
+        ottenuto = REGOLE[nome].mappa(valore).codice
+        if atteso != ottenuto:
+            raise AssertionError(f"{nome} '{valore}': {atteso} != {ottenuto}")
+
+    def vecchio() -> None:
+        for nome, valore in record:
+            _scansione_lineare(tabelle[nome], valore)
+
+    norm = Normalizzatore()
+
+    def memorizzato() -> None:
+        for nome, valore in record:
+            norm.mappa(nome, valore)
+
+    totale = giri * len(record)
+    print(f"{totale} valori ({len(record)} distinti)")
+    for etichetta, funzione in (("scansione lineare", vecchio),
+                                ("tabelle + cache", memorizzato)):
+        secondi = timeit.timeit(funzione, number=giri)
+        print(f"  {etichetta:<18} {secondi * 1e9 / totale:8.0f} ns/valore")
+    info = REGOLE["tipo_procedura"].mappa.cache_info()
+    print(f"  cache tipo_procedura: {info.hits} hit, {info.misses} miss")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Normalizzazione dei valori di lookup")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_mappa = sub.add_parser("mappa", help="Mostra il codice di uno o più valori")
+    p_mappa.add_argument("dimensione", choices=sorted(REGOLE))
+    p_mappa.add_argument("valori", nargs="+")
+    p_bench = sub.add_parser("bench", help="Micro-benchmark contro la scansione lineare")
+    p_bench.add_argument("--n", type=int, default=100_000, help="Valori da normalizzare")
+    args = parser.parse_args()
+
+    if args.cmd == "mappa":
+        for valore in args.valori:
+            esito = REGOLE[args.dimensione].mappa(valore)
+            tipo = "esatta" if esito.esatta else "parziale" if esito.trovata else "default"
+            print(f"{valore!r} → {esito.codice} ({tipo})")
+    elif args.cmd == "bench":
+        _bench(args.n)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+pg_loader.py
+============
+
+Backend di scrittura diretto su PostgreSQL per i backfill grandi.
+
+``PgUpserter`` ha la stessa interfaccia di ``supabase_batch.BatchUpserter``
+(``add`` / ``flush`` → ``UpsertResult``), quindi le funzioni di upload della
+pipeline producono le stesse righe con entrambi i backend. Invece di inviare
+JSON a PostgREST, ogni ``flush`` carica le righe con ``COPY`` in una tabella
+temporanea di staging e le applica con un unico
+``INSERT ... SELECT ... ON CONFLICT DO UPDATE``: gli id restituiti vengono
+associati alla chiave naturale come nel backend PostgREST.
+
+Tutti i flush di una connessione stanno in una sola transazione, confermata
+all'uscita dal context manager (``with PgUpserter.connect(dsn) as writer``).
+Con ``transaction=False`` ogni blocco COPY è invece una transazione breve,
+confermata subito: serve per le righe condivise fra giorni elaborati in
+parallelo (enti, CPV), che nella transazione del giorno resterebbero
+bloccate fino al suo commit e farebbero attendere, o andare in deadlock, gli
+upsert degli altri giorni. Le righe di ogni blocco vengono scritte in ordine
+di chiave di conflitto, così due blocchi concorrenti prendono i lock nello
+stesso ordine.
+Ogni blocco COPY ha un proprio savepoint: se fallisce viene annullato e
+ritentato diviso a metà come nel backend PostgREST, quindi una riga non
+valida finisce in ``UpsertResult.failed`` senza far perdere le altre.
+
+Con un ``change_index.ChangeIndex`` gli hash delle righe scritte vengono
+registrati solo dopo il commit della transazione.
+
+La connection string è quella "direct connection" di Supabase (oppure di un
+Postgres locale con lo stesso schema, per le prove):
+
+    export SUPABASE_DB_URL=postgresql://postgres:<password>@db.<ref>.supabase.co:5432/postgres
+
+Richiede ``pip install "psycopg[binary]"``; senza il pacchetto il backend
+non è disponibile e la pipeline resta su PostgREST.
+"""
+from __future__ import annotations
+
+import os
+from contextlib import contextmanager
+from typing import Any, Hashable, Iterator, List, Optional, Tuple
+
+from change_index import ChangeIndex
+from supabase_batch import BatchUpserter, TableBuffer
+
+try:
+    import psycopg
+    from psycopg import sql
+    from psycopg.types.json import Jsonb
+except ImportError:  # backend opzionale
+    psycopg = None
+
+DB_URL_ENV = "SUPABASE_DB_URL"
+COPY_CHUNK = 50000          # Righe per COPY (una tabella di staging ciascuna)
+
+
+def default_dsn() -> Optional[str]:
+    return os.getenv(DB_URL_ENV)
+
+
+def _copy_value(value: Any) -> Any:
+    """Valori annidati (dict/list) come jsonb; il resto passa a COPY così
+    com'è e viene convertito dal server nel tipo della colonna, come fa
+    PostgREST con il JSON."""
+    if isinstance(value, (dict, list)):
+        return Jsonb(value)
+    return value
+
+
+class PgUpserter(BatchUpserter):
+    """Upsert COPY + ``INSERT ... ON CONFLICT`` su una connessione psycopg."""
+
+    def __init__(self, conn, chunk_size: int = COPY_CHUNK, index: Optional[ChangeIndex] = None,
+                 transaction: bool = True):
+        super().__init__(client=None, chunk_size=chunk_size, index=index)
+        self.conn = conn
+        self.transaction = transaction
+        self._staged = 0
+        self._uncommitted: List[Tuple[str, List[Tuple[Hashable, str, Any]]]] = []
+
+    @classmethod
+    @contextmanager
+    def connect(cls, dsn: Optional[str] = None, index: Optional[ChangeIndex] = None,
+                transaction: bool = True) -> Iterator["PgUpserter"]:
+        """Apre la connessione e una transazione: commit all'uscita,
+        rollback se il blocco solleva un'eccezione. Con ``transaction=False``
+        ogni blocco COPY viene confermato da sé."""
+        if psycopg is None:
+            raise RuntimeError("backend pg non disponibile: installa 'psycopg[binary]'")
+        dsn = dsn or default_dsn()
+        if not dsn:
+            raise RuntimeError(f"connection string mancante: imposta {DB_URL_ENV} o --db-url")
+        # Transazione esterna esplicita: i blocchi ``transaction()`` di
+        # ``_send`` diventano savepoint (senza, ciascuno fa commit da sé)
+        with psycopg.connect(dsn, autocommit=True) as conn:
+            writer = cls(conn, index=index, transaction=transaction)
+            if not transaction:
+                yield writer
+                return
+            with conn.transaction():
+                yield writer
+        # Uscito dal blocco senza eccezioni: la transazione è confermata
+        for table, entries in writer._uncommitted:
+            index.record(table, entries)
+
+    def _index_written(self, table: str, entries: List[Tuple[Hashable, str, Any]]) -> None:
+        if not self.transaction:
+            super()._index_written(table, entries)    # blocco già confermato
+            return
+        self._uncommitted.append((table, entries))
+
+    def _send(self, table: str, rows: List[dict], buf: TableBuffer,
+              returning: bool) -> List[dict]:
+        # Colonne nell'ordine di prima apparizione; le assenti valgono NULL
+        columns: List[str] = list(dict.fromkeys(c for row in rows for c in row))
+        conflict = [c.strip() for c in buf.on_conflict.split(",")]
+        updates = [c for c in columns if c not in conflict]
+        # Lock sulle righe esistenti sempre nello stesso ordine (niente
+        # deadlock fra blocchi concorrenti sulle stesse chiavi)
+        rows = sorted(rows, key=lambda row: tuple(
+            (row.get(c) is None, str(row.get(c))) for c in conflict))
+        self._staged += 1
+        staging = sql.Identifier(f"_stg_{table}_{self._staged}")
+        target = sql.Identifier(table)
+        cols = sql.SQL(", ").join(map(sql.Identifier, columns))
+
+        if updates:
+            on_conflict = sql.SQL("DO UPDATE SET {}").format(sql.SQL(", ").join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c)) for c in updates
+            ))
+        else:
+            on_conflict = sql.SQL("DO NOTHING")
+        upsert = sql.SQL(
+            "INSERT INTO {target} ({cols}) SELECT {cols} FROM {staging} "
+            "ORDER BY {conflict} ON CONFLICT ({conflict}) {on_conflict}"
+        ).format(
+            target=target, cols=cols, staging=staging,
+            conflict=sql.SQL(", ").join(map(sql.Identifier, conflict)),
+            on_conflict=on_conflict,
+        )
+        returned = list(dict.fromkeys(["id", *buf.key_columns]))
+        if returning:
+            upsert = sql.SQL("{} RETURNING {}").format(
+                upsert, sql.SQL(", ").join(map(sql.Identifier, returned))
+            )
+
+        # Savepoint: se il blocco fallisce la transazione resta utilizzabile
+        # e BatchUpserter lo ritenta diviso a metà
+        with self.conn.transaction():
+            with self.conn.cursor() as cur:
+                # Staging con i tipi della tabella ma senza vincoli né default
+                cur.execute(sql.SQL(
+                    "CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                    "SELECT {cols} FROM {target} WITH NO DATA"
+                ).format(staging=staging, cols=cols, target=target))
+                with cur.copy(sql.SQL("COPY {} ({}) FROM STDIN").format(staging, cols)) as copy:
+                    for row in rows:
+                        copy.write_row([_copy_value(row.get(c)) for c in columns])
+                cur.execute(upsert)
+                if not returning:
+                    return []
+                return [dict(zip(returned, values)) for values in cur.fetchall()]
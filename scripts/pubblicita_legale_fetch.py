@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+pubblicita_legale_fetch.py
+==========================
+
+Download delle pagine dell'API avvisi di Pubblicità Legale (struttura
+Spring-Page: ``content``, ``totalElements``, ``last``).
+
+La prima pagina dice quanti elementi ci sono: le pagine successive sono note
+in anticipo e vengono scaricate in parallelo, con un token bucket che limita
+le richieste al secondo. Ogni pagina ha i propri retry; quelle ancora mancanti
+alla fine vengono ritentate una per una prima di arrendersi. Se qualche
+pagina non arriva viene sollevata ``IncompleteDownloadError``: il risultato
+non è mai troncato in silenzio.
+
+Le richieste passano da ``http_archive`` (``--record`` / ``--replay`` delle
+pipeline): in replay le pagine arrivano dall'archivio, senza rate limit, e
+una pagina non archiviata non viene ritentata.
+"""
+from __future__ import annotations
+
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+import http_archive
+from http_archive import ReplayMiss
+from run_trace import TRACER, warning
+
+PAGE_WORKERS = 4            # Pagine scaricate in parallelo
+PAGE_RATE = 4.0             # Richieste al secondo (media)
+PAGE_BURST = 4              # Richieste consentite in raffica
+PAGE_RETRIES = 3            # Tentativi per pagina
+PAGE_TIMEOUT = 30           # Timeout richiesta (s)
+
+
+class IncompleteDownloadError(RuntimeError):
+    """Alcune pagine non sono state scaricate nemmeno dopo i retry."""
+
+    def __init__(self, missing_pages: List[int], items: List[Dict]):
+        self.missing_pages = missing_pages
+        self.items = items
+        super().__init__(
+            f"{len(missing_pages)} pagine non scaricate: "
+            f"{', '.join(str(p + 1) for p in missing_pages)}"
+        )
+
+
+class TokenBucket:
+    """Rate limiter thread-safe: ``rate`` gettoni al secondo, al massimo
+    ``burst`` accumulabili. ``acquire`` blocca finché un gettone è libero."""
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[int] = None):
+        # Default letti alla creazione: si possono cambiare a runtime (benchmark)
+        self.rate = rate or PAGE_RATE
+        self.capacity = max(1, burst or PAGE_BURST)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_thread_local = threading.local()
+
+
+def _http_session() -> requests.Session:
+    """Sessione requests per thread (keep-alive), con l'archivio HTTP montato."""
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = _thread_local.http = http_archive.mount(requests.Session())
+    return http
+
+
+def _get_page(url: str, params: Dict[str, Any], headers: Dict[str, str],
+              page: int, bucket: Optional[TokenBucket], retries: int,
+              timeout: int) -> Optional[Dict]:
+    """Scarica una pagina con retry e backoff; ``None`` se non ci riesce."""
+    for attempt in range(retries):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            # Errori e latenze di ogni richiesta finiscono nel report del run
+            with TRACER.span("avvisi.pagina"):
+                r = _http_session().get(url, headers=headers,
+                                        params={**params, "page": page}, timeout=timeout)
+                r.raise_for_status()
+                return r.json()
+        except ReplayMiss as exc:
+            warning("⚠️  pagina %d assente dall'archivio HTTP: %s", page + 1, exc)
+            return None
+        except Exception as exc:
+            warning("⚠️  errore HTTP/API pagina %d (tentativo %d/%d): %s",
+                    page + 1, attempt + 1, retries, exc)
+            if attempt < retries - 1:
+                time.sleep(2 ** attempt)
+    return None
+
+
+def fetch_pages(url: str,
+                params: Dict[str, Any],
+                headers: Dict[str, str],
+                page_size: int,
+                max_items: Optional[int] = None,
+                workers: int = PAGE_WORKERS,
+                bucket: Optional[TokenBucket] = None,
+                retries: int = PAGE_RETRIES,
+                timeout: int = PAGE_TIMEOUT,
+                on_page: Optional[Callable[[int, int, int], None]] = None,
+                transform: Optional[Callable[[Dict], Any]] = None) -> List[Any]:
+    """Scarica tutte le pagine di una ricerca e restituisce gli elementi in
+    ordine di pagina.
+
+    ``on_page(page, total_pages, n_items)`` viene chiamata per ogni pagina
+    arrivata. Con ``max_items`` si scaricano solo le pagine necessarie e il
+    risultato viene troncato a quel numero di elementi. ``transform`` viene
+    applicata a ogni elemento appena arriva la sua pagina, così il JSON
+    completo della pagina non resta in memoria fino alla fine.
+    """
+    if bucket is None and not http_archive.replaying():
+        bucket = TokenBucket()
+    params = {**params, "size": page_size}
+
+    first = _get_page(url, params, headers, 0, bucket, retries, timeout)
+    if first is None:
+        raise IncompleteDownloadError([0], [])
+
+    total = first.get("totalElements") or 0
+    if max_items is not None:
+        total = min(total, max_items)
+    total_pages = max(1, math.ceil(total / page_size)) if total else 1
+    if first.get("last", True):
+        total_pages = 1
+
+    def _content(payload: Dict) -> List[Any]:
+        content = payload.get("content", [])
+        return [transform(item) for item in content] if transform else content
+
+    pages: Dict[int, List[Any]] = {0: _content(first)}
+    if on_page:
+        on_page(0, total_pages, len(pages[0]))
+
+    def _download(page: int) -> None:
+        payload = _get_page(url, params, headers, page, bucket, retries, timeout)
+        if payload is not None:
+            pages[page] = _content(payload)
+            if on_page:
+                on_page(page, total_pages, len(pages[page]))
+
+    remaining = list(range(1, total_pages))
+    if remaining:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(_download, remaining))
+
+    # Ripresa: le pagine fallite vengono ritentate una alla volta
+    missing = [p for p in remaining if p not in pages]
+    if missing and not http_archive.replaying():
+        print(f"↻  ripresa di {len(missing)} pagine non scaricate")
+        for page in missing:
+            time.sleep(2 ** retries)
+            _download(page)
+
+    items: List[Any] = []
+    for page in sorted(pages):
+        items.extend(pages[page])
+    if max_items is not None:
+        items = items[:max_items]
+
+    missing = [p for p in range(total_pages) if p not in pages]
+    if missing:
+        raise IncompleteDownloadError(missing, items)
+    if len(items) != total:
+        # Il totale può cambiare se ANAC pubblica durante il download
+        print(f"⚠️  attesi {total} elementi, ricevuti {len(items)}")
+    return items
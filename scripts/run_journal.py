@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+run_journal.py
+==============
+
+Giornale append-only delle unità di lavoro completate da un run, per
+riprendere con ``--resume`` un run interrotto (crash, Ctrl-C, macchina
+spenta) senza rifare ciò che era già finito.
+
+Ogni riga è un oggetto JSON ``{"unita", "giorno", "chiave", "ts"}``. Le unità
+usate dalle pipeline sono:
+
+* ``cig``: dettaglio Superset consegnato e salvato in ``CigStore`` (i CIG
+  falliti o rinviati dalla cache negativa non vengono registrati);
+* ``avviso``: riga ``avviso_gara`` scritta insieme alla sua gara;
+* ``aggiudicatari``: aggiudicatari di un CIG scritti, per giorno di esito;
+* ``giorno``: giorno completato senza errori.
+
+Un'unità viene registrata solo quando il suo effetto è già persistente (con
+``--loader pg`` dopo il commit): il giornale può restare indietro rispetto al
+database ma mai andare avanti, quindi dopo un'interruzione al più qualche
+unità viene rifatta. Ogni ``record`` arriva al sistema operativo con una
+sola ``write`` e sopravvive alla morte del processo; ``fsync`` viene fatto al
+più ogni ``FSYNC_INTERVAL`` secondi e alla chiusura. Un'ultima riga troncata
+da un crash viene ignorata.
+
+Senza ``resume`` il giornale viene ricominciato da zero: il file è per
+intervallo di date (vedi ``journal_path``), quindi si riprende rilanciando
+lo stesso comando con ``--resume``.
+
+Usage
+-----
+python run_journal.py stats <giornale.ndjson>
+"""
+from __future__ import annotations
+
+import argparse
+import datetime as dt
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Set, Tuple
+
+FSYNC_INTERVAL = 1.0        # Secondi massimi fra due fsync del giornale
+
+
+def journal_path(directory: Path, nome: str, primo: str, ultimo: str) -> Path:
+    """Giornale di un run su ``primo``..``ultimo`` (YYYY-MM-DD)."""
+    span = primo if primo == ultimo else f"{primo}_{ultimo}"
+    return Path(directory) / f"journal_{nome}_{span}.ndjson"
+
+
+def _read_entries(path: Path) -> Iterator[Tuple[str, str, str]]:
+    """(unità, giorno, chiave) delle righe valide; le righe illeggibili
+    (tipicamente l'ultima, troncata da un crash) vengono saltate."""
+    with open(path, "rb") as fh:
+        for raw in fh:
+            try:
+                entry = json.loads(raw)
+                yield entry["unita"], entry.get("giorno") or "", entry["chiave"]
+            except (ValueError, KeyError, TypeError):
+                continue
+
+
+class RunJournal:
+    """Unità completate di un run, thread-safe."""
+
+    def __init__(self, path: Path, resume: bool = False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._done: Dict[Tuple[str, str], Set[str]] = {}
+        self._last_sync = time.monotonic()
+        if resume and self.path.exists():
+            for unita, giorno, chiave in _read_entries(self.path):
+                self._done.setdefault((unita, giorno), set()).add(chiave)
+            n = sum(len(keys) for keys in self._done.values())
+            print(f"↺  Ripresa dal giornale {self.path}: {n} unità già completate")
+        elif resume:
+            print(f"⚠️  Nessun giornale da riprendere in {self.path}: run completo")
+        self._fh = open(self.path, "ab" if resume else "wb")
+        if resume and self._fh.tell() > 0 and not self._ends_with_newline():
+            # Riga troncata da un crash: le nuove righe partono su una riga pulita
+            self._fh.write(b"\n")
+            self._fh.flush()
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as fh:
+            fh.seek(-1, os.SEEK_END)
+            return fh.read(1) == b"\n"
+
+    def done(self, unita: str, chiavi: Iterable[str], giorno: str = "") -> Set[str]:
+        """Le ``chiavi`` già registrate per (``unita``, ``giorno``)."""
+        with self._lock:
+            registrate = self._done.get((unita, giorno))
+            if not registrate:
+                return set()
+            return {chiave for chiave in chiavi if chiave in registrate}
+
+    def record(self, unita: str, chiavi: Iterable[str], giorno: str = "") -> None:
+        """Registra le unità completate (da chiamare dopo che sono persistenti)."""
+        now = round(time.time(), 3)
+        with self._lock:
+            registrate = self._done.setdefault((unita, giorno), set())
+            nuove = [chiave for chiave in dict.fromkeys(chiavi) if chiave not in registrate]
+            if not nuove:
+                return
+            self._fh.write(b"".join(
+                json.dumps({"unita": unita, "giorno": giorno, "chiave": chiave, "ts": now},
+                           ensure_ascii=False).encode("utf-8") + b"\n"
+                for chiave in nuove))
+            self._fh.flush()
+            registrate.update(nuove)
+            if time.monotonic() - self._last_sync >= FSYNC_INTERVAL:
+                os.fsync(self._fh.fileno())
+                self._last_sync = time.monotonic()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh.closed:
+                return
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._fh.close()
+
+    def __enter__(self) -> "RunJournal":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Giornale delle unità completate di un run")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_stats = sub.add_parser("stats", help="Unità registrate per tipo e giorno")
+    p_stats.add_argument("journal", type=Path)
+    args = parser.parse_args()
+
+    if args.cmd == "stats":
+        counts: Dict[Tuple[str, str], Set[str]] = {}
+        for unita, giorno, chiave in _read_entries(args.journal):
+            counts.setdefault((unita, giorno), set()).add(chiave)
+        for (unita, giorno), keys in sorted(counts.items()):
+            print(f"{unita:<16} {giorno or '-':<12} {len(keys):>8}")
+        print(f"{'totale':<29} {sum(len(k) for k in counts.values()):>8}")
+        mtime = dt.datetime.fromtimestamp(args.journal.stat().st_mtime)
+        print(f"ultima scrittura: {mtime:%Y-%m-%d %H:%M:%S}")
+
+
+if __name__ == "__main__":
+    main()
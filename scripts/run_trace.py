@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+run_trace.py
+============
+
+Strumentazione leggera dei run: span per fase, contatori, errori per tipo e
+log a livelli.
+
+``span("superset.cig")`` misura la durata di un blocco e, se il blocco
+solleva un'eccezione, la conta fra gli errori della fase con il nome della
+classe. Le misure vengono aggregate per nome (conteggio, totale, massimo e
+un campione limitato per i percentili), quindi il costo resta costante anche
+con milioni di span. Alla fine del run ``write_report`` salva un report JSON
+con latenze, contatori ed errori.
+
+``debug`` / ``info`` / ``warning`` stampano solo sopra il livello scelto
+(``--log-level`` o ``PIPELINE_LOG_LEVEL``); il messaggio viene formattato
+solo se stampato, quindi i log disattivati costano un confronto:
+
+    debug("[%s] tentativo %d", cig, attempt)
+
+Usage
+-----
+python run_trace.py <report.json>     # riepilogo leggibile di un report
+"""
+from __future__ import annotations
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_ENV = "PIPELINE_LOG_LEVEL"
+SAMPLE_CAP = 2000           # Durate conservate per span (campione per i percentili)
+
+_level = LEVELS.get(os.getenv(LEVEL_ENV, "info").lower(), INFO)
+
+
+# ---------------------------------------------------------------------------
+# LOG A LIVELLI
+# ---------------------------------------------------------------------------
+
+def set_level(name: str) -> None:
+    global _level
+    _level = LEVELS[name.lower()]
+
+
+def enabled(level: int) -> bool:
+    """Per saltare blocchi costosi che servono solo al log."""
+    return level >= _level
+
+
+def _emit(msg: str, args: tuple) -> None:
+    print(msg % args if args else msg)
+
+
+def debug(msg: str, *args: Any) -> None:
+    if _level <= DEBUG:
+        _emit(msg, args)
+
+
+def info(msg: str, *args: Any) -> None:
+    if _level <= INFO:
+        _emit(msg, args)
+
+
+def warning(msg: str, *args: Any) -> None:
+    if _level <= WARNING:
+        _emit(msg, args)
+
+
+# ---------------------------------------------------------------------------
+# SPAN E REPORT
+# ---------------------------------------------------------------------------
+
+@dataclass(slots=True)
+class SpanStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    samples: List[float] = field(default_factory=list)
+    errors: Counter = field(default_factory=Counter)
+
+    def add(self, elapsed: float, error: str = "") -> None:
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        if len(self.samples) < SAMPLE_CAP:
+            self.samples.append(elapsed)
+        else:
+            # Reservoir sampling: il campione resta uniforme su tutto il run
+            i = random.randrange(self.count)
+            if i < SAMPLE_CAP:
+                self.samples[i] = elapsed
+        if error:
+            self.errors[error] += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        ordered = sorted(self.samples)
+
+        def pct(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+        return {
+            "count": self.count,
+            "total_s": round(self.total, 3),
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": pct(0.50) if ordered else 0.0,
+            "p95_ms": pct(0.95) if ordered else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+            "errors": dict(self.errors),
+        }
+
+
+class Tracer:
+    """Aggregatore thread-safe di span, contatori ed errori di un run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started_at = time.time()
+            self._t0 = time.perf_counter()
+            self.spans: Dict[str, SpanStats] = {}
+            self.counters: Counter = Counter()
+            self.errors: Dict[str, Counter] = {}
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        except BaseException as exc:
+            self.record(name, time.perf_counter() - t0, type(exc).__name__)
+            raise
+        self.record(name, time.perf_counter() - t0)
+
+    def record(self, name: str, elapsed: float, error: str = "") -> None:
+        with self._lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = SpanStats()
+            stats.add(elapsed, error)
+
+    def count(self, name: str, n: int = 1) -> None:
+        if n:
+            with self._lock:
+                self.counters[name] += n
+
+    def error(self, stage: str, kind: str, n: int = 1) -> None:
+        """Errore gestito (senza eccezione propagata) di una fase."""
+        with self._lock:
+            self.errors.setdefault(stage, Counter())[kind] += n
+
+    def snapshot(self, **meta: Any) -> Dict[str, Any]:
+        with self._lock:
+            errors: Dict[str, Dict[str, int]] = {k: dict(v) for k, v in self.errors.items()}
+            for name, stats in self.spans.items():
+                for kind, n in stats.errors.items():
+                    errors.setdefault(name, {})
+                    errors[name][kind] = errors[name].get(kind, 0) + n
+            return {
+                **meta,
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+                "duration_s": round(time.perf_counter() - self._t0, 3),
+                "spans": {name: s.to_dict() for name, s in sorted(self.spans.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "errors": errors,
+            }
+
+    def write_report(self, path: Path, **meta: Any) -> Dict[str, Any]:
+        report = self.snapshot(**meta)
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".part")
+        tmp.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+        return report
+
+
+TRACER = Tracer()
+span = TRACER.span
+count = TRACER.count
+error = TRACER.error
+
+
+def print_summary(report: Dict[str, Any]) -> None:
+    """Tabella delle fasi ordinate per tempo totale."""
+    print(f"⏱  Run di {report['duration_s']:.1f}s (avviato {report['started_at']})")
+    spans = sorted(report["spans"].items(), key=lambda kv: kv[1]["total_s"], reverse=True)
+    for name, s in spans:
+        print(f"  {name:<28} {s['count']:>8} × {s['mean_ms']:>9.1f} ms "
+              f"(p95 {s['p95_ms']:.1f}, max {s['max_ms']:.1f}) = {s['total_s']:.1f}s")
+    if report["counters"]:
+        print("  " + ", ".join(f"{k} {v}" for k, v in report["counters"].items()))
+    for stage, kinds in report["errors"].items():
+        print(f"  ⚠️ {stage}: " + ", ".join(f"{k} ×{n}" for k, n in kinds.items()))
+
+
+def main() -> None:
+    if len(sys.argv) != 2:
+        print("Usage: python run_trace.py <report.json>")
+        sys.exit(1)
+    print_summary(json.loads(Path(sys.argv[1]).read_text(encoding="utf-8")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+-- Vincolo unico usato come target ON CONFLICT dall'upsert a blocchi degli
+-- aggiudicatari (aggiudicatari_updater.upsert_aggiudicatari).
+--
+-- Prima di creare il vincolo:
+--   * i codici fiscali vuoti diventano NULL (i soggetti senza CF non
+--     collidono fra loro: NULL è sempre distinto nei vincoli unici);
+--   * gli spazi ai margini vengono rimossi e le lettere portate in
+--     maiuscolo, come fa la pipeline (il vincolo distingue le maiuscole);
+--   * dei duplicati (stesso lotto e codice fiscale) resta la riga con la
+--     data di pubblicazione più recente.
+--
+-- Esecuzione: SQL editor di Supabase oppure
+--   psql "$DATABASE_URL" -f scripts/sql/aggiudicatario_unique.sql
+
+BEGIN;
+
+UPDATE aggiudicatario
+   SET codice_fiscale = NULLIF(upper(btrim(codice_fiscale)), '')
+ WHERE codice_fiscale IS NOT NULL
+   AND codice_fiscale IS DISTINCT FROM NULLIF(upper(btrim(codice_fiscale)), '');
+
+DELETE FROM aggiudicatario
+ WHERE ctid IN (
+    SELECT ctid
+      FROM (
+        SELECT ctid,
+               row_number() OVER (
+                   PARTITION BY lotto_id, codice_fiscale
+                   ORDER BY data_pubblicazione DESC NULLS LAST, ctid DESC
+               ) AS rn
+          FROM aggiudicatario
+         WHERE codice_fiscale IS NOT NULL
+      ) ranked
+     WHERE rn > 1
+ );
+
+ALTER TABLE aggiudicatario
+    ADD CONSTRAINT aggiudicatario_lotto_codice_fiscale_key
+    UNIQUE (lotto_id, codice_fiscale);
+
+COMMIT;
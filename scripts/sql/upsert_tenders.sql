@@ -0,0 +1,181 @@
+-- Scrittura di più gare in un'unica chiamata RPC (unified_data_pipelineGPT.py
+-- --loader rpc): gara, rup, pubblicazione, avviso_gara, lotto e
+-- lotto_categoria_opera vengono scritti in una sola transazione, con upsert
+-- set-based sulle stesse chiavi di conflitto del percorso PostgREST.
+--
+-- Ogni elemento di ``tenders`` è un documento:
+--   {
+--     "gara":          { cig, cup, ente_appaltante_id, ... },
+--     "rup":           { nome, cognome, email, telefono } | null,
+--     "pubblicazione": { data_creazione, data_pubblicazione, ... } | null,
+--     "avvisi":        [ { id, id_appalto, codice_scheda, ... } ],
+--     "lotto":         { cig, descrizione, valore, ... },
+--     "categorie":     [ { categoria_opera_id, ruolo } ]
+--   }
+-- gara_id e lotto_id vengono risolti qui: il client non li conosce.
+-- Restituisce [{ "cig", "gara_id", "lotto_id" }] per le gare scritte.
+--
+-- Se un documento non è valido l'intera chiamata viene annullata; il client
+-- (supabase_batch.rpc_batched) divide il blocco a metà e riprova.
+--
+-- Installazione: SQL editor di Supabase oppure
+--   psql "$SUPABASE_DB_URL" -f scripts/sql/upsert_tenders.sql
+
+CREATE OR REPLACE FUNCTION public.upsert_tenders(tenders jsonb)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    written jsonb;
+BEGIN
+    IF jsonb_typeof(tenders) = 'object' THEN
+        tenders := jsonb_build_array(tenders);
+    END IF;
+
+    DROP TABLE IF EXISTS pg_temp._tender_doc;
+    CREATE TEMP TABLE _tender_doc ON COMMIT DROP AS
+        SELECT t.ord, t.doc, t.doc -> 'gara' ->> 'cig' AS cig
+          FROM jsonb_array_elements(tenders) WITH ORDINALITY AS t(doc, ord)
+         WHERE t.doc -> 'gara' ->> 'cig' IS NOT NULL;
+
+    DROP TABLE IF EXISTS pg_temp._tender_ids;
+    CREATE TEMP TABLE _tender_ids ON COMMIT DROP AS
+        SELECT g.cig, g.id AS gara_id, l.id AS lotto_id
+          FROM gara g CROSS JOIN lotto l
+          WITH NO DATA;
+
+    -- GARA (l'ultimo documento per CIG vince, come nel buffer del client)
+    WITH src AS (
+        SELECT DISTINCT ON (d.cig) r.*
+          FROM _tender_doc d,
+               jsonb_populate_record(NULL::gara, d.doc -> 'gara') AS r
+         ORDER BY d.cig, d.ord DESC
+    ), up AS (
+        INSERT INTO gara (cig, cup, ente_appaltante_id, descrizione, data_pubblicazione,
+                          scadenza_offerta, importo_totale, importo_sicurezza, valuta,
+                          natura_principale_id, criterio_aggiudicazione_id,
+                          stato_procedura_id, tipo_procedura_id, documenti_di_gara_link)
+        SELECT cig, cup, ente_appaltante_id, descrizione, data_pubblicazione,
+               scadenza_offerta, importo_totale, importo_sicurezza, valuta,
+               natura_principale_id, criterio_aggiudicazione_id,
+               stato_procedura_id, tipo_procedura_id, documenti_di_gara_link
+          FROM src
+        ON CONFLICT (cig) DO UPDATE SET
+            cup = EXCLUDED.cup,
+            ente_appaltante_id = EXCLUDED.ente_appaltante_id,
+            descrizione = EXCLUDED.descrizione,
+            data_pubblicazione = EXCLUDED.data_pubblicazione,
+            scadenza_offerta = EXCLUDED.scadenza_offerta,
+            importo_totale = EXCLUDED.importo_totale,
+            importo_sicurezza = EXCLUDED.importo_sicurezza,
+            valuta = EXCLUDED.valuta,
+            natura_principale_id = EXCLUDED.natura_principale_id,
+            criterio_aggiudicazione_id = EXCLUDED.criterio_aggiudicazione_id,
+            stato_procedura_id = EXCLUDED.stato_procedura_id,
+            tipo_procedura_id = EXCLUDED.tipo_procedura_id,
+            documenti_di_gara_link = EXCLUDED.documenti_di_gara_link
+        RETURNING id, cig
+    )
+    INSERT INTO _tender_ids (cig, gara_id) SELECT cig, id FROM up;
+
+    -- RUP
+    INSERT INTO rup (gara_id, nome, cognome, email, telefono)
+    SELECT DISTINCT ON (i.gara_id) i.gara_id, r.nome, r.cognome, r.email, r.telefono
+      FROM _tender_doc d
+      JOIN _tender_ids i USING (cig),
+           jsonb_populate_record(NULL::rup, d.doc -> 'rup') AS r
+     WHERE jsonb_typeof(d.doc -> 'rup') = 'object'
+     ORDER BY i.gara_id, d.ord DESC
+    ON CONFLICT (gara_id) DO UPDATE SET
+        nome = EXCLUDED.nome,
+        cognome = EXCLUDED.cognome,
+        email = EXCLUDED.email,
+        telefono = EXCLUDED.telefono;
+
+    -- PUBBLICAZIONE
+    INSERT INTO pubblicazione (gara_id, data_creazione, data_pubblicazione, data_guri,
+                               link_sito_committente, scadenza_invito)
+    SELECT DISTINCT ON (i.gara_id) i.gara_id, p.data_creazione, p.data_pubblicazione,
+           p.data_guri, p.link_sito_committente, p.scadenza_invito
+      FROM _tender_doc d
+      JOIN _tender_ids i USING (cig),
+           jsonb_populate_record(NULL::pubblicazione, d.doc -> 'pubblicazione') AS p
+     WHERE jsonb_typeof(d.doc -> 'pubblicazione') = 'object'
+     ORDER BY i.gara_id, d.ord DESC
+    ON CONFLICT (gara_id) DO UPDATE SET
+        data_creazione = EXCLUDED.data_creazione,
+        data_pubblicazione = EXCLUDED.data_pubblicazione,
+        data_guri = EXCLUDED.data_guri,
+        link_sito_committente = EXCLUDED.link_sito_committente,
+        scadenza_invito = EXCLUDED.scadenza_invito;
+
+    -- AVVISI
+    INSERT INTO avviso_gara (id, gara_id, id_appalto, codice_scheda, data_pubblicazione,
+                             data_scadenza, data_pcp, attivo)
+    SELECT DISTINCT ON (a.id) a.id, i.gara_id, a.id_appalto, a.codice_scheda,
+           a.data_pubblicazione, a.data_scadenza, a.data_pcp, a.attivo
+      FROM _tender_doc d
+      JOIN _tender_ids i USING (cig),
+           jsonb_array_elements(COALESCE(d.doc -> 'avvisi', '[]')) WITH ORDINALITY AS e(avviso, n),
+           jsonb_populate_record(NULL::avviso_gara, e.avviso) AS a
+     WHERE a.id IS NOT NULL
+     ORDER BY a.id, d.ord DESC, e.n DESC
+    ON CONFLICT (id) DO UPDATE SET
+        gara_id = EXCLUDED.gara_id,
+        id_appalto = EXCLUDED.id_appalto,
+        codice_scheda = EXCLUDED.codice_scheda,
+        data_pubblicazione = EXCLUDED.data_pubblicazione,
+        data_scadenza = EXCLUDED.data_scadenza,
+        data_pcp = EXCLUDED.data_pcp,
+        attivo = EXCLUDED.attivo;
+
+    -- LOTTO
+    WITH src AS (
+        SELECT DISTINCT ON (d.cig) i.gara_id, d.cig, l.descrizione, l.valore, l.valuta,
+               l.termine_ricezione, l.luogo_istat, l.cpv_id
+          FROM _tender_doc d
+          JOIN _tender_ids i USING (cig),
+               jsonb_populate_record(NULL::lotto, d.doc -> 'lotto') AS l
+         WHERE jsonb_typeof(d.doc -> 'lotto') = 'object'
+         ORDER BY d.cig, d.ord DESC
+    ), up AS (
+        INSERT INTO lotto (gara_id, cig, descrizione, valore, valuta, termine_ricezione,
+                           luogo_istat, cpv_id)
+        SELECT src.gara_id, src.cig, src.descrizione, src.valore, src.valuta,
+               src.termine_ricezione, src.luogo_istat, src.cpv_id
+          FROM src
+        ON CONFLICT (cig) DO UPDATE SET
+            gara_id = EXCLUDED.gara_id,
+            descrizione = EXCLUDED.descrizione,
+            valore = EXCLUDED.valore,
+            valuta = EXCLUDED.valuta,
+            termine_ricezione = EXCLUDED.termine_ricezione,
+            luogo_istat = EXCLUDED.luogo_istat,
+            cpv_id = EXCLUDED.cpv_id
+        RETURNING id, cig
+    )
+    UPDATE _tender_ids i SET lotto_id = up.id FROM up WHERE i.cig = up.cig;
+
+    -- LOTTO ⇄ CATEGORIE OPERA
+    INSERT INTO lotto_categoria_opera (lotto_id, categoria_opera_id, ruolo)
+    SELECT DISTINCT ON (i.lotto_id, c.categoria_opera_id)
+           i.lotto_id, c.categoria_opera_id, c.ruolo
+      FROM _tender_doc d
+      JOIN _tender_ids i USING (cig),
+           jsonb_array_elements(COALESCE(d.doc -> 'categorie', '[]')) WITH ORDINALITY AS e(cat, n),
+           jsonb_populate_record(NULL::lotto_categoria_opera, e.cat) AS c
+     WHERE i.lotto_id IS NOT NULL
+       AND c.categoria_opera_id IS NOT NULL
+     ORDER BY i.lotto_id, c.categoria_opera_id, d.ord DESC, e.n DESC
+    ON CONFLICT (lotto_id, categoria_opera_id) DO UPDATE SET
+        ruolo = EXCLUDED.ruolo;
+
+    SELECT COALESCE(jsonb_agg(jsonb_build_object(
+               'cig', cig, 'gara_id', gara_id, 'lotto_id', lotto_id)), '[]')
+      INTO written
+      FROM _tender_ids;
+    RETURN written;
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.upsert_tenders(jsonb) TO anon, authenticated, service_role;
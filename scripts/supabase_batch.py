@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+supabase_batch.py
+=================
+
+Scritture a blocchi su Supabase (PostgREST).
+
+``BatchUpserter`` accumula le righe per tabella e le invia con upsert di
+array, ``UPSERT_CHUNK`` righe per richiesta, invece di una richiesta per
+record. Le righe con la stessa chiave di conflitto vengono deduplicate prima
+dell'invio (vince l'ultima), perché PostgreSQL rifiuta un ``ON CONFLICT``
+che tocca due volte la stessa riga nello stesso comando.
+
+Se un blocco fallisce viene diviso a metà e ritentato, fino alla singola
+riga: una riga non valida non fa perdere le altre. Con ``returning=True`` gli
+id restituiti vengono associati alla chiave naturale (CIG, codice fiscale,
+codice CPV, ...) della riga.
+
+``rpc_batched`` applica la stessa strategia a blocchi alle funzioni RPC che
+ricevono un array di documenti (vedi sql/upsert_tenders.sql).
+
+Con un ``change_index.ChangeIndex`` le righe (o i documenti RPC) identici a
+quelli già scritti in un run precedente non vengono inviati: risultano fra
+``written`` e ``skipped`` con l'id registrato allora.
+
+Ogni flush è uno span ``write.<tabella>`` (``rpc.<funzione>`` per le RPC) del
+report del run, con le righe scritte nel contatore ``righe.<tabella>`` e
+quelle invariate in ``invariate.<tabella>``.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from change_index import ChangeIndex, row_hash
+from run_trace import TRACER, warning
+
+UPSERT_CHUNK = 500          # Righe per richiesta di upsert
+
+
+@dataclass
+class UpsertResult:
+    """Esito di un flush: id per chiave naturale, chiavi scritte e fallite.
+    ``skipped`` sono le chiavi invariate non inviate (incluse in ``written``)."""
+    ids: Dict[Hashable, Any] = field(default_factory=dict)
+    written: List[Hashable] = field(default_factory=list)
+    failed: Dict[Hashable, str] = field(default_factory=dict)
+    skipped: List[Hashable] = field(default_factory=list)
+    requests: int = 0
+
+
+@dataclass
+class TableBuffer:
+    on_conflict: str
+    key_columns: Tuple[str, ...]
+    rows: Dict[Hashable, dict] = field(default_factory=dict)
+
+
+def _skip_unchanged(index: ChangeIndex, name: str, hashes: Dict[Hashable, str],
+                    returning: bool, result: UpsertResult) -> Dict[Hashable, Any]:
+    """Segna in ``result`` le chiavi invariate secondo ``index`` e le restituisce."""
+    unchanged = index.unchanged(name, hashes, need_id=returning)
+    result.skipped.extend(unchanged)
+    result.written.extend(unchanged)
+    if returning:
+        result.ids.update(unchanged)
+    return unchanged
+
+
+def _index_entries(hashes: Dict[Hashable, str], result: UpsertResult) -> List[Tuple[Hashable, str, Any]]:
+    """(chiave, hash, id) delle righe inviate e scritte in questo flush."""
+    skipped = set(result.skipped)
+    return [(key, hashes[key], result.ids.get(key))
+            for key in result.written if key not in skipped and key in hashes]
+
+
+def row_key(row: dict, columns: Tuple[str, ...]) -> Hashable:
+    """Chiave naturale di una riga: il valore se la colonna è una sola,
+    altrimenti la tupla dei valori."""
+    if len(columns) == 1:
+        return row.get(columns[0])
+    return tuple(row.get(c) for c in columns)
+
+
+class BatchUpserter:
+    """Buffer di upsert per tabella, svuotato con ``flush``.
+
+    ``key`` indica le colonne della chiave naturale se diverse dal target
+    ``on_conflict`` (per esempio quando il conflitto è su un indice
+    composto ma gli id vanno mappati su una sola colonna).
+    """
+
+    def __init__(self, client, chunk_size: int = UPSERT_CHUNK,
+                 index: Optional[ChangeIndex] = None):
+        self.client = client
+        self.chunk_size = max(1, chunk_size)
+        self.index = index
+        self._tables: Dict[str, TableBuffer] = {}
+
+    def add(self, table: str, row: dict, on_conflict: str, key: str = "") -> Hashable:
+        """Accoda una riga e restituisce la sua chiave naturale."""
+        buf = self._tables.get(table)
+        if buf is None:
+            columns = tuple(c.strip() for c in (key or on_conflict).split(","))
+            buf = self._tables[table] = TableBuffer(on_conflict, columns)
+        elif buf.on_conflict != on_conflict:
+            raise ValueError(f"{table}: on_conflict diverso ({buf.on_conflict} / {on_conflict})")
+        key_value = row_key(row, buf.key_columns)
+        buf.rows.pop(key_value, None)   # l'ultima versione va in coda
+        buf.rows[key_value] = row
+        return key_value
+
+    def pending(self, table: str) -> int:
+        buf = self._tables.get(table)
+        return len(buf.rows) if buf else 0
+
+    def flush(self, table: str, returning: bool = False) -> UpsertResult:
+        """Scrive le righe accodate per ``table`` e svuota il buffer."""
+        result = UpsertResult()
+        buf = self._tables.pop(table, None)
+        if not buf or not buf.rows:
+            return result
+        total = len(buf.rows)
+        hashes: Dict[Hashable, str] = {}
+        if self.index is not None:
+            hashes = {key: row_hash(row) for key, row in buf.rows.items()}
+            unchanged = _skip_unchanged(self.index, table, hashes, returning, result)
+            rows = [row for key, row in buf.rows.items() if key not in unchanged]
+        else:
+            rows = list(buf.rows.values())
+        if rows:
+            with TRACER.span(f"write.{table}"):
+                for start in range(0, len(rows), self.chunk_size):
+                    self._upsert(table, rows[start:start + self.chunk_size], buf, returning, result)
+        TRACER.count(f"righe.{table}", len(result.written) - len(result.skipped))
+        TRACER.count(f"invariate.{table}", len(result.skipped))
+        TRACER.count("richieste.upsert", result.requests)
+        if result.failed:
+            warning("  ↳ %s: %d righe non scritte su %d", table, len(result.failed), total)
+        if hashes:
+            self._index_written(table, _index_entries(hashes, result))
+        return result
+
+    def _index_written(self, table: str, entries: List[Tuple[Hashable, str, Any]]) -> None:
+        """Registra le righe scritte (qui subito: ogni richiesta è già confermata)."""
+        self.index.record(table, entries)
+
+    def _upsert(self, table: str, rows: List[dict], buf: TableBuffer,
+                returning: bool, result: UpsertResult) -> None:
+        result.requests += 1
+        try:
+            returned = self._send(table, rows, buf, returning)
+        except Exception as exc:
+            if len(rows) == 1:
+                key_value = row_key(rows[0], buf.key_columns)
+                result.failed[key_value] = str(exc).strip()
+                TRACER.error(f"write.{table}", type(exc).__name__)
+                warning("  ↳ errore %s %s: %s", table, key_value, exc)
+                return
+            # Divide il blocco per isolare le righe che lo fanno fallire
+            mid = len(rows) // 2
+            self._upsert(table, rows[:mid], buf, returning, result)
+            self._upsert(table, rows[mid:], buf, returning, result)
+            return
+
+        result.written.extend(row_key(row, buf.key_columns) for row in rows)
+        for item in returned:
+            result.ids[row_key(item, buf.key_columns)] = item.get("id")
+
+    def _send(self, table: str, rows: List[dict], buf: TableBuffer,
+              returning: bool) -> List[dict]:
+        """Una richiesta di upsert; restituisce le righe scritte se ``returning``."""
+        res = (
+            self.client
+            .table(table)
+            .upsert(rows, on_conflict=buf.on_conflict,
+                    returning="representation" if returning else "minimal")
+            .execute()
+        )
+        return (res.data or []) if returning else []
+
+
+def rpc_batched(client, function: str, param: str, items: List[Any],
+                key: Callable[[Any], Hashable], chunk_size: int = UPSERT_CHUNK,
+                index: Optional[ChangeIndex] = None) -> UpsertResult:
+    """Chiama una funzione RPC che accetta un array, ``chunk_size`` elementi
+    per chiamata. Una chiamata fallita viene divisa a metà e ritentata come
+    negli upsert; in ``ids`` finiscono le righe restituite dalla funzione,
+    indicizzate con ``key``. Con ``index`` i documenti invariati non vengono
+    inviati e ``ids`` riporta le righe restituite quando furono scritti."""
+    result = UpsertResult()
+    total = len(items)
+    hashes: Dict[Hashable, str] = {}
+    if index is not None:
+        hashes = {key(item): row_hash(item) for item in items}
+        unchanged = _skip_unchanged(index, function, hashes, True, result)
+        items = [item for item in items if key(item) not in unchanged]
+
+    def _call(chunk: List[Any]) -> None:
+        result.requests += 1
+        try:
+            returned = client.rpc(function, {param: chunk}).execute().data or []
+        except Exception as exc:
+            if len(chunk) == 1:
+                result.failed[key(chunk[0])] = str(exc).strip()
+                TRACER.error(f"rpc.{function}", type(exc).__name__)
+                warning("  ↳ errore %s %s: %s", function, key(chunk[0]), exc)
+                return
+            mid = len(chunk) // 2
+            _call(chunk[:mid])
+            _call(chunk[mid:])
+            return
+        result.written.extend(key(item) for item in chunk)
+        for row in returned:
+            result.ids[key(row)] = row
+
+    if items:
+        with TRACER.span(f"rpc.{function}"):
+            for start in range(0, len(items), max(1, chunk_size)):
+                _call(items[start:start + chunk_size])
+    TRACER.count(f"righe.{function}", len(result.written) - len(result.skipped))
+    TRACER.count(f"invariate.{function}", len(result.skipped))
+    TRACER.count("richieste.rpc", result.requests)
+    if result.failed:
+        warning("  ↳ %s: %d elementi non scritti su %d", function, len(result.failed), total)
+    if hashes:
+        index.record(function, _index_entries(hashes, result))
+    return result
@@ -1,11 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-# Set console to UTF-8 mode on Windows
-import os
-if os.name == 'nt':
-    os.system('chcp 65001')
-
 """superset_cig_fetch.py
 
 Fetch detailed CIG data (including categorie opera) from ANAC's Superset backend.
@@ -13,27 +8,40 @@ Fetch detailed CIG data (including categorie opera) from ANAC's Superset backend
 Prerequisites
 -------------
 pip install playwright requests
-playwright install
+playwright install   # serve solo se il bootstrap HTTP della sessione fallisce
 
 Usage
 -----
 python superset_cig_fetch.py <CIG> [output_file.json]
 
 Se non viene specificato un file di output, verrà creato un file con nome 'CIG_<codice>.json'
+
+Gli altri script importano direttamente ``fetch_many_cig_details``: tutti i CIG
+di un run condividono lo stesso browser e vengono scaricati con concorrenza
+limitata, senza avviare un interprete per CIG.
 """
 
 import asyncio
 import json
 import os
 import sys
+import tempfile
+import threading
 import time
 import uuid
-from typing import Dict, Tuple, Optional
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 import ssl
 import urllib3
 
 import requests
-from playwright.async_api import async_playwright
+
+import http_archive
+from cig_store import MISS_ERROR, MISS_NOT_FOUND, CigStore
+from http_archive import ReplayMiss
+from run_trace import TRACER, debug, warning
 
 # Disabilita solo gli avvisi SSL che esistono
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -48,66 +56,298 @@ class CustomHTTPSAdapter(requests.adapters.HTTPAdapter):
         kwargs['ssl_context'] = ctx
         return super().init_poolmanager(*args, **kwargs)
 
-SUPRESET_BASE = "https://dati.anticorruzione.it"
+SUPRESET_BASE = os.getenv("SUPERSET_BASE_URL", "https://dati.anticorruzione.it")
 MAX_RETRIES = 3
 BASE_TIMEOUT = 120
+MAX_CONCURRENCY = 4         # Richieste chart/data contemporanee
+POOL_SIZE = 2               # Contesti Chromium persistenti
+MAX_BATCH_SIZE = 200        # Limite superiore per la modalità multi-CIG
+BATCH_FILTER_COLUMN = "cig" # Colonna di DETTAGLIO_CIG usata nel filtro IN
 
 
-async def _get_session(cig: str) -> Tuple[Dict[str, str], str]:
-    """Launches a headless Chromium session, opens the dashboard page for
-    the given CIG and extracts:
-      • all cookies as a dict
-      • the csrf_token stored in localStorage
+# Risorse inutili per ottenere cookie e csrf_token: vengono bloccate durante
+# il caricamento della dashboard (le chart verrebbero comunque scartate).
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media", "stylesheet"}
+BLOCKED_URL_PARTS = ("/api/v1/chart/", "/static/assets/images/")
+CHROMIUM_ARGS = [
+    "--disable-blink-features=AutomationControlled",
+    "--ignore-certificate-errors",
+    "--ignore-ssl-errors",
+    "--ignore-certificate-errors-spki-list",
+    "--disable-web-security",
+    "--allow-running-insecure-content",
+    "--disable-extensions",
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-features=VizDisplayCompositor"
+]
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
+CSRF_WAIT_MS = 15_000
+
+# Cache su disco di cookie e csrf_token, condivisa da tutti i processi
+TOKEN_CACHE_PATH = Path(os.getenv("SUPERSET_TOKEN_CACHE",
+                                  Path(tempfile.gettempdir()) / "superset_session.json"))
+TOKEN_CACHE_TTL = 30 * 60   # secondi
+
+
+@dataclass
+class SupersetSession:
+    """Cookie e csrf_token di un contesto del pool.
+
+    ``generation`` identifica il caricamento della dashboard che li ha prodotti:
+    serve a evitare refresh multipli quando più richieste vengono rifiutate
+    con lo stesso token.
+    """
+    cookies: Dict[str, str]
+    csrf_token: str
+    slot: int
+    generation: int
+    source: str = "browser"     # "cache", "http" o "browser"
+
+
+@dataclass
+class _PoolSlot:
+    context: Any = None
+    session: Optional[SupersetSession] = None
+    generation: int = 0
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+class SupersetSessionPool:
+    """Pool persistente di contesti Chromium per l'acquisizione delle sessioni.
+
+    Per inizializzare uno slot si prova, nell'ordine: la cache su disco dei
+    token (``token_cache``), il bootstrap HTTP senza browser e infine la
+    dashboard ``dettaglio_cig`` in Chromium. Il browser viene avviato solo se
+    serve, una sola volta; cookie/csrf_token vengono riutilizzati finché il
+    backend non li rifiuta (vedi ``invalidate``).
     """
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(
-            headless=True,
-            args=[
-                "--disable-blink-features=AutomationControlled",
-                "--ignore-certificate-errors",
-                "--ignore-ssl-errors",
-                "--ignore-certificate-errors-spki-list",
-                "--disable-web-security",
-                "--allow-running-insecure-content",
-                "--disable-extensions",
-                "--no-sandbox",
-                "--disable-dev-shm-usage",
-                "--disable-gpu",
-                "--disable-features=VizDisplayCompositor"
-            ]
+
+    def __init__(self, size: int = 1, token_cache: Optional[Path] = None,
+                 use_token_cache: bool = True):
+        self.size = max(1, size)
+        self.token_cache = Path(token_cache or TOKEN_CACHE_PATH) if use_token_cache else None
+        self._playwright = None
+        self._browser = None
+        self._slots = [_PoolSlot() for _ in range(self.size)]
+        self._next = 0
+        self._http_bootstrap_ok = True
+
+    async def __aenter__(self) -> "SupersetSessionPool":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        if self._browser is not None:
+            return
+        # Import ritardato: un run servito dalla cache non carica Playwright
+        from playwright.async_api import async_playwright
+
+        self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch(
+            headless=True, args=CHROMIUM_ARGS
         )
-        context = await browser.new_context(
+
+    async def close(self) -> None:
+        for slot in self._slots:
+            if slot.context is not None:
+                try:
+                    await slot.context.close()
+                except Exception:
+                    pass
+                slot.context = None
+                slot.session = None
+        if self._browser is not None:
+            await self._browser.close()
+            self._browser = None
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def acquire(self, cig: str = "") -> SupersetSession:
+        """Restituisce la sessione di uno slot (round robin), caricando la
+        dashboard solo se lo slot non è ancora stato inizializzato."""
+        index = self._next % self.size
+        self._next += 1
+        slot = self._slots[index]
+        async with slot.lock:
+            if slot.session is None:
+                await self._refresh(index, cig)
+            return slot.session
+
+    async def invalidate(self, session: SupersetSession, cig: str = "") -> None:
+        """Da chiamare quando il backend rifiuta il token: ricarica il
+        contesto solo se nessun'altra richiesta lo ha già fatto."""
+        slot = self._slots[session.slot]
+        async with slot.lock:
+            if slot.session is not None and slot.session.generation != session.generation:
+                return
+            if session.source == "cache" and self.token_cache:
+                _discard_token_cache(self.token_cache, session.csrf_token)
+            elif session.source == "http":
+                # Il token ottenuto via HTTP non basta: d'ora in poi browser
+                self._http_bootstrap_ok = False
+            await self._refresh(session.slot, cig, rejected=session.csrf_token)
+
+    async def _refresh(self, index: int, cig: str, rejected: str = "") -> None:
+        with TRACER.span("superset.sessione"):
+            await self._load_session(index, cig, rejected)
+        TRACER.count(f"superset.sessione.{self._slots[index].session.source}")
+
+    async def _load_session(self, index: int, cig: str, rejected: str) -> None:
+        slot = self._slots[index]
+        slot.generation += 1
+
+        if http_archive.replaying():
+            # Le risposte arrivano dall'archivio: nessun cookie o token da ottenere
+            slot.session = SupersetSession({"session": "replay"}, "replay", index,
+                                           slot.generation, "replay")
+            return
+
+        if self.token_cache:
+            cached = _load_token_cache(self.token_cache)
+            if cached and cached[1] != rejected:
+                slot.session = SupersetSession(*cached, index, slot.generation, "cache")
+                return
+
+        if self._http_bootstrap_ok:
+            cookies, csrf_token = await asyncio.to_thread(_bootstrap_session_http, cig)
+            if csrf_token and csrf_token != rejected:
+                self._save_tokens(cookies, csrf_token)
+                slot.session = SupersetSession(cookies, csrf_token, index, slot.generation, "http")
+                return
+            self._http_bootstrap_ok = False
+            print("Bootstrap HTTP della sessione fallito: uso Chromium")
+
+        await self.start()
+        if slot.context is not None:
+            try:
+                await slot.context.close()
+            except Exception:
+                pass
+        slot.context = await self._browser.new_context(
             ignore_https_errors=True,
-            extra_http_headers={
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
-            }
+            extra_http_headers={"User-Agent": USER_AGENT}
+        )
+        await slot.context.route("**/*", _block_heavy_resources)
+        cookies, csrf_token = await _load_dashboard(slot.context, cig)
+        if cookies and csrf_token:
+            self._save_tokens(cookies, csrf_token)
+        slot.session = SupersetSession(cookies, csrf_token, index, slot.generation)
+
+    def _save_tokens(self, cookies: Dict[str, str], csrf_token: str) -> None:
+        if not self.token_cache:
+            return
+        try:
+            _write_json_atomic(self.token_cache, {
+                "cookies": cookies,
+                "csrf_token": csrf_token,
+                "created_at": time.time(),
+            })
+        except OSError as e:
+            print(f"ATTENZIONE: impossibile salvare la cache dei token: {e}")
+
+
+def _load_token_cache(path: Path) -> Optional[Tuple[Dict[str, str], str]]:
+    """Cookie e csrf_token dalla cache su disco, se presenti e non scaduti."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if time.time() - cached.get("created_at", 0) > TOKEN_CACHE_TTL:
+        return None
+    if not cached.get("cookies") or not cached.get("csrf_token"):
+        return None
+    return cached["cookies"], cached["csrf_token"]
+
+
+def _discard_token_cache(path: Path, csrf_token: str) -> None:
+    """Elimina la cache se contiene ancora il token rifiutato (un altro
+    processo potrebbe averla già rinnovata)."""
+    cached = _load_token_cache(path)
+    if cached and cached[1] == csrf_token:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _bootstrap_session_http(cig: str) -> Tuple[Dict[str, str], str]:
+    """Ottiene cookie e csrf_token senza browser: la pagina della dashboard
+    imposta i cookie di sessione guest, l'endpoint security/csrf_token
+    restituisce il token associato."""
+    http = requests.Session()
+    http.mount('https://', CustomHTTPSAdapter())
+    http.verify = False
+    http.headers.update({
+        "User-Agent": USER_AGENT,
+        "Accept-Language": "it-IT,it;q=0.9,en;q=0.8",
+    })
+    try:
+        page = http.get(
+            f"{SUPRESET_BASE}/superset/dashboard/dettaglio_cig/?cig={cig}&standalone=2",
+            timeout=30
         )
-        page = await context.new_page()
+        page.raise_for_status()
+        response = http.get(
+            f"{SUPRESET_BASE}/api/v1/security/csrf_token/",
+            headers={
+                "Accept": "application/json",
+                "referer": page.url,
+            },
+            timeout=30
+        )
+        response.raise_for_status()
+        csrf_token = (response.json() or {}).get("result") or ""
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Bootstrap HTTP della sessione non riuscito: {type(e).__name__}")
+        return {}, ""
+    return http.cookies.get_dict(), csrf_token
+
+
+async def _block_heavy_resources(route) -> None:
+    request = route.request
+    if (request.resource_type in BLOCKED_RESOURCE_TYPES
+            or any(part in request.url for part in BLOCKED_URL_PARTS)):
+        await route.abort()
+    else:
+        await route.continue_()
+
 
+async def _load_dashboard(context, cig: str) -> Tuple[Dict[str, str], str]:
+    """Apre la dashboard nel contesto indicato ed estrae:
+      • all cookies as a dict
+      • the csrf_token stored in localStorage
+    """
+    page = await context.new_page()
+    try:
+        await page.goto(
+            f"{SUPRESET_BASE}/superset/dashboard/dettaglio_cig/?cig={cig}&standalone=2",
+            timeout=120_000,
+            wait_until="domcontentloaded"
+        )
+        # Invece di attendere networkidle + 3 s aspettiamo solo il token
         try:
-            await page.goto(
-                f"{SUPRESET_BASE}/superset/dashboard/dettaglio_cig/?cig={cig}&standalone=2",
-                timeout=120_000,
-                wait_until="networkidle"
+            await page.wait_for_function(
+                "() => window.localStorage.getItem('csrf_token')",
+                timeout=CSRF_WAIT_MS
             )
-            
-            # Aspetta un po' per assicurarsi che la pagina sia completamente caricata
-            await page.wait_for_timeout(3000)
-            
-        except Exception as e:
-            print(f"Errore durante il caricamento della pagina: {e}")
-            await browser.close()
-            return {}, ""
+        except Exception:
+            print("ATTENZIONE: csrf_token non comparso in localStorage")
 
-        # Collect cookies
         cookies_list = await context.cookies()
         cookies = {c["name"]: c["value"] for c in cookies_list}
-
-        # csrf_token is stored in localStorage
         csrf_token = await page.evaluate("() => window.localStorage.getItem('csrf_token')")
-
-        await browser.close()
         return cookies, csrf_token or ""
+    except Exception as e:
+        print(f"Errore durante il caricamento della pagina: {e}")
+        return {}, ""
+    finally:
+        await page.close()
 
 
 def _build_payload(cig: str, uuid_str: str) -> dict:
@@ -195,6 +435,150 @@ def _build_payload(cig: str, uuid_str: str) -> dict:
     return base
 
 
+def _build_batch_payload(cigs: List[str], uuid_str: str) -> dict:
+    """Payload chart/data per più CIG: filtro IN sulla colonna del CIG al posto
+    del parametro ``cig`` in ``url_params``; due righe per CIG come nella
+    richiesta singola."""
+    payload = _build_payload(cigs[0], uuid_str)
+    query = payload["queries"][0]
+    form_data = payload["form_data"]
+
+    query["url_params"] = {"UUID": uuid_str}
+    query["filters"] = [{"col": BATCH_FILTER_COLUMN, "op": "IN", "val": list(cigs)}]
+    query["row_limit"] = 2 * len(cigs)
+
+    form_data["url_params"] = {"UUID": uuid_str}
+    form_data["adhoc_filters"] = [{
+        "expressionType": "SIMPLE",
+        "subject": BATCH_FILTER_COLUMN,
+        "operator": "IN",
+        "comparator": list(cigs),
+        "clause": "WHERE",
+    }]
+    form_data["row_limit"] = str(2 * len(cigs))
+    return payload
+
+
+def _row_cig(row: dict) -> Optional[str]:
+    """Legge il CIG di una riga DETTAGLIO_CIG dalla colonna ``bando``."""
+    bando = row.get("bando")
+    if isinstance(bando, str):
+        try:
+            bando = json.loads(bando)
+        except json.JSONDecodeError:
+            return None
+    if not isinstance(bando, dict):
+        return None
+    cig = bando.get("CIG") or bando.get("cig")
+    return cig.strip().upper() if isinstance(cig, str) else None
+
+
+def _has_rows(data: Optional[dict]) -> bool:
+    """True se la risposta chart/data contiene almeno una riga: Superset
+    risponde 200 con ``data`` vuoto per i CIG che non conosce."""
+    try:
+        return bool((data.get("result") or [{}])[0].get("data"))
+    except (AttributeError, IndexError):
+        return False
+
+
+def _foreign_rows(data: dict, cigs: List[str]) -> int:
+    """Righe della risposta multi-CIG con un CIG non richiesto: se ci sono,
+    il dataset non ha applicato il filtro IN."""
+    wanted = {cig.upper() for cig in cigs}
+    rows = ((data.get("result") or [{}])[0]).get("data") or []
+    return sum(1 for row in rows if (_row_cig(row) or "") not in wanted)
+
+
+def _split_batch_response(data: dict, cigs: List[str]) -> Dict[str, dict]:
+    """Divide la risposta multi-CIG in risposte con lo stesso formato di una
+    richiesta singola, una per CIG richiesto e trovato."""
+    wanted = {cig.upper(): cig for cig in cigs}
+    result = (data.get("result") or [{}])[0]
+    rows_by_cig: Dict[str, List[dict]] = {}
+    for row in result.get("data") or []:
+        cig = wanted.get(_row_cig(row) or "")
+        if cig:
+            rows_by_cig.setdefault(cig, []).append(row)
+
+    split = {}
+    for cig, rows in rows_by_cig.items():
+        entry = {k: v for k, v in result.items() if k != "data"}
+        entry["data"] = rows
+        entry["rowcount"] = len(rows)
+        split[cig] = {**data, "result": [entry]}
+    return split
+
+
+class _ChartDataRoute(http_archive.Route):
+    """Archivia le risposte chart/data per CIG.
+
+    Il payload contiene UUID e ``import_time`` diversi a ogni richiesta, quindi
+    la chiave è il CIG; le risposte multi-CIG vengono divise con
+    ``_split_batch_response`` e ricomposte in replay, indipendentemente da come
+    erano raggruppate in registrazione.
+    """
+
+    def matches(self, request) -> bool:
+        return request.method == "POST" and "/api/v1/chart/data" in request.url
+
+    @staticmethod
+    def _cigs(request) -> Tuple[List[str], bool]:
+        query = json.loads(request.body)["queries"][0]
+        for f in query.get("filters") or []:
+            if f.get("col") == BATCH_FILTER_COLUMN and f.get("op") == "IN":
+                return list(f["val"]), True
+        return [query["url_params"]["cig"]], False
+
+    @staticmethod
+    def _key(cig: str) -> str:
+        return f"superset:cig:{cig.upper()}"
+
+    def keys(self, request) -> List[str]:
+        return [self._key(cig) for cig in self._cigs(request)[0]]
+
+    def split(self, request, body: bytes) -> Dict[str, bytes]:
+        cigs, batch = self._cigs(request)
+        if not batch:
+            # Anche una risposta senza righe va archiviata: è un "non trovato"
+            return {self._key(cigs[0]): body}
+        try:
+            parts = _split_batch_response(json.loads(body), cigs)
+        except (json.JSONDecodeError, AttributeError, IndexError, TypeError):
+            return {}
+        return {self._key(cig): json.dumps(part, ensure_ascii=False).encode("utf-8")
+                for cig, part in parts.items()}
+
+    def join(self, request, found: Dict[str, bytes]) -> Optional[bytes]:
+        cigs, batch = self._cigs(request)
+        if not batch:
+            return found.get(self._key(cigs[0]))
+        # CIG non archiviati assenti dalla risposta: passano alla richiesta singola
+        rows: List[dict] = []
+        for cig in cigs:
+            if self._key(cig) in found:
+                rows.extend((json.loads(found[self._key(cig)]).get("result") or [{}])[0].get("data") or [])
+        return json.dumps({"result": [{"data": rows, "rowcount": len(rows)}]}).encode("utf-8")
+
+
+http_archive.register(_ChartDataRoute())
+
+
+class _AdaptiveBatchSize:
+    """Dimensione del batch multi-CIG: dimezzata a ogni timeout o errore del
+    server, fatta crescere gradualmente dopo ogni batch riuscito."""
+
+    def __init__(self, initial: int):
+        self.limit = max(1, min(initial, MAX_BATCH_SIZE))
+        self.size = self.limit
+
+    def shrink(self) -> None:
+        self.size = max(1, self.size // 2)
+
+    def grow(self) -> None:
+        self.size = min(self.limit, self.size + max(1, self.size // 4))
+
+
 def safe_print(text):
     """Stampa testo gestendo i caratteri Unicode problematici"""
     try:
@@ -205,125 +589,152 @@ def safe_print(text):
         print(safe_text)
 
 
-def fetch_cig_details(cig: str) -> Optional[dict]:
-    """High‑level helper: gets cookies/csrf and performs the data request.
-    Implements retry logic with exponential backoff.
+def _is_session_rejected(response: requests.Response) -> bool:
+    """True se il backend ha rifiutato cookie/csrf_token della sessione."""
+    if response.status_code in (401, 403):
+        return True
+    return response.status_code == 400 and "csrf" in response.text.lower()
+
+
+_thread_local = threading.local()
+
+
+def _http_session() -> requests.Session:
+    """Sessione requests per thread: riutilizza le connessioni keep-alive."""
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        http = requests.Session()
+        http.mount('https://', CustomHTTPSAdapter())
+        http.verify = False
+        _thread_local.http = http_archive.mount(http)
+    return http
+
+
+def _post_chart_data(payload: dict, uuid_str: str, cig: str,
+                     session: SupersetSession, timeout: int) -> requests.Response:
+    """Esegue la richiesta /api/v1/chart/data con la sessione indicata."""
+    headers = {
+        'Accept': 'application/json, text/plain, */*',
+        # 'Accept-Encoding': 'gzip, deflate, br',  # <-- Commenta questa riga
+        'Accept-Language': 'it-IT,it;q=0.9,en;q=0.8',
+        "content-type": "application/json",
+        "origin": SUPRESET_BASE,
+        "priority": "u=1, i",
+        "referer": f"{SUPRESET_BASE}/superset/dashboard/dettaglio_cig/?UUID={uuid_str}&cig={cig}",
+        "sec-ch-ua": '"Not)A;Brand";v="8", "Chromium";v="138", "Google Chrome";v="138"',
+        "sec-ch-ua-mobile": "?0",
+        "sec-ch-ua-platform": '"Windows"',
+        "sec-fetch-dest": "empty",
+        "sec-fetch-mode": "same-origin",
+        "sec-fetch-site": "same-origin",
+        "user-agent": USER_AGENT,
+        "x-csrftoken": session.csrf_token
+    }
+
+    url = f"{SUPRESET_BASE}/api/v1/chart/data?form_data=%7B%22slice_id%22%3A372%7D&dashboard_id=26&force"
+
+    return _http_session().post(
+        url,
+        headers=headers,
+        cookies=session.cookies,
+        json=payload,
+        timeout=timeout,
+        verify=False
+    )
+
+
+async def _backoff(attempt: int) -> None:
+    if attempt < MAX_RETRIES - 1:
+        wait_time = 2 ** attempt * 5
+        print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
+        await asyncio.sleep(wait_time)
+
+
+async def fetch_cig_details_async(cig: str, pool: SupersetSessionPool,
+                                  failures: Optional[Dict[str, str]] = None) -> Optional[dict]:
+    """Recupera i dati di un CIG usando una sessione del pool.
+
+    La sessione viene rinnovata solo se il backend rifiuta il token; gli altri
+    errori vengono ritentati con backoff esponenziale riutilizzando il browser.
+    Se tutti i tentativi falliscono l'ultimo errore viene scritto in
+    ``failures[cig]``.
     """
-    
+    last_error = "nessuna risposta"
     for attempt in range(MAX_RETRIES):
+        response = None
         try:
             current_timeout = BASE_TIMEOUT * (attempt + 1)
-            print(f"Tentativo {attempt+1}/{MAX_RETRIES} (timeout: {current_timeout}s)...")
-            
-            cookies, csrf_token = asyncio.run(_get_session(cig))
-            
-            if not cookies:
+            debug("[%s] Tentativo %d/%d (timeout: %ds)...", cig, attempt + 1, MAX_RETRIES, current_timeout)
+
+            session = await pool.acquire(cig)
+
+            if not session.cookies:
                 print("ATTENZIONE: Nessun cookie ottenuto dalla sessione")
+                last_error = "sessione senza cookie"
                 if attempt < MAX_RETRIES - 1:
-                    wait_time = 2 ** attempt * 5
-                    print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
-                    time.sleep(wait_time)
+                    await pool.invalidate(session, cig)
+                    await _backoff(attempt)
                     continue
-            
+
             uuid_str = str(uuid.uuid4())
             payload = _build_payload(cig, uuid_str)
+            with TRACER.span("superset.richiesta"):
+                response = await asyncio.to_thread(
+                    _post_chart_data, payload, uuid_str, cig, session, current_timeout
+                )
+
+            debug("[%s] Status code: %d, %d caratteri", cig, response.status_code, len(response.text))
+
+            if _is_session_rejected(response):
+                print("Sessione rifiutata dal server: rinnovo del contesto")
+                last_error = f"sessione rifiutata (HTTP {response.status_code})"
+                await pool.invalidate(session, cig)
+                await _backoff(attempt)
+                continue
 
-            headers = {
-                'Accept': 'application/json, text/plain, */*',
-                # 'Accept-Encoding': 'gzip, deflate, br',  # <-- Commenta questa riga
-                'Accept-Language': 'it-IT,it;q=0.9,en;q=0.8',  
-                "content-type": "application/json",
-                "origin": SUPRESET_BASE,
-                "priority": "u=1, i",
-                "referer": f"{SUPRESET_BASE}/superset/dashboard/dettaglio_cig/?UUID={uuid_str}&cig={cig}",
-                "sec-ch-ua": '"Not)A;Brand";v="8", "Chromium";v="138", "Google Chrome";v="138"',
-                "sec-ch-ua-mobile": "?0",
-                "sec-ch-ua-platform": '"Windows"',
-                "sec-fetch-dest": "empty",
-                "sec-fetch-mode": "same-origin",
-                "sec-fetch-site": "same-origin",
-                "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36",
-                "x-csrftoken": csrf_token
-            }
-
-            url = f"{SUPRESET_BASE}/api/v1/chart/data?form_data=%7B%22slice_id%22%3A372%7D&dashboard_id=26&force"
-            
-            session = requests.Session()
-            session.headers.update(headers)
-            session.mount('https://', CustomHTTPSAdapter())
-            session.verify = False
-            
-            response = session.post(
-                url, 
-                headers=headers, 
-                cookies=cookies, 
-                json=payload, 
-                timeout=current_timeout,
-                verify=False
-            )
-            
-            print(f"Status code: {response.status_code}")
-            print(f"Response length: {len(response.text)} caratteri")
-            
             if response.status_code != 200:
                 print(f"Errore HTTP {response.status_code}")
-                if attempt < MAX_RETRIES - 1:
-                    wait_time = 2 ** attempt * 5
-                    print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    return None
-            
+                last_error = f"HTTP {response.status_code}"
+                await _backoff(attempt)
+                continue
+
             if not response.text.strip():
                 print("ERRORE: Risposta vuota dal server")
-                if attempt < MAX_RETRIES - 1:
-                    wait_time = 2 ** attempt * 5
-                    print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    return None
-            
+                last_error = "risposta vuota"
+                await _backoff(attempt)
+                continue
+
             try:
                 data = response.json()
-                print("Risposta JSON parsata con successo")
+                debug("[%s] Risposta JSON parsata con successo", cig)
                 return data
             except json.JSONDecodeError as json_err:
                 print(f"Errore nel parsing JSON: {json_err}")
+                last_error = "JSON non valido"
                 # Stampa solo i primi 500 caratteri in modo sicuro
                 try:
                     preview = response.text[:500]
                     safe_print(f"Anteprima risposta: {preview}")
                 except:
                     print("Impossibile mostrare anteprima della risposta (caratteri non supportati)")
-                
-                if attempt < MAX_RETRIES - 1:
-                    wait_time = 2 ** attempt * 5
-                    print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    return None
-            
+                await _backoff(attempt)
+
+        except ReplayMiss:
+            # In replay ritentare non serve: la risposta non è nell'archivio
+            last_error = "assente dall'archivio HTTP"
+            break
         except (requests.exceptions.SSLError, ssl.SSLError) as ssl_err:
             print(f"Errore SSL (tentativo {attempt+1}): {ssl_err}")
-            if attempt < MAX_RETRIES - 1:
-                wait_time = 2 ** attempt * 5
-                print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
-                time.sleep(wait_time)
+            last_error = "errore SSL"
+            await _backoff(attempt)
         except requests.exceptions.Timeout:
             print(f"Timeout durante il tentativo {attempt+1}")
-            if attempt < MAX_RETRIES - 1:
-                wait_time = 2 ** attempt * 5
-                print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
-                time.sleep(wait_time)
+            last_error = f"timeout ({BASE_TIMEOUT * (attempt + 1)}s)"
+            await _backoff(attempt)
         except requests.exceptions.RequestException as e:
             print(f"Errore durante la richiesta (tentativo {attempt+1}): {e}")
-            if attempt < MAX_RETRIES - 1:
-                wait_time = 2 ** attempt * 5
-                print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
-                time.sleep(wait_time)
+            last_error = type(e).__name__
+            await _backoff(attempt)
         except UnicodeEncodeError as enc_err:
             print(f"Errore di encoding durante la stampa (tentativo {attempt+1})")
             # Non interrompere per errori di stampa, continua con il processing
@@ -332,40 +743,269 @@ def fetch_cig_details(cig: str) -> Optional[dict]:
                 print("Risposta JSON parsata con successo (nonostante errore di stampa)")
                 return data
             except:
-                if attempt < MAX_RETRIES - 1:
-                    wait_time = 2 ** attempt * 5
-                    print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
-                    time.sleep(wait_time)
+                await _backoff(attempt)
         except Exception as e:
             print(f"Errore imprevisto (tentativo {attempt+1}): {type(e).__name__}")
-            if attempt < MAX_RETRIES - 1:
-                wait_time = 2 ** attempt * 5
-                print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
-                time.sleep(wait_time)
-    
+            last_error = type(e).__name__
+            await _backoff(attempt)
+
+    TRACER.error("superset.cig", last_error)
+    if failures is not None:
+        failures[cig] = last_error
     return None
 
 
+async def _fetch_batch(cigs: List[str], pool: SupersetSessionPool) -> Optional[Tuple[Dict[str, dict], int]]:
+    """Una richiesta chart/data per più CIG. Restituisce le risposte per CIG
+    trovati e il numero di righe di CIG non richiesti (vedi ``_foreign_rows``),
+    oppure ``None`` se il batch è fallito (timeout, errore server, sessione
+    non ottenuta o rifiutata): i suoi CIG tornano al batcher adattivo, che
+    ripiega sulla richiesta singola invece di interrompere il download."""
+    uuid_str = str(uuid.uuid4())
+    payload = _build_batch_payload(cigs, uuid_str)
+    try:
+        session = await pool.acquire(cigs[0])
+        with TRACER.span("superset.batch"):
+            response = await asyncio.to_thread(
+                _post_chart_data, payload, uuid_str, cigs[0], session, BASE_TIMEOUT
+            )
+        if _is_session_rejected(response):
+            TRACER.error("superset.batch", "sessione rifiutata")
+            await pool.invalidate(session, cigs[0])
+            return None
+    except requests.exceptions.RequestException as e:
+        TRACER.error("superset.batch", type(e).__name__)
+        warning("[batch %d CIG] Errore durante la richiesta: %s", len(cigs), type(e).__name__)
+        return None
+    except Exception as e:
+        # Bootstrap della sessione (HTTP o Chromium) fallito o errore imprevisto
+        TRACER.error("superset.batch", type(e).__name__)
+        warning("[batch %d CIG] Errore imprevisto: %s: %s", len(cigs), type(e).__name__, e)
+        return None
+
+    if response.status_code != 200:
+        TRACER.error("superset.batch", f"HTTP {response.status_code}")
+        warning("[batch %d CIG] Errore HTTP %d", len(cigs), response.status_code)
+        return None
+    try:
+        data = response.json()
+        return _split_batch_response(data, cigs), _foreign_rows(data, cigs)
+    except (json.JSONDecodeError, AttributeError, IndexError, TypeError) as e:
+        warning("[batch %d CIG] Risposta non valida: %s", len(cigs), e)
+        return None
+
+
+def _write_json_atomic(path: Path, data: dict) -> None:
+    """Scrittura atomica: un file parziale non viene mai letto."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+async def fetch_many_cig_details_async(
+    cigs: Iterable[str],
+    cache: Optional[CigStore] = None,
+    concurrency: int = MAX_CONCURRENCY,
+    pool_size: int = POOL_SIZE,
+    on_result: Optional[Callable[[str, Optional[dict]], None]] = None,
+    batch_size: int = 0,
+    refresh_budget: int = 0,
+    collect: bool = True,
+) -> Dict[str, Optional[dict]]:
+    """Scarica i dettagli di più CIG con concorrenza limitata.
+
+    I CIG già presenti in ``cache`` non vengono richiesti; quelli scaricati
+    vengono salvati in cache. Restituisce una mappa CIG → risposta Superset
+    (``None`` se il download è fallito). ``on_result`` viene invocato per ogni
+    CIG completato, ad esempio per mostrare l'avanzamento.
+
+    Con ``batch_size`` > 1 i CIG vengono prima richiesti a gruppi con un
+    filtro IN (vedi ``_build_batch_payload``); la dimensione del gruppo si
+    adatta ai timeout del server. I CIG assenti dalle risposte multiple o
+    rimasti dopo che il batch è sceso a 1 passano alla richiesta singola.
+
+    Fino a ``refresh_budget`` voci di cache scadute (vedi
+    ``CigStore.stale_cigs``) vengono riscaricate, le più urgenti per prime;
+    se il refresh fallisce resta valida la versione in cache.
+
+    I CIG senza righe su Superset o falliti dopo tutti i retry vanno nella
+    cache negativa (``CigStore.record_misses``) e restituiscono ``None``;
+    finché il loro ``next_retry`` non scade non vengono richiesti di nuovo.
+
+    Con ``collect=False`` i dettagli passano solo da ``on_result`` e la mappa
+    restituita contiene ``None`` per ogni CIG: chi li consuma in streaming
+    non li tiene tutti in memoria fino alla fine.
+    """
+    cigs = list(dict.fromkeys(cigs))
+    cached: Dict[str, dict] = cache.get_many(cigs) if cache is not None else {}
+    # Risposte senza righe salvate prima della cache negativa: si ritentano
+    cached = {cig: data for cig, data in cached.items() if _has_rows(data)}
+    stale = set(cache.stale_cigs(cached, limit=refresh_budget)) if cache is not None and refresh_budget > 0 else set()
+    if stale:
+        print(f"↻  {len(stale)} CIG in cache da aggiornare")
+
+    results: Dict[str, Optional[dict]] = {}
+    for cig, data in cached.items():
+        if cig not in stale:
+            results[cig] = data if collect else None
+            if on_result:
+                on_result(cig, data)
+    to_fetch = [cig for cig in cigs if cig not in results]
+    TRACER.count("cig.da_cache", len(results))
+
+    new = [cig for cig in to_fetch if cig not in cached]
+    if not collect:
+        # Servono ancora solo le voci da aggiornare (fallback se il refresh fallisce)
+        cached = {cig: cached[cig] for cig in stale}
+    deferred = cache.deferred_cigs(new) if cache is not None and new else {}
+    if deferred:
+        print(f"⏭  {len(deferred)} CIG nella cache negativa, non ancora da ritentare")
+        TRACER.count("cig.rinviati", len(deferred))
+        for cig in deferred:
+            results[cig] = None
+            if on_result:
+                on_result(cig, None)
+        to_fetch = [cig for cig in to_fetch if cig not in deferred]
+
+    if not to_fetch:
+        return results
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    failures: Dict[str, str] = {}
+    misses: Dict[str, Tuple[str, Optional[str]]] = {}
+
+    def _store(cig: str, data: Optional[dict]) -> None:
+        if data is not None and not _has_rows(data):
+            data = None
+            reason: Tuple[str, Optional[str]] = (MISS_NOT_FOUND, None)
+        else:
+            reason = (MISS_ERROR, failures.get(cig))
+        if data is not None and cache is not None:
+            try:
+                cache.put(cig, data)
+            except Exception as e:
+                print(f"  ↳ errore scrittura cache per CIG {cig}: {e}")
+        if data is None:
+            if cig in cached:
+                # Refresh fallito: resta valida la versione in cache
+                data = cached[cig]
+            else:
+                misses[cig] = reason
+        TRACER.count("cig.scaricati" if cig not in misses else "cig.mancanti")
+        results[cig] = data if collect else None
+        if on_result:
+            on_result(cig, data)
+
+    async with SupersetSessionPool(size=min(pool_size, len(to_fetch))) as pool:
+        single = to_fetch
+        if batch_size > 1 and len(to_fetch) > 1:
+            single = await _fetch_batched(to_fetch, pool, batch_size, concurrency, _store)
+            if single:
+                print(f"→ {len(single)} CIG passano alla richiesta singola")
+
+        async def _worker(cig: str) -> None:
+            async with semaphore:
+                with TRACER.span("superset.cig"):
+                    data = await fetch_cig_details_async(cig, pool, failures)
+            _store(cig, data)
+
+        await asyncio.gather(*(_worker(cig) for cig in single))
+
+    if misses and cache is not None:
+        try:
+            cache.record_misses(misses)
+        except Exception as e:
+            print(f"  ↳ errore scrittura cache negativa: {e}")
+        not_found = sum(1 for reason, _ in misses.values() if reason == MISS_NOT_FOUND)
+        print(f"✖  {len(misses)} CIG nella cache negativa "
+              f"({not_found} non trovati, {len(misses) - not_found} in errore)")
+    return results
+
+
+async def _fetch_batched(
+    cigs: List[str],
+    pool: SupersetSessionPool,
+    batch_size: int,
+    concurrency: int,
+    store: Callable[[str, Optional[dict]], None],
+) -> List[str]:
+    """Scarica i CIG a gruppi e restituisce quelli da richiedere singolarmente."""
+    pending = deque(cigs)
+    fallback: List[str] = []
+    batcher = _AdaptiveBatchSize(batch_size)
+    batching_enabled = True
+
+    async def _batch_worker() -> None:
+        nonlocal batching_enabled
+        while pending and batching_enabled:
+            if batcher.size <= 1:
+                break
+            chunk = [pending.popleft() for _ in range(min(batcher.size, len(pending)))]
+            outcome = await _fetch_batch(chunk, pool)
+            if outcome is None:
+                batcher.shrink()
+                warning("↳ batch fallito, nuova dimensione: %d", batcher.size)
+                pending.extendleft(reversed(chunk))
+                continue
+            found, foreign = outcome
+            if foreign:
+                # Il dataset non applica il filtro IN: inutile insistere
+                warning("Superset ha restituito %d righe di CIG non richiesti: "
+                        "modalità multi-CIG disattivata", foreign)
+                batching_enabled = False
+                pending.extendleft(reversed(chunk))
+                break
+            # Un batch vuoto (CIG inesistenti) passa solo lui alla richiesta singola
+            batcher.grow()
+            for cig in chunk:
+                if cig in found:
+                    store(cig, found[cig])
+                else:
+                    fallback.append(cig)
+
+    await asyncio.gather(*(_batch_worker() for _ in range(max(1, concurrency))))
+    fallback.extend(pending)
+    return fallback
+
+
+def fetch_many_cig_details(
+    cigs: Iterable[str],
+    cache: Optional[CigStore] = None,
+    concurrency: int = MAX_CONCURRENCY,
+    pool_size: int = POOL_SIZE,
+    on_result: Optional[Callable[[str, Optional[dict]], None]] = None,
+    batch_size: int = 0,
+    refresh_budget: int = 0,
+    collect: bool = True,
+) -> Dict[str, Optional[dict]]:
+    """Wrapper sincrono di ``fetch_many_cig_details_async``."""
+    return asyncio.run(fetch_many_cig_details_async(
+        cigs, cache, concurrency, pool_size, on_result, batch_size, refresh_budget, collect
+    ))
+
+
+def fetch_cig_details(cig: str) -> Optional[dict]:
+    """High‑level helper: gets cookies/csrf and performs the data request."""
+    return fetch_many_cig_details([cig]).get(cig)
+
+
 def main():
+    # Set console to UTF-8 mode on Windows
+    if os.name == 'nt':
+        os.system('chcp 65001')
+
     if len(sys.argv) < 2:
         print("Usage: python superset_cig_fetch.py <CIG> [output_file.json]")
         sys.exit(1)
 
     cig = sys.argv[1].strip().upper()
-    
-    if len(sys.argv) >= 3:
-        output_file = sys.argv[2]
-        output_file = os.path.abspath(output_file)
-        print(f"Percorso file di output (assoluto): {output_file}")
-    else:
-        output_file = f"CIG_{cig}.json"
-    
-    data = None
-    
+    output_file = Path(sys.argv[2] if len(sys.argv) >= 3 else f"CIG_{cig}.json").absolute()
+
+    print(f"Recupero dati per il CIG: {cig}")
     try:
-        print(f"Recupero dati per il CIG: {cig}")
         data = fetch_cig_details(cig)
-        
         if data is None:
             print(f"Impossibile recuperare i dati dopo {MAX_RETRIES} tentativi.")
             print("Suggerimenti:")
@@ -373,23 +1013,10 @@ def main():
             print("- Il server ANAC potrebbe essere sovraccarico")
             print("- Verifica che il CIG sia corretto e completo")
             sys.exit(2)
-        
-        output_dir = os.path.dirname(output_file)
-        if output_dir:
-            print(f"Creazione directory: {output_dir}")
-            os.makedirs(output_dir, exist_ok=True)
-        
-        print(f"Tentativo di salvataggio in: {output_file}")
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        
-        if os.path.exists(output_file):
-            print(f"Dati salvati con successo nel file: {output_file}")
-            file_size = os.path.getsize(output_file)
-            print(f"Dimensione file: {file_size} bytes")
-        else:
-            print(f"ERRORE: Il file non è stato creato: {output_file}")
-        
+
+        _write_json_atomic(output_file, data)
+        print(f"Dati salvati con successo nel file: {output_file} "
+              f"({output_file.stat().st_size} bytes)")
     except Exception as exc:
         print(f"ERRORE: {exc}")
         sys.exit(2)
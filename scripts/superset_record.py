@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+superset_record.py
+==================
+
+Vista sui dettagli Superset di un CIG con decodifica pigra delle colonne JSON.
+
+Superset restituisce ``stazione_appaltante``, ``bando``, ``categorie_opera``,
+``incaricati`` e le altre colonne di ``EMBEDDED_JSON_COLUMNS`` come stringhe
+con JSON incorporato; dentro ``bando`` anche campi come ``CPV`` o ``CUP``
+possono arrivare come stringa. ``CigRecord`` decodifica ogni colonna (e ogni
+campo annidato) al primo accesso e conserva il risultato: tutte le fasi che
+ricevono lo stesso record (enti, CPV, gare e lotti) condividono le stesse
+viste decodificate.
+
+Valori vuoti, ``"N/A"`` o non decodificabili diventano ``None``, quindi chi
+legge usa ``get_dict`` / ``get_list`` e non deve più controllare se il
+valore è una stringa da convertire.
+
+Il record accetta sia le colonne grezze di Superset sia colonne già
+decodificate (per esempio rilette da un vecchio ``bandi_completi.json``).
+I campi da salvare vengono poi estratti in ``bandi_model.CigDetail``.
+"""
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, Hashable, List, Optional
+
+EMBEDDED_JSON_COLUMNS = (
+    "stazione_appaltante",
+    "bando",
+    "categorie_opera",
+    "quadro_economico",
+    "template",
+    "incaricati",
+    "pubblicazioni",
+)
+_MISSING = {"", "N/A", "NULL", "NONE"}
+
+
+def decode_json(value: Any) -> Any:
+    """Decodifica una stringa JSON; dict e liste passano invariati."""
+    if not isinstance(value, str):
+        return value
+    text = value.strip()
+    if text.upper() in _MISSING:
+        return None
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+
+class CigRecord:
+    """Colonne Superset di un CIG, decodificate una sola volta al primo accesso."""
+
+    __slots__ = ("_raw", "_decoded")
+
+    def __init__(self, columns: Optional[Dict[str, Any]] = None):
+        self._raw: Dict[str, Any] = columns or {}
+        self._decoded: Dict[Hashable, Any] = {}
+
+    @classmethod
+    def from_superset(cls, cig_data: Optional[dict]) -> "CigRecord":
+        """Record dalla risposta chart/data di Superset (prima riga)."""
+        if not cig_data:
+            return cls()
+        try:
+            item = (cig_data.get("result") or [{}])[0].get("data") or [{}]
+            item = item[0]
+        except (AttributeError, IndexError, TypeError) as exc:
+            print(f"⚠️  risposta Superset non valida: {exc}")
+            return cls()
+        return cls({k: item.get(k) for k in EMBEDDED_JSON_COLUMNS})
+
+    @classmethod
+    def wrap(cls, value: Any) -> "CigRecord":
+        """Restituisce ``value`` se è già un record, altrimenti lo avvolge."""
+        if isinstance(value, cls):
+            return value
+        return cls(value if isinstance(value, dict) else None)
+
+    def get(self, column: str, default: Any = None) -> Any:
+        try:
+            value = self._decoded[column]
+        except KeyError:
+            value = self._decoded[column] = decode_json(self._raw.get(column))
+        return default if value is None else value
+
+    def get_dict(self, column: str) -> Dict[str, Any]:
+        value = self.get(column)
+        return value if isinstance(value, dict) else {}
+
+    def get_list(self, column: str) -> List[Any]:
+        value = self.get(column)
+        return value if isinstance(value, list) else []
+
+    def nested(self, column: str, key: str, default: Any = None) -> Any:
+        """Campo ``key`` dell'oggetto in ``column``, decodificato se stringa JSON."""
+        cache_key = (column, key)
+        try:
+            value = self._decoded[cache_key]
+        except KeyError:
+            value = self._decoded[cache_key] = decode_json(self.get_dict(column).get(key))
+        return default if value is None else value
+
+    def nested_list(self, column: str, key: str) -> List[Any]:
+        value = self.nested(column, key)
+        return value if isinstance(value, list) else []
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Colonne decodificate, per il salvataggio in JSON."""
+        return {column: self.get(column) for column in self._raw}
+
+    def __bool__(self) -> bool:
+        return any(value is not None for value in self._raw.values())
+
+    def __repr__(self) -> str:
+        return f"CigRecord({sorted(self._raw)})"
@@ -0,0 +1,26 @@
+"""Fixture comuni: le pipeline girano contro i server locali di bench_pipeline."""
+from __future__ import annotations
+
+import argparse
+import sys
+from pathlib import Path
+
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[1]
+if str(SCRIPTS) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS))
+
+
+@pytest.fixture(scope="session")
+def bench():
+    """Server locali di Pubblicità Legale, Superset e PostgREST (vedi bench_pipeline).
+
+    Le variabili d'ambiente vengono impostate prima che i test importino le
+    pipeline, che le leggono all'import.
+    """
+    from bench_pipeline import Bench
+    bench = Bench(argparse.Namespace(latency_ms=0, error_rate=0, seed=0, page_rate=0,
+                                     verbose=False, superset_batch=0, loader="postgrest"))
+    yield bench
+    bench.close()
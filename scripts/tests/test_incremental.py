@@ -0,0 +1,53 @@
+"""Run incrementale: avvisi saltati, solo riscritti o rielaborati (filter_incremental)."""
+from __future__ import annotations
+
+import pytest
+
+from bench_pipeline import Dataset
+
+
+@pytest.fixture
+def incrementale(bench, monkeypatch, tmp_path):
+    """Pipeline con registro e cache CIG vuoti e avvisi di un giorno di prova."""
+    import unified_data_pipelineGPT as pipeline
+    from avvisi_watermark import AvvisiWatermark
+    from cig_store import CigStore
+
+    dataset = Dataset.generate(6)
+    bench._reset(dataset, tmp_path)
+    monkeypatch.setattr(pipeline, "cig_store", CigStore(tmp_path / "cig.sqlite"))
+    avvisi = [pipeline.Avviso.from_api(a) for a in dataset.avvisi]
+    return pipeline, AvvisiWatermark(tmp_path / "avvisi_watermark.sqlite"), avvisi
+
+
+def _carica(bench, avvisi, con_lotto):
+    """Righe avviso_gara (e lotto per ``con_lotto``) come dopo un run precedente."""
+    for n, avviso in enumerate(avvisi):
+        bench.sink.seed("avviso_gara", [{**avviso.avviso_row(), "gara_id": f"gara-{n}"}])
+        if avviso.id_avviso in con_lotto:
+            bench.sink.seed("lotto", [{"cig": avviso.cig, "gara_id": f"gara-{n}"}])
+
+
+def test_avviso_senza_lotto_rielaborato(bench, incrementale):
+    pipeline, watermark, avvisi = incrementale
+    completo, parziale = avvisi[0], avvisi[1]
+    _carica(bench, [completo, parziale], con_lotto={completo.id_avviso})
+
+    todo = pipeline.filter_incremental(avvisi, watermark)
+
+    assert completo not in todo
+    assert parziale in todo                 # gara scritta solo in parte: si ripara
+    assert set(watermark.get_many(a.id_avviso for a in avvisi)) == {completo.id_avviso}
+
+
+def test_avviso_invariato_con_cig_scaduto_rielaborato(incrementale):
+    pipeline, watermark, avvisi = incrementale
+    watermark.mark(avvisi)
+    scaduto, fresco = avvisi[0], avvisi[1]
+    for avviso in (scaduto, fresco):
+        pipeline.cig_store.put(avviso.cig, {"result": [{"data": [{"cig": avviso.cig}]}]})
+    pipeline.cig_store._conn.execute("UPDATE cig_detail SET expires_at = 0 WHERE cig = ?",
+                                     (scaduto.cig,))
+
+    assert pipeline.filter_incremental(avvisi, watermark) == []
+    assert pipeline.filter_incremental(avvisi, watermark, refresh_limit=10) == [scaduto]
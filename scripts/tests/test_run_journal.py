@@ -0,0 +1,107 @@
+"""Ripresa di un run interrotto con ``--resume`` (run_journal)."""
+from __future__ import annotations
+
+import json
+import sys
+
+import pytest
+
+from bench_pipeline import BENCH_DATE, Dataset, SupersetStub
+
+
+class Interrotto(Exception):
+    pass
+
+
+@pytest.fixture
+def richiesti(monkeypatch):
+    """CIG richiesti a ``chart/data`` dello stub Superset."""
+    cigs = []
+    handle = SupersetStub.handle
+
+    def _handle(self, req, method, path, query, body):
+        if path.startswith("/api/v1/chart/data"):
+            q = json.loads(body)["queries"][0]
+            cigs.extend(next((f["val"] for f in q.get("filters") or [] if f.get("op") == "IN"),
+                             [q.get("url_params", {}).get("cig")]))
+        return handle(self, req, method, path, query, body)
+
+    monkeypatch.setattr(SupersetStub, "handle", _handle)
+    return cigs
+
+
+def _run(pipeline, run_dir, *extra):
+    argv = ["unified_data_pipelineGPT.py", "--date", BENCH_DATE, "--refresh-budget", "0",
+            "--full", "--report", str(run_dir / "run_report.json"), *extra]
+    saved, sys.argv = sys.argv, argv
+    try:
+        pipeline.main()
+    except SystemExit as exc:
+        return exc.code
+    finally:
+        sys.argv = saved
+
+
+def test_resume_ritenta_cig_falliti(bench, richiesti, monkeypatch, tmp_path):
+    import unified_data_pipelineGPT as pipeline
+    from cig_store import CigStore
+
+    dataset = Dataset.generate(60)
+    cigs = sorted({pipeline.extract_cig_from_bando(pipeline.Avviso.from_api(a))
+                   for a in dataset.avvisi})
+    fallito = cigs[0]
+    dettaglio = dataset.superset.pop(fallito)   # Superset non lo restituisce
+    bench._reset(dataset, tmp_path)
+    monkeypatch.setattr(pipeline, "cig_store", CigStore(tmp_path / "cig.sqlite"))
+    monkeypatch.setattr(pipeline, "WATERMARK_PATH", tmp_path / "avvisi_watermark.sqlite")
+    monkeypatch.setattr(pipeline, "CHANGE_INDEX_PATH", tmp_path / "righe_scritte.sqlite")
+    monkeypatch.setattr(pipeline, "LOCAL_DIR", tmp_path)
+    # Coda minima: il fetcher non può finire prima dell'interruzione
+    monkeypatch.setattr(pipeline, "STREAM_QUEUE", 1)
+
+    # Primo run: interrotto durante il download Superset, dopo il CIG fallito
+    merge_data = pipeline.merge_data
+    uniti = []
+
+    def _merge_interrotto(bando, cig_data):
+        uniti.append(bando)
+        if len(uniti) == len(cigs) // 2:
+            raise Interrotto()
+        return merge_data(bando, cig_data)
+
+    monkeypatch.setattr(pipeline, "merge_data", _merge_interrotto)
+    with pytest.raises(Interrotto):
+        _run(pipeline, tmp_path)
+    assert fallito in richiesti
+    assert pipeline.cig_store.get_many([fallito]) == {}
+
+    # Ripresa: il CIG ora è disponibile e deve essere richiesto di nuovo
+    dataset.superset[fallito] = dettaglio
+    monkeypatch.setattr(pipeline, "merge_data", merge_data)
+    richiesti.clear()
+    assert _run(pipeline, tmp_path, "--resume") == 0
+    assert fallito in richiesti
+    assert fallito in pipeline.cig_store.get_many([fallito])
+    # I CIG scaricati prima dell'interruzione escono dalla cache
+    assert len(set(richiesti)) < len(cigs)
+
+
+def test_giorno_completo_con_cig_non_disponibili(bench, monkeypatch, tmp_path):
+    import unified_data_pipelineGPT as pipeline
+    from cig_store import CigStore
+    from run_journal import RunJournal, journal_path
+
+    dataset = Dataset.generate(20)
+    cigs = sorted({pipeline.extract_cig_from_bando(pipeline.Avviso.from_api(a))
+                   for a in dataset.avvisi})
+    dataset.superset.pop(cigs[0])     # nella cache negativa dopo il run
+    bench._reset(dataset, tmp_path)
+    monkeypatch.setattr(pipeline, "cig_store", CigStore(tmp_path / "cig.sqlite"))
+    monkeypatch.setattr(pipeline, "WATERMARK_PATH", tmp_path / "avvisi_watermark.sqlite")
+    monkeypatch.setattr(pipeline, "CHANGE_INDEX_PATH", tmp_path / "righe_scritte.sqlite")
+    monkeypatch.setattr(pipeline, "LOCAL_DIR", tmp_path)
+
+    assert _run(pipeline, tmp_path) == 0
+    # L'avviso senza dettaglio non può essere scritto: il giorno è comunque completo
+    with RunJournal(journal_path(tmp_path, "bandi", BENCH_DATE, BENCH_DATE), resume=True) as journal:
+        assert journal.done("giorno", [BENCH_DATE])
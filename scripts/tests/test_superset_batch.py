@@ -0,0 +1,77 @@
+"""Richieste multi-CIG di superset_cig_fetch (``--superset-batch``)."""
+from __future__ import annotations
+
+import asyncio
+import json
+
+import pytest
+
+
+@pytest.fixture
+def fetch(bench):
+    """Il modulo legge gli URL all'import: prima le variabili di ``bench``."""
+    import superset_cig_fetch
+    return superset_cig_fetch
+
+
+def _run_batched(fetch, monkeypatch, cigs, risposta, batch_size=4):
+    """Esegue ``_fetch_batched`` con ``risposta(chunk) -> (trovati, righe estranee)``."""
+    richieste = []
+
+    async def _fake_fetch_batch(chunk, pool):
+        richieste.append(list(chunk))
+        return risposta(chunk)
+
+    monkeypatch.setattr(fetch, "_fetch_batch", _fake_fetch_batch)
+    stored = {}
+    fallback = asyncio.run(fetch._fetch_batched(cigs, None, batch_size, 1, stored.__setitem__))
+    return richieste, stored, fallback
+
+
+def test_batch_vuoto_non_disattiva_il_batching(fetch, monkeypatch):
+    inesistenti = [f"X{i:09d}" for i in range(4)]
+    validi = [f"A{i:09d}" for i in range(8)]
+
+    def _risposta(chunk):
+        return {cig: {"cig": cig} for cig in chunk if cig.startswith("A")}, 0
+
+    richieste, stored, fallback = _run_batched(fetch, monkeypatch, inesistenti + validi, _risposta)
+    # Il primo batch è vuoto: solo i suoi CIG passano alla richiesta singola
+    assert fallback == inesistenti
+    assert set(stored) == set(validi)
+    assert all(len(chunk) > 1 for chunk in richieste)
+
+
+def test_filtro_in_ignorato_disattiva_il_batching(fetch, monkeypatch):
+    cigs = [f"A{i:09d}" for i in range(12)]
+
+    def _risposta(chunk):
+        # Il dataset restituisce righe qualsiasi, non quelle richieste
+        return {}, 25
+
+    richieste, stored, fallback = _run_batched(fetch, monkeypatch, cigs, _risposta)
+    assert len(richieste) == 1
+    assert stored == {}
+    assert sorted(fallback) == cigs
+
+
+def test_foreign_rows(fetch):
+    def _row(cig):
+        return {"bando": json.dumps({"CIG": cig})}
+
+    data = {"result": [{"data": [_row("A1"), _row("a2"), _row("B9")]}]}
+    assert fetch._foreign_rows(data, ["A1", "A2"]) == 1
+    assert fetch._foreign_rows({"result": [{"data": []}]}, ["A1"]) == 0
+
+
+def test_sessione_non_ottenuta_ripiega_sulla_richiesta_singola(fetch):
+    class _PoolGuasto:
+        async def acquire(self, cig):
+            raise RuntimeError("bootstrap Chromium fallito")
+
+    cigs = [f"A{i:09d}" for i in range(6)]
+    assert asyncio.run(fetch._fetch_batch(cigs, _PoolGuasto())) is None
+    stored = {}
+    fallback = asyncio.run(fetch._fetch_batched(cigs, _PoolGuasto(), 4, 2, stored.__setitem__))
+    assert stored == {}
+    assert sorted(fallback) == cigs
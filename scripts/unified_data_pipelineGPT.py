@@ -23,22 +23,35 @@ La dimensione *ruolo* (prevalente `P` / scorporabile `S`) **non** risiede più
 from __future__ import annotations
 
 import argparse
-import asyncio
-import json
+import contextlib
+import itertools
 import os
-import subprocess
+import queue
 import sys
+import threading
 import time
-import uuid
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
-import requests
 from dotenv import load_dotenv
-from playwright.async_api import async_playwright
 from supabase import Client, create_client
 
+import http_archive
+from avvisi_watermark import AvvisiWatermark
+from change_index import ChangeIndex
+from cig_store import CigStore
+from bandi_model import Avviso, Bando, CigDetail, GaraPayload, LottoPayload
+from superset_record import CigRecord
+from normalizzazione import Normalizzatore
+from merged_ndjson import SUFFIX as MERGED_SUFFIX, NdjsonWriter, iter_records
+from run_trace import LEVELS, TRACER, debug, print_summary, set_level
+from pg_loader import DB_URL_ENV, PgUpserter, default_dsn
+from run_journal import RunJournal, journal_path
+from supabase_batch import BatchUpserter, rpc_batched
+from superset_cig_fetch import fetch_many_cig_details
+
 # ---------------------------------------------------------------------------
 # CONFIGURAZIONE & COSTANTI
 # ---------------------------------------------------------------------------
@@ -54,18 +67,29 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # Percorsi file e script
-LOCAL_DIR = Path("c:\\Users\\MADEINSICILY1\\Desktop\\BancaDati\\v0\\local")
-CIG_CACHE_DIR = LOCAL_DIR / "cig_completi"
-SCRIPTS_DIR = Path("c:\\Users\\MADEINSICILY1\\Desktop\\BancaDati\\v0\\scripts")
-FETCH_SCRIPT = SCRIPTS_DIR / "superset_cig_fetch.py"
-PARSER_SCRIPT = SCRIPTS_DIR / "superset_cig_parser.py"
+LOCAL_DIR = Path(os.getenv("PIPELINE_LOCAL_DIR", "c:\\Users\\MADEINSICILY1\\Desktop\\BancaDati\\v0\\local"))
+# Cache dettagli CIG (SQLite compresso). La vecchia cache a directory
+# "cig_completi" si importa con: python cig_store.py import <dir> --db <file>
+CIG_STORE_PATH = LOCAL_DIR / "cig_completi.sqlite"
+# Avvisi già caricati, per i run incrementali (vedi avvisi_watermark.py)
+WATERMARK_PATH = LOCAL_DIR / "avvisi_watermark.sqlite"
+# Hash delle righe scritte, per saltare gli upsert invariati (vedi change_index.py)
+CHANGE_INDEX_PATH = LOCAL_DIR / "righe_scritte.sqlite"
 
 # Assicurati che le directory esistano
 LOCAL_DIR.mkdir(parents=True, exist_ok=True)
-CIG_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+cig_store = CigStore(CIG_STORE_PATH)
 
 # Configurazione download
 MAX_WORKERS = 4  # Numero di thread paralleli per il download
+PARALLEL_DAYS = 2  # Giorni elaborati in parallelo nel backfill (--from/--to)
+REFRESH_BUDGET = 50  # CIG in cache scaduti riscaricati per run (--refresh-budget)
+TENDER_RPC_BATCH = 200  # Gare per chiamata upsert_tenders (--loader rpc)
+STREAM_QUEUE = 200  # Dettagli CIG in attesa di merge/upload (backpressure sul fetcher)
+UPLOAD_BATCH = 200  # Bandi uniti per micro-batch di upload
+UPLOAD_MAX_WAIT = 5.0  # Secondi massimi prima di caricare un micro-batch incompleto
+AVVISO_LOOKUP_CHUNK = 150  # idAvviso per query ``in`` su avviso_gara (limite lunghezza URL)
 
 # ---------------------------------------------------------------------------
 # SEZIONE 1 – DOWNLOAD BANDI GIORNALIERI
@@ -73,10 +97,10 @@ MAX_WORKERS = 4  # Numero di thread paralleli per il download
 
 
 import datetime as dt
-import requests, time, math
-from typing import List, Dict
 
-BASE_URL = "https://pubblicitalegale.anticorruzione.it/api/v0/avvisi"
+from pubblicita_legale_fetch import IncompleteDownloadError, fetch_pages
+
+BASE_URL = os.getenv("PUBBLICITA_LEGALE_URL", "https://pubblicitalegale.anticorruzione.it/api/v0/avvisi")
 HEADERS  = {
     "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
                    "AppleWebKit/537.36 (KHTML, like Gecko) "
@@ -87,40 +111,26 @@ HEADERS  = {
 PAGE_SIZE = 100                # valore max accettato dall’API
 
 def fetch_avvisi_legali(date: dt.date,
-                        codice_scheda: str = "2,4") -> List[Dict]:
-    """Scarica tutti gli avvisi pubblicati in una certa data."""
+                        codice_scheda: str = "2,4") -> List[Avviso]:
+    """Scarica tutti gli avvisi pubblicati in una certa data.
+
+    Le pagine successive alla prima vengono scaricate in parallelo (vedi
+    ``pubblicita_legale_fetch.fetch_pages``); se qualche pagina manca anche
+    dopo i retry viene sollevata ``IncompleteDownloadError``. Ogni avviso
+    viene ridotto a ``Avviso`` appena arriva la sua pagina.
+    """
     ds = date.strftime("%d/%m/%Y")   # formato richiesto 24/06/2025
     params_base = {
         "dataPubblicazioneStart": ds,
         "dataPubblicazioneEnd":   ds,
         "codiceScheda":           codice_scheda,
-        "size":                   PAGE_SIZE,
-        "page":                   0
     }
-    all_items: List[Dict] = []
-    while True:
-        try:
-            r = requests.get(BASE_URL, headers=HEADERS,
-                             params=params_base, timeout=30)
-            r.raise_for_status()
-            payload = r.json()
-        except Exception as exc:
-            print(f"⚠️  errore HTTP/API pagina {params_base['page']}: {exc}")
-            break
 
-        content = payload.get("content", [])          # struttura Spring-Page
-        total   = payload.get("totalElements", 0)
-        all_items.extend(content)
+    def _log(page: int, tot_pages: int, n_items: int) -> None:
+        debug("  ↳ scaricata pagina %d/%d (%d avvisi)", page + 1, tot_pages, n_items)
 
-        # log friendly
-        tot_pages = math.ceil(total / PAGE_SIZE) if total else "?"
-        print(f"  ↳ scaricata pagina {params_base['page']+1}/{tot_pages} "
-              f"({len(content)} avvisi)")
-
-        if payload.get("last", True):
-            break
-        params_base["page"] += 1
-        time.sleep(0.5)     # antidoto rate-limit
+    all_items = fetch_pages(BASE_URL, params_base, HEADERS, PAGE_SIZE, on_page=_log,
+                            transform=Avviso.from_api)
 
     print(f"✓ scaricati {len(all_items)} avvisi da Pubblicità Legale")
     return all_items
@@ -130,129 +140,191 @@ def fetch_avvisi_legali(date: dt.date,
 # SEZIONE 2 – DOWNLOAD DETTAGLI CIG (SUPERSET)
 # ---------------------------------------------------------------------------
 
-def extract_cig_from_bando(bando: Dict[str, Any]) -> Optional[str]:
-    """Prova a individuare un CIG all'interno del JSON del bando."""
-    template = (bando.get("template") or [{}])[0]
-    sections = template.get("template", {}).get("sections", [])
-    for section in sections:
-        if section.get("name") == "SEZ. C - Oggetto":
-            for item in section.get("items", []):
-                cig_val = item.get("cig") or item.get("CIG")
-                if cig_val:
-                    return cig_val.replace(" ", "")
-    return None
-
-
-def fetch_cig_details(cig: str) -> Optional[dict]:
-    """Scarica i dettagli del CIG utilizzando lo script superset_cig_fetch.py"""
-    output_file = CIG_CACHE_DIR / f"{cig}.json"
-    
-    # Verifica se il file esiste già
-    if output_file.exists():
-        print(f"  • CIG {cig} – già in cache")
+def extract_cig_from_bando(bando: Avviso) -> Optional[str]:
+    """CIG dell'avviso (dalla sezione "SEZ. C - Oggetto", vedi ``Avviso.from_api``)."""
+    return bando.cig
+
+
+def _righe_esistenti(table: str, column: str, values: List[str], columns: str) -> Dict[str, Dict]:
+    """Righe di ``table`` già presenti per ``values`` di ``column`` (valore → riga),
+    con query ``in`` a blocchi in parallelo. I blocchi che falliscono vengono
+    ignorati: i relativi avvisi si rielaborano."""
+    chunks = [values[i:i + AVVISO_LOOKUP_CHUNK] for i in range(0, len(values), AVVISO_LOOKUP_CHUNK)]
+
+    def _lookup(chunk: List[str]) -> List[Dict]:
         try:
-            with open(output_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"  ↳ errore lettura cache per CIG {cig}: {e}")
-            # Se c'è un errore nella lettura, procediamo con il download
-    
-    print(f"  • Scaricamento dettagli per CIG {cig}...")
+            response = supabase.table(table).select(columns).in_(column, chunk).execute()
+            return response.data or []
+        except Exception as exc:
+            print(f"⚠️  verifica {table} già caricati non riuscita ({len(chunk)} valori): {exc}")
+            return []
+
+    found: Dict[str, Dict] = {}
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(chunks))) as pool:
+            for rows in pool.map(_lookup, chunks):
+                found.update((row[column], row) for row in rows)
+    return found
+
+
+def _avvisi_esistenti(ids: List[str]) -> Dict[str, Dict]:
+    """Righe ``avviso_gara`` già presenti per ``ids`` (id → gara_id, data_scadenza)."""
+    return _righe_esistenti("avviso_gara", "id", ids, "id,gara_id,data_scadenza")
+
+
+def filter_incremental(bandi: List[Avviso], watermark: AvvisiWatermark,
+                       index: Optional[ChangeIndex] = None,
+                       refresh_limit: int = 0) -> List[Avviso]:
+    """Avvisi da elaborare in un run incrementale.
+
+    Gli avvisi registrati in ``watermark`` con la stessa impronta vengono
+    saltati; quelli mai registrati ma già presenti in ``avviso_gara`` (run
+    precedenti su un'altra macchina, registro cancellato) vengono solo
+    riscritti nella loro riga, senza Superset né gara/lotto, e registrati,
+    purché il lotto del loro CIG esista con la stessa gara: altrimenti la
+    gara è stata scritta solo in parte e l'avviso si rielabora.
+
+    L'impronta copre solo i campi dell'avviso: fra gli avvisi che verrebbero
+    saltati, quelli con il dettaglio CIG scaduto in cache (al più
+    ``refresh_limit`` CIG, vedi ``CigStore.stale_cigs``) vengono rielaborati,
+    così il refresh del dettaglio arriva anche a gara e lotto.
+    Restano gli avvisi nuovi o modificati.
+    """
+    with TRACER.span("avvisi.incrementale"):
+        unchanged, changed, unknown = watermark.classify(bandi)
+        existing = _avvisi_esistenti([a.id_avviso for a in unknown if a.id_avviso])
+        lotti = _righe_esistenti("lotto", "cig",
+                                 list({a.cig for a in unknown if a.cig and a.id_avviso in existing}),
+                                 "cig,gara_id")
+        candidates: List[Avviso] = []
+        for avviso in unknown:
+            row = existing.get(avviso.id_avviso)
+            lotto = lotti.get(avviso.cig) if avviso.cig else None
+            if row is not None and lotto is not None and lotto["gara_id"] == row["gara_id"]:
+                candidates.append(avviso)
+
+        # Dettaglio CIG scaduto: l'avviso passa dal refresh invece di essere saltato
+        stale: Set[str] = set()
+        if refresh_limit > 0:
+            stale = set(cig_store.stale_cigs({a.cig for a in unchanged + candidates if a.cig},
+                                             limit=refresh_limit))
+        riaperti = [a for a in unchanged if a.cig in stale]
+        unchanged = [a for a in unchanged if a.cig not in stale]
+        candidates = [a for a in candidates if a.cig not in stale]
+
+        touched: List[Avviso] = []
+        if candidates:
+            writer = BatchUpserter(supabase, index=index)
+            by_id: Dict[str, Avviso] = {}
+            for avviso in candidates:
+                row = existing[avviso.id_avviso]
+                by_id[avviso.id_avviso] = avviso
+                touch = {**avviso.avviso_row(), "gara_id": row["gara_id"]}
+                if row.get("data_scadenza") is None:
+                    touch["data_scadenza"] = None     # affidamento diretto: resta vuota
+                writer.add("avviso_gara", touch, on_conflict="id")
+            touched = [by_id[i] for i in writer.flush("avviso_gara").written if i in by_id]
+            watermark.mark(touched)
+    TRACER.count("avvisi.invariati", len(unchanged))
+    TRACER.count("avvisi.toccati", len(touched))
+    TRACER.count("avvisi.scaduti", len(riaperti))
+    done = {id(a) for a in unchanged} | {id(a) for a in touched}
+    todo = [a for a in bandi if id(a) not in done]
+    if unchanged or touched or riaperti:
+        print(f"↷  {len(unchanged) + len(touched)} avvisi già caricati "
+              f"({len(unchanged)} invariati, {len(touched)} solo riscritti), "
+              f"{len(todo)} da elaborare ({len(changed)} modificati, "
+              f"{len(riaperti)} con dettaglio CIG scaduto)")
+    return todo
+
+
+class StreamAbandoned(Exception):
+    """Il consumatore di ``stream_cig_details`` ha smesso di leggere."""
+
+
+def stream_cig_details(cigs: Set[str], batch_size: int = 0, refresh_budget: int = 0,
+                       from_cache_only: bool = False) -> Iterator[Tuple[str, Optional[dict]]]:
+    """Produce (CIG, dettaglio) man mano che i dettagli arrivano.
+
+    Il fetcher Superset gira in un thread e consegna i risultati in una coda
+    limitata a ``STREAM_QUEUE`` elementi: se chi consuma (merge e upload) è
+    più lento, il fetcher si ferma finché la coda non si svuota. I CIG già in
+    cache escono subito, salvo al più ``refresh_budget`` voci scadute; con
+    ``from_cache_only`` si leggono solo quelli, senza avviare il browser.
+    Ogni CIG viene prodotto una volta sola, con ``None`` se il dettaglio
+    non è disponibile.
+    """
+    ordered = sorted(cigs)
+    if from_cache_only:
+        for i in range(0, len(ordered), STREAM_QUEUE):
+            chunk = ordered[i:i + STREAM_QUEUE]
+            cached = cig_store.get_many(chunk)
+            for cig in chunk:
+                yield cig, cached.get(cig)
+        return
+
+    results: "queue.Queue" = queue.Queue(maxsize=STREAM_QUEUE)
+    done = object()
+    stop = threading.Event()
+    errors: List[BaseException] = []
+
+    def _put(item: Any) -> None:
+        while True:
+            if stop.is_set():
+                # Chi consuma ha smesso: interrompe il fetch in corso
+                raise StreamAbandoned()
+            try:
+                results.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _produce() -> None:
+        try:
+            fetch_many_cig_details(ordered, cache=cig_store, concurrency=MAX_WORKERS,
+                                   on_result=lambda cig, data: _put((cig, data)),
+                                   batch_size=batch_size, refresh_budget=refresh_budget,
+                                   collect=False)
+        except StreamAbandoned:
+            return
+        except BaseException as exc:
+            errors.append(exc)
+        try:
+            _put(done)
+        except StreamAbandoned:
+            pass
+
+    producer = threading.Thread(target=_produce, name="cig-fetch", daemon=True)
+    producer.start()
     try:
-        # Assicurati che la directory esista
-        os.makedirs(CIG_CACHE_DIR, exist_ok=True)
-        
-        # Converti il percorso in stringa assoluta
-        output_file_str = str(output_file.absolute())
-        print(f"  • Percorso file output: {output_file_str}")
-        
-        # Esegui lo script superset_cig_fetch.py per ottenere i dettagli del CIG
-        result = subprocess.run(
-            [sys.executable, str(FETCH_SCRIPT), cig, output_file_str],
-            check=True,
-            capture_output=True,
-            text=True
-        )
-        print(f"  ✓ Dettagli per CIG {cig} salvati")
-        print(f"  ✓ Percorso file atteso: {output_file_str}")
-        print(f"  ✓ Output dello script: {result.stdout}")
-        
-        # Verifica che il file esista prima di tentare di leggerlo
-        if not output_file.exists():
-            print(f"  ↳ ERRORE: Il file non esiste dopo il salvataggio: {output_file_str}")
-            # Cerca il file nella directory principale
-            alt_file = LOCAL_DIR / f"CIG_{cig}.json"
-            if alt_file.exists():
-                print(f"  ✓ Trovato file alternativo: {alt_file}")
-                try:
-                    with open(alt_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    # Copia il file nella posizione corretta
-                    import shutil
-                    shutil.copy2(alt_file, output_file)
-                    print(f"  ✓ File copiato nella posizione corretta: {output_file}")
-                    return data
-                except Exception as e:
-                    print(f"  ↳ Errore durante la lettura/copia del file alternativo: {e}")
-            
-            # Se non troviamo il file alternativo, creiamo un file vuoto
-            print(f"  ↳ Creazione file vuoto: {output_file}")
-            os.makedirs(os.path.dirname(output_file), exist_ok=True)
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump({}, f)
-            return {}
-        
-        # Leggi il file appena creato
-        with open(output_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except subprocess.CalledProcessError as e:
-        print(f"  ↳ errore durante il download del CIG {cig}: {e}")
-        print(f"  ↳ output: {e.stdout if e.stdout else ''}")
-        print(f"  ↳ errore: {e.stderr if e.stderr else ''}")
-        return None
-    except Exception as e:
-        print(f"  ↳ errore generico per CIG {cig}: {e}")
-        return None
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        # Se chi consuma si interrompe, il fetcher non resta bloccato sulla coda
+        stop.set()
+        producer.join()
+    if errors:
+        raise errors[0]
 
 # ---------------------------------------------------------------------------
 # SEZIONE 3 – MERGING DATI BANDI + CIG
 # ---------------------------------------------------------------------------
 
-def merge_data(bando: Dict, cig_data: Dict) -> Dict:
-    """Unisce minimalmente le due fonti in un unico dict."""
-    merged = {
-        "bando_info": bando,
-        "cig_details": {},
-    }
-    if not cig_data:
-        return merged
-    try:
-        data_items = cig_data.get("result", [{}])[0].get("data", [])
-        if data_items:
-            item = data_items[0]
-            print(f"DEBUG merge_data: chiavi disponibili = {list(item.keys())}")  # ← AGGIUNGI QUESTA RIGA
-            # Alcune colonne sono stringhe con JSON incorporato
-            for k in [
-                "stazione_appaltante",
-                "bando",
-                "categorie_opera",
-                "quadro_economico",
-                "template",
-                "incaricati",
-                "pubblicazioni",
-            ]:
-                val = item.get(k)
-                print(f"DEBUG merge_data: campo '{k}' = {type(val)} - {str(val)[:100]}...")  # ← AGGIUNGI QUESTA RIGA
-                if isinstance(val, str):
-                    try:
-                        merged["cig_details"][k] = json.loads(val)
-                    except json.JSONDecodeError:
-                        merged["cig_details"][k] = val
-                else:
-                    merged["cig_details"][k] = val
-    except Exception as exc:
-        print(f"⚠️  merge_data: {exc}")
-    return merged
+def merge_data(bando: Avviso, cig_data: Any) -> Bando:
+    """Unisce l'avviso e il dettaglio del suo CIG.
+
+    ``cig_data`` è la risposta Superset, un ``CigRecord`` oppure un
+    ``CigDetail`` già estratto: i bandi con lo stesso CIG possono
+    condividere lo stesso dettaglio.
+    """
+    if cig_data is not None and not isinstance(cig_data, CigDetail):
+        if not isinstance(cig_data, CigRecord):
+            cig_data = CigRecord.from_superset(cig_data)
+        cig_data = CigDetail.from_record(cig_data)
+    return Bando(bando, cig_data)
 
 # ---------------------------------------------------------------------------
 # SEZIONE 4 – UPLOAD IN SUPABASE (funzioni complete)
@@ -327,688 +399,676 @@ def process_categorie_opera(bandi: List[Dict]) -> Dict[str, int]:
     return cat_map
 
 
-def process_categorie_cpv(bandi: List[Dict]) -> Dict[str, int]:
+def process_categorie_cpv(bandi: List[Bando], known: Optional[Dict[str, int]] = None,
+                          writer: Optional[BatchUpserter] = None) -> Dict[str, int]:
     """
-    Deduplica le categorie CPV (COD_CPV), esegue upsert su `categoria_cpv`
+    Deduplica le categorie CPV (COD_CPV), esegue upsert a blocchi su `categoria_cpv`
     e restituisce una mappa code → id (PK autoincrement di Supabase).
+    Le categorie già presenti in ``known`` (caricate in questo run) non vengono riscritte.
     """
-    print("Elaborazione categorie CPV…")
+    debug("Elaborazione categorie CPV…")
     seen: Dict[str, str] = {}           # code → descrizione
-    for item in bandi:
-        bando_data = item.get("cig_details", {}).get("bando", {})
-        if isinstance(bando_data, str):
-            try:
-                if bando_data.strip().upper() == "N/A":
-                    continue
-                bando_data = json.loads(bando_data)
-            except json.JSONDecodeError:
-                continue
-        
-        cpv_list = bando_data.get("CPV", [])
-        if not cpv_list:
+    for bando in bandi:
+        if bando.detail is None:
             continue
-        if isinstance(cpv_list, str):
-            try:
-                if cpv_list.strip().upper() == "N/A":
-                    continue
-                cpv_list = json.loads(cpv_list)
-            except json.JSONDecodeError:
-                continue
-        
-        for c in cpv_list:
-            code = c.get("COD_CPV")
-            desc = c.get("DESCRIZIONE_CPV")
+        for code, desc in bando.detail.cpv:
             if code and desc:
                 seen[code] = desc
 
-    cpv_map: Dict[str, int] = {}
+    cpv_map: Dict[str, int] = {code: known[code] for code in seen if known and code in known}
+    writer = writer or BatchUpserter(supabase)
     for code, desc in seen.items():
-        try:
-            res = (
-                supabase
-                .table("categoria_cpv")
-                .upsert(
-                    {"codice": code, "descrizione": desc},
-                    on_conflict="codice",
-                    returning="representation"
-                )
-                .execute()
-            )
-            cpv_map[code] = res.data[0]["id"]
-        except Exception as exc:
-            print(f"  ↳ errore categoria CPV {code}: {exc}")
+        if code not in cpv_map:
+            writer.add("categoria_cpv", {"codice": code, "descrizione": desc}, on_conflict="codice")
+    cpv_map.update(writer.flush("categoria_cpv", returning=True).ids)
 
     print(f"✔  {len(cpv_map)} categorie CPV inserite/aggiornate")
     return cpv_map
 
 
-def process_gare_e_lotti(bandi: List[Dict], enti_map: Dict[str, int], cat_map: Dict[str, int], cpv_map: Dict[str, int],
-                      natura_map: Dict[str, int], criterio_map: Dict[str, int], stato_map: Dict[str, int], tipo_procedura_map: Dict[str, int]):
-    """Elabora i dati di gare, lotti e avvisi."""
-    print("Elaborazione gare, lotti e avvisi…")
-    
-    # Debug: stampa i contenuti delle mappe
-    print(f"  ↳ natura_map contiene: {natura_map}")
-    print(f"  ↳ tipo_procedura_map contiene: {tipo_procedura_map}")
-    
-    gare = lotti = avvisi = links = 0
+def process_gare_e_lotti(bandi: List[Bando], enti_map: Dict[str, int], cat_map: Dict[str, int], cpv_map: Dict[str, int],
+                      natura_map: Dict[str, int], criterio_map: Dict[str, int], stato_map: Dict[str, int], tipo_procedura_map: Dict[str, int],
+                      writer: Optional[BatchUpserter] = None, use_rpc: bool = False):
+    """Elabora i dati di gare, lotti e avvisi.
+
+    Le righe vengono accumulate e scritte con upsert a blocchi (vedi
+    ``supabase_batch``): prima le gare, poi le tabelle che dipendono da
+    ``gara_id``, infine i collegamenti lotto-categoria. ``writer`` sceglie il
+    backend (default PostgREST; ``pg_loader.PgUpserter`` per COPY diretto).
+    Con ``use_rpc`` ogni gara diventa un documento annidato scritto dalla
+    funzione ``upsert_tenders`` (vedi ``_write_tenders_rpc``).
 
-    for merged in bandi:
-        info_bando   = merged.get("bando_info") or {}
-        cig_details  = merged.get("cig_details") or {}
-        bando_json   = cig_details.get("bando") or {}
-        sa           = cig_details.get("stazione_appaltante") or {}
-        template     = info_bando.get("template", [{}])[0]
-        sections     = template.get("template", {}).get("sections", [])
+    Restituisce gli ``idAvviso`` delle righe ``avviso_gara`` scritte.
+    """
+    debug("Elaborazione gare, lotti e avvisi…")
+
+    writer = writer or BatchUpserter(supabase)
+    norm = Normalizzatore()
+    gara_rows: Dict[str, Dict] = {}              # CIG → riga gara
+    rup_rows: Dict[str, Dict] = {}               # CIG → riga rup senza gara_id
+    pubblicazione_rows: Dict[str, Dict] = {}     # CIG → riga pubblicazione senza gara_id
+    avviso_rows: List[Tuple[str, Dict]] = []     # (CIG, riga avviso senza gara_id)
+    lotto_rows: Dict[str, Dict] = {}             # CIG → riga lotto senza gara_id
+    cat_links: Dict[str, List[Tuple[int, str]]] = {}  # CIG → [(categoria_opera_id, ruolo)]
+
+    normalize_start = time.perf_counter()
+    for bando in bandi:
+        avviso = bando.avviso
+        detail = bando.detail
 
         # ------------------------- GARA -------------------------
-        cig = bando_json.get("CIG") or bando_json.get("cig")
+        cig = detail.cig if detail else None
         if not cig:
             continue                        # niente CIG → saltiamo
 
-        ente_id = enti_map.get(sa.get("codice_fiscale")
-                               or sa.get("CF_AMMINISTRAZIONE_APPALTANTE"))
+        ente_id = enti_map.get(detail.ente.codice_fiscale) if detail.ente else None
         if not ente_id:
             continue                        # ente non caricato → saltiamo
 
-        # Estrai natura_principale, criterio_aggiudicazione, stato_procedura e tipo_procedura
-        natura_principale = None
-        criterio_aggiudicazione = None
-        stato_procedura = None
-        tipo_procedura = None
-        documenti_di_gara_link = None  # Nuovo campo per i link ai documenti di gara
-        
-        # Cerca nei dati del bando
-        for section in sections:
-            if section.get("name") == "SEZ. C - Oggetto":
-                items = section.get("items", [])
-                if items:
-                    natura_principale = items[0].get("natura_principale")
-                    criterio_aggiudicazione = items[0].get("criteri_aggiudicazione")
-                    documenti_di_gara_link = items[0].get("documenti_di_gara_link")  # Estrai il link ai documenti
-        
-        # Se non trovati, cerca nei dettagli CIG
-        if not natura_principale and bando_json.get("OGGETTO_PRINCIPALE_CONTRATTO"):
-            natura_principale = bando_json.get("OGGETTO_PRINCIPALE_CONTRATTO")
-        
-        # Estrai il tipo di procedura
-        if bando_json.get("TIPO_SCELTA_CONTRAENTE"):
-            tipo_procedura = bando_json.get("TIPO_SCELTA_CONTRAENTE")
-        elif bando_json.get("tipo_procedura_aggiudicazione"):
-            tipo_procedura = bando_json.get("tipo_procedura_aggiudicazione")
-        
-        
-        # Estrai il codice CPV dal bando
+        # natura_principale, criterio_aggiudicazione e link ai documenti dall'avviso
+        # ("SEZ. C - Oggetto"), con ripiego sul dettaglio CIG; stato e
+        # tipo_procedura dal dettaglio CIG
+        natura_principale = avviso.natura_principale or detail.oggetto_principale_contratto
+        criterio_aggiudicazione = avviso.criterio_aggiudicazione or detail.criterio_aggiudicazione
+        documenti_di_gara_link = avviso.documenti_di_gara_link
+
+        # CPV principale: il primo della lista
         cpv_id = None
-        cpv_list = bando_json.get("CPV", [])
-        if cpv_list:
-            if isinstance(cpv_list, str):
-                try:
-                    if cpv_list.strip().upper() != "N/A":
-                        cpv_list = json.loads(cpv_list)
-                    else:
-                        cpv_list = []
-                except json.JSONDecodeError:
-                    cpv_list = []
-            
-            # Prendi il primo CPV dalla lista (principale)
-            if cpv_list and isinstance(cpv_list, list) and len(cpv_list) > 0:
-                cpv_code = cpv_list[0].get("COD_CPV")
-                if cpv_code and cpv_code in cpv_map:
-                    cpv_id = cpv_map.get(cpv_code)
-                    print(f"  ↳ CPV trovato: {cpv_code} -> ID: {cpv_id}")
-
-        if not natura_principale and bando_json.get("OGGETTO_PRINCIPALE_CONTRATTO"):
-            natura_principale = bando_json.get("OGGETTO_PRINCIPALE_CONTRATTO")
-           # Aggiungi logging per diagnosticare il problema
+        if detail.cpv:
+            cpv_id = cpv_map.get(detail.cpv[0][0])
+
         if not natura_principale:
-            print(f"  ⚠️ Natura principale non trovata per CIG {cig}")
-            # Stampa le sezioni per vedere se c'è la sezione "SEZ. C - Oggetto"
-            print(f"  ↳ Sezioni disponibili: {[s.get('name') for s in sections]}")
-            # Stampa i campi disponibili in bando_json
-            print(f"  ↳ Campi in bando_json: {list(bando_json.keys())}")
-        else:
-            # Stampa il valore trovato e se è stato mappato correttamente
-            natura_norm = natura_principale.lower()
-            mapped = False
-            if "lavori" in natura_norm:
-                mapped = True
-            elif "forniture" in natura_norm or "fornitura" in natura_norm:
-                mapped = True
-            elif "servizi" in natura_norm or "servizio" in natura_norm:
-                mapped = True
-            if not mapped:
-                print(f"  ⚠️ Natura principale trovata ma non mappata: '{natura_principale}'")
-            
-        if not criterio_aggiudicazione and bando_json.get("CRITERIO_AGGIUDICAZIONE"):
-            criterio_aggiudicazione = bando_json.get("CRITERIO_AGGIUDICAZIONE")
-            
-        # Per stato_procedura, usa lo stato dal bando
-        if bando_json.get("STATO"):
-            stato_procedura = bando_json.get("STATO")
-        
+            debug("  ⚠️ Natura principale non trovata per CIG %s", cig)
+
         # Mappa i valori testuali agli ID delle tabelle di lookup
-        natura_principale_id = None
-        if natura_principale:
-            # Dizionario di mappatura per natura_principale
-            natura_mapping = {
-                "lavori": "works",
-                "work": "works",
-                "works": "works",
-                "forniture": "goods",
-                "fornitura": "goods",
-                "good": "goods",
-                "goods": "goods",
-                "servizi": "services",
-                "servizio": "services",
-                "service": "services",
-                "services": "services"
-            }
-            
-            # Normalizza e cerca nella mappa
-            natura_norm = natura_principale.lower()
-            
-            # Aggiungi debug per vedere cosa contiene natura_principale
-            print(f"  ↳ Natura principale trovata: '{natura_principale}', normalizzata: '{natura_norm}'")
-            print(f"  ↳ Natura map contiene: {natura_map}")
-            
-            # Prima verifica se il valore normalizzato è esattamente uguale a una delle chiavi
-            if natura_norm in natura_mapping:
-                natura_principale_id = natura_map.get(natura_mapping[natura_norm])
-                print(f"  ↳ Mappato esattamente a {natura_mapping[natura_norm]} -> {natura_principale_id}")
-            else:
-                # Altrimenti cerca se una delle chiavi è contenuta nel valore normalizzato
-                for key, value in natura_mapping.items():
-                    if key in natura_norm:
-                        natura_principale_id = natura_map.get(value)
-                        print(f"  ↳ Mappato parzialmente a {value} -> {natura_principale_id}")
-                        break
-                    
-                    if not natura_principale_id:
-                        print(f"  ⚠️ Natura principale non mappata: '{natura_principale}'")
-            
-        criterio_aggiudicazione_id = None
-        if criterio_aggiudicazione:
-            # Dizionario di mappatura per criterio_aggiudicazione
-            criterio_mapping = {
-                "prezzo": "price",
-                "price": "price",
-                "qualità": "quality",
-                "qualita": "quality",
-                "quality": "quality",
-                "costo": "quality",
-                "cost": "quality",
-                "economicamente vantaggiosa": "quality",  # Spesso si riferisce a qualità-prezzo
-                "offerta economicamente vantaggiosa": "quality"
-            }
-            
-            # Normalizza e cerca nella mappa
-            criterio_norm = criterio_aggiudicazione.lower()
-            
-            # Aggiungi debug per vedere cosa contiene criterio_aggiudicazione
-            print(f"  ↳ Criterio aggiudicazione trovato: '{criterio_aggiudicazione}', normalizzato: '{criterio_norm}'")
-            print(f"  ↳ Criterio map contiene: {criterio_map}")
-            
-            # Prima verifica se il valore normalizzato è esattamente uguale a una delle chiavi
-            if criterio_norm in criterio_mapping:
-                criterio_aggiudicazione_id = criterio_map.get(criterio_mapping[criterio_norm])
-                print(f"  ↳ Mappato esattamente a {criterio_mapping[criterio_norm]} -> {criterio_aggiudicazione_id}")
-            else:
-                # Altrimenti cerca se una delle chiavi è contenuta nel valore normalizzato
-                for key, value in criterio_mapping.items():
-                    if key in criterio_norm:
-                        criterio_aggiudicazione_id = criterio_map.get(value)
-                        print(f"  ↳ Mappato parzialmente a {value} -> {criterio_aggiudicazione_id}")
-                        break
-                
-                if not criterio_aggiudicazione_id:
-                    print(f"  ⚠️ Criterio aggiudicazione non mappato: '{criterio_aggiudicazione}'")
-        
-        stato_procedura_id = None
-        if stato_procedura:
-            # Dizionario di mappatura per stato_procedura
-            stato_mapping = {
-                "programmazione": "planning",
-                "planning": "planning",
-                "attivo": "active",
-                "in corso": "active",
-                "active": "active",
-                "concluso": "complete",
-                "conclusa": "complete",
-                "complete": "complete",
-                "annullato": "cancelled",
-                "annullata": "cancelled",
-                "cancelled": "cancelled",
-                "senza esito": "unsuccessful",
-                "unsuccessful": "unsuccessful"
-            }
-            
-            # Normalizza e cerca nella mappa
-            stato_norm = stato_procedura.lower()
-            
-            # Aggiungi debug per vedere cosa contiene stato_procedura
-            print(f"  ↳ Stato procedura trovato: '{stato_procedura}', normalizzato: '{stato_norm}'")
-            print(f"  ↳ Stato map contiene: {stato_map}")
-            
-            # Prima verifica se il valore normalizzato è esattamente uguale a una delle chiavi
-            if stato_norm in stato_mapping:
-                stato_procedura_id = stato_map.get(stato_mapping[stato_norm])
-                print(f"  ↳ Mappato esattamente a {stato_mapping[stato_norm]} -> {stato_procedura_id}")
-            else:
-                # Altrimenti cerca se una delle chiavi è contenuta nel valore normalizzato
-                for key, value in stato_mapping.items():
-                    if key in stato_norm:
-                        stato_procedura_id = stato_map.get(value)
-                        print(f"  ↳ Mappato parzialmente a {value} -> {stato_procedura_id}")
-                        break
-                
-                if not stato_procedura_id:
-                    print(f"  ⚠️ Stato procedura non mappato: '{stato_procedura}'")
-                    # Usa active come default se non è stato possibile mappare
-                    stato_procedura_id = stato_map.get("active")  # Default
-                    print(f"  ↳ Usando valore default 'active' -> {stato_procedura_id}")
-
-            # Inizializza tipo_procedura_id prima del blocco di debug
-            tipo_procedura_id = None
-            if tipo_procedura:
-                # Dizionario di mappatura per tipo_procedura
-                tipo_procedura_mapping = {
-                    "aperta": "open",
-                    "open": "open",
-                    "ristretta": "restricted",
-                    "restricted": "restricted",
-                    "negoziata": "negotiated",
-                    "negotiated": "negotiated",
-                    "competitiva": "competitive_dialogue",
-                    "competitive": "competitive_dialogue",
-                    "dialogo": "competitive_dialogue",
-                    "dialogue": "competitive_dialogue",
-                    "competitive_dialogue": "competitive_dialogue",
-                    "diretto": "direct",
-                    "direct": "direct",
-                    "affidamento": "direct",
-                    "affidamento diretto": "direct" 
-                }
-                # Normalizza e cerca nella mappa
-                tipo_procedura_norm = tipo_procedura.lower()
-                
-                # Aggiungi debug per vedere cosa contiene tipo_procedura
-                print(f"  ↳ Tipo procedura trovato: '{tipo_procedura}', normalizzato: '{tipo_procedura_norm}'")
-                
-                # Prima verifica se il valore normalizzato è esattamente uguale a una delle chiavi
-                if tipo_procedura_norm in tipo_procedura_mapping:
-                    tipo_procedura_id = tipo_procedura_map.get(tipo_procedura_mapping[tipo_procedura_norm])
-                    print(f"  ↳ Mappato esattamente a {tipo_procedura_mapping[tipo_procedura_norm]} -> {tipo_procedura_id}")
-                else:
-                    # Altrimenti cerca se una delle chiavi è contenuta nel valore normalizzato
-                    for key, value in tipo_procedura_mapping.items():
-                        if key in tipo_procedura_norm:
-                            tipo_procedura_id = tipo_procedura_map.get(value)
-                            print(f"  ↳ Mappato parzialmente a {value} -> {tipo_procedura_id}")
-                            break
-                    
-                    if not tipo_procedura_id:
-                        print(f"  ⚠️ Tipo procedura non mappato: '{tipo_procedura}'")
-                        # Usa open come default se non è stato possibile mappare
-                        tipo_procedura_id = tipo_procedura_map.get("open")  # Default
-                        print(f"  ↳ Usando valore default 'open' -> {tipo_procedura_id}")
-                
-                # Verifica se è una manifestazione di interesse
-                pubblicazioni = cig_details.get('pubblicazioni', {})
-                if isinstance(pubblicazioni, str):
-                    try:
-                        pubblicazioni = json.loads(pubblicazioni)
-                    except json.JSONDecodeError:
-                        pubblicazioni = {}
-                
-                # Se è una procedura negoziata e contiene "SCADENZA INVITO" nelle pubblicazioni,
-                # allora è una manifestazione di interesse
-                if tipo_procedura_mapping.get(tipo_procedura_norm) == "negotiated" and pubblicazioni:
-                    if isinstance(pubblicazioni, dict) and any("SCADENZA INVITO" in str(v) for v in pubblicazioni.values()):
-                        print(f"  ↳ Rilevata manifestazione di interesse nelle pubblicazioni")
-                        tipo_procedura_id = tipo_procedura_map.get("manifestazione_interesse")
-                        print(f"  ↳ Tipo procedura aggiornato a manifestazione_interesse -> {tipo_procedura_id}")
-                
-                # Determina se è un affidamento diretto
-                is_affidamento_diretto = (
-                    tipo_procedura_mapping.get(tipo_procedura_norm) == "direct" if tipo_procedura_norm else False
-                )
-                
-                # Estrai informazioni sul RUP
-                rup_nome = None
-                rup_cognome = None
-                rup_email = None
-                rup_telefono = None
-                
-                # Cerca nel campo incaricati
-                # Cerca nel campo incaricati
-                incaricati = cig_details.get('incaricati', [])
-                print(f"  ↳ DEBUG: incaricati raw = {type(incaricati)} - {str(incaricati)[:200]}...")
-                
-                # Gestisci sia il caso di lista che di stringa JSON
-                if isinstance(incaricati, list):
-                    # È già una lista, usala direttamente
-                    incaricati_list = incaricati
-                    print(f"  ↳ DEBUG: incaricati è già una lista con {len(incaricati_list)} elementi")
-                elif isinstance(incaricati, str):
-                    # È una stringa, prova a parsarla come JSON
-                    print(f"  ↳ DEBUG: incaricati è una stringa, tentativo di parsing JSON")
-                    try:
-                        incaricati_list = json.loads(incaricati)
-                        print(f"  ↳ DEBUG: JSON parsing riuscito, tipo: {type(incaricati_list)}")
-                    except json.JSONDecodeError as e:
-                        print(f"  ⚠️ Errore nel parsing degli incaricati: {e}")
-                        incaricati_list = []
-                else:
-                    print(f"  ↳ DEBUG: incaricati tipo non supportato: {type(incaricati)}")
-                    incaricati_list = []
-                
-                # Processa la lista per trovare il RUP
-                if isinstance(incaricati_list, list):
-                    print(f"  ↳ DEBUG: processando lista con {len(incaricati_list)} elementi")
-                    for i, inc_item in enumerate(incaricati_list):
-                        print(f"  ↳ DEBUG: elemento {i}: {inc_item}")
-                        if inc_item.get('COD_RUOLO') == 'RUP' or 'RUP' in str(inc_item.get('DESCRIZIONE_RUOLO', '')).upper():
-                            rup_nome = inc_item.get('NOME', '')
-                            rup_cognome = inc_item.get('COGNOME', '')
-                            rup_email = inc_item.get('EMAIL', '')
-                            rup_telefono = inc_item.get('TELEFONO', '')
-                            print(f"  ↳ RUP trovato: {rup_nome} {rup_cognome}")
-                            break
-                else:
-                    print(f"  ↳ DEBUG: incaricati_list non è una lista: {type(incaricati_list)}")
-                
-                print(f"  ↳ DEBUG: Risultato estrazione RUP - nome: '{rup_nome}', cognome: '{rup_cognome}'")
-                
+        natura_principale_id = norm.id("natura", natura_principale, natura_map)
+        criterio_aggiudicazione_id = norm.id("criterio", criterio_aggiudicazione, criterio_map)
+        stato_procedura_id = norm.id("stato", detail.stato, stato_map)
+
+        tipo_procedura_id = None
+        is_affidamento_diretto = False
+        tipo = norm.mappa("tipo_procedura", detail.tipo_procedura)
+        if tipo is not None:
+            tipo_procedura_id = tipo_procedura_map.get(tipo.codice)
+            # Una procedura negoziata con "SCADENZA INVITO" nelle pubblicazioni
+            # è una manifestazione di interesse
+            if tipo.esatta and tipo.codice == "negotiated" and detail.invito_in_pubblicazioni:
+                tipo_procedura_id = tipo_procedura_map.get("manifestazione_interesse")
+            is_affidamento_diretto = tipo.esatta and tipo.codice == "direct"
+
         # ------------------------- LOTTI -------------------------
 
-        gara_payload = {
-            "cig": cig,
-            "cup": (bando_json.get("CUP") or [{}])[0].get("CUP")
-                    if bando_json.get("CUP") else None,
-            "ente_appaltante_id": ente_id,
-            "descrizione": bando_json.get("OGGETTO_GARA"),
-            "data_pubblicazione": info_bando.get("dataPubblicazione"),
+        gara_rows[cig] = GaraPayload(
+            cig=cig,
+            ente_appaltante_id=ente_id,
+            cup=detail.cup,
+            descrizione=detail.oggetto_gara,
+            data_pubblicazione=avviso.data_pubblicazione,
             # Per affidamenti diretti, non impostare scadenza offerta
-            "scadenza_offerta": None if is_affidamento_diretto else bando_json.get("DATA_SCADENZA_OFFERTA"),
-            "importo_totale": bando_json.get("IMPORTO_COMPLESSIVO_GARA"),
-            "importo_sicurezza": bando_json.get("IMPORTO_SICUREZZA"),
-            "valuta": "EUR",
-            "natura_principale_id": natura_principale_id,
-            "criterio_aggiudicazione_id": criterio_aggiudicazione_id,
-            "stato_procedura_id": stato_procedura_id,
-            "tipo_procedura_id": tipo_procedura_id,
-            "documenti_di_gara_link": documenti_di_gara_link,
-        }
-        try:
-            res = (
-                supabase
-                .table("gara")
-                .upsert(gara_payload, on_conflict="cig",
-                        returning="representation")
-                .execute()
-            )
-            gara_id = res.data[0]["id"]
-            gare += 1
-            
-            # Inserisci i dati del RUP se disponibili
-            if rup_nome or rup_cognome:
-                rup_payload = {
-                    "gara_id": gara_id,
-                    "nome": rup_nome,
-                    "cognome": rup_cognome,
-                    "email": rup_email,
-                    "telefono": rup_telefono
-                }
-                try:
-                    supabase.table("rup").upsert(
-                        rup_payload, on_conflict="gara_id", returning="minimal"
-                    ).execute()
-                    print(f"  ↳ Inserito RUP per gara {cig}")
-                except Exception as exc:
-                    print(f"  ↳ errore inserimento RUP per gara {cig}: {exc}")
-            
-            # Inserisci i dati delle pubblicazioni se disponibili
-            if pubblicazioni and isinstance(pubblicazioni, dict):
-                pubblicazione_payload = {
-                    "gara_id": gara_id,
-                    "data_creazione": pubblicazioni.get("DATA_CREAZIONE"),
-                    "data_pubblicazione": pubblicazioni.get("DATA_PUBBLICAZIONE"),
-                    "data_guri": pubblicazioni.get("DATA_GURI"),
-                    "link_sito_committente": pubblicazioni.get("LINK_SITO_COMMITTENTE"),
-                    "scadenza_invito": pubblicazioni.get("SCADENZA_INVITO")
-                }
-                try:
-                    supabase.table("pubblicazione").upsert(
-                        pubblicazione_payload, on_conflict="gara_id", returning="minimal"
-                    ).execute()
-                    print(f"  ↳ Inserite pubblicazioni per gara {cig}")
-                except Exception as exc:
-                    print(f"  ↳ errore inserimento pubblicazioni per gara {cig}: {exc}")
-                    
-        except Exception as exc:
-            print(f"  ↳ errore gara {cig}: {exc}")
-            continue
+            scadenza_offerta=None if is_affidamento_diretto else detail.data_scadenza_offerta,
+            importo_totale=detail.importo_complessivo_gara,
+            importo_sicurezza=detail.importo_sicurezza,
+            natura_principale_id=natura_principale_id,
+            criterio_aggiudicazione_id=criterio_aggiudicazione_id,
+            stato_procedura_id=stato_procedura_id,
+            tipo_procedura_id=tipo_procedura_id,
+            documenti_di_gara_link=documenti_di_gara_link,
+        ).to_row()
+
+        # Righe che dipendono da gara_id: completate dopo il flush delle gare
+        if detail.rup and (detail.rup.nome or detail.rup.cognome):
+            rup_rows[cig] = asdict(detail.rup)
+        if detail.pubblicazione:
+            pubblicazione_rows[cig] = asdict(detail.pubblicazione)
 
         # ------------------------- AVVISO ------------------------
-        avviso_id = info_bando.get("idAvviso")
-        if avviso_id:
-            avviso_payload = {
-                "id": avviso_id,
-                "gara_id": gara_id,
-                "id_appalto": info_bando.get("idAppalto"),
-                "codice_scheda": info_bando.get("codiceScheda"),
-                "data_pubblicazione": info_bando.get("dataPubblicazione"),
-                # Per affidamenti diretti, non impostare data scadenza
-                "data_scadenza": None if is_affidamento_diretto else info_bando.get("dataScadenza"),
-                "data_pcp": (info_bando.get("template") or [{}])[0]
-                              .get("avviso", [{}])[0]
-                              .get("dataPCP"),
-                "attivo": info_bando.get("attivo", True),
-            }
-            try:
-                supabase.table("avviso_gara").upsert(
-                    avviso_payload, on_conflict="id", returning="minimal"
-                ).execute()
-                avvisi += 1
-            except Exception as exc:
-                print(f"    ↳ errore avviso {avviso_id}: {exc}")
+        if avviso.id_avviso:
+            avviso_rows.append((cig, avviso.avviso_row(is_affidamento_diretto)))
 
         # ------------------------- LOTTO -------------------------
-        lotto_payload = {
-            "gara_id": gara_id,
-            "cig": cig,
-            "descrizione": bando_json.get("OGGETTO_LOTTO")
-                           or bando_json.get("OGGETTO_GARA"),
-            "valore": bando_json.get("IMPORTO_LOTTO")
-                      or bando_json.get("IMPORTO_COMPLESSIVO_GARA"),
-            "valuta": "EUR",
+        lotto_rows[cig] = LottoPayload(
+            cig=cig,
+            descrizione=detail.oggetto_lotto or detail.oggetto_gara,
+            valore=detail.importo_lotto or detail.importo_complessivo_gara,
             # Per affidamenti diretti, non impostare termine ricezione
-            "termine_ricezione": None if is_affidamento_diretto else bando_json.get("DATA_SCADENZA_OFFERTA"),
-            "luogo_istat": bando_json.get("LUOGO_ISTAT"),
-            "cpv_id": cpv_id,  
-        }
-        try:
-            res_lot = (
-                supabase
-                .table("lotto")
-                .upsert(lotto_payload, on_conflict="cig",
-                        returning="representation")
-                .execute()
-            )
-            lotto_id = res_lot.data[0]["id"]
-            lotti += 1
-        except Exception as exc:
-            print(f"    ↳ errore lotto (CIG {cig}): {exc}")
-            continue
+            termine_ricezione=None if is_affidamento_diretto else detail.data_scadenza_offerta,
+            luogo_istat=detail.luogo_istat,
+            cpv_id=cpv_id,
+        ).to_row()
 
         # -------------- LOTTO ⇄ CATEGORIE OPERA (ponte) ----------
-        cats = cig_details.get("categorie_opera") or []
-        if isinstance(cats, str):
-            try:
-                cats = json.loads(cats) if cats.strip().upper() != "N/A" else []
-            except json.JSONDecodeError:
-                cats = []
-
-        for c in cats:
-            code      = (c.get("ID_CATEGORIA") or c.get("id_categoria"))
+        cat_links[cig] = []
+        for code, ruolo in detail.categorie:
             # Verifica se la categoria esiste nella mappa
-            cat_id    = cat_map.get(code)
+            cat_id = cat_map.get(code)
             if not cat_id:
                 # Salta questa categoria se non esiste nella mappa
-                print(f"      ↳ categoria {code} non trovata nel database, saltata")
+                debug("      ↳ categoria %s non trovata nel database, saltata", code)
                 continue
-                
-            # Determina il ruolo (prevalente o scorporabile)
-            ruolo_raw = c.get("COD_TIPO_CATEGORIA") or c.get("cod_tipo_categoria")
-            ruolo     = "P" if (ruolo_raw or "").upper() == "P" else "S"
-            
-            link_payload = {
+            cat_links[cig].append((cat_id, ruolo))
+
+    TRACER.record("normalize", time.perf_counter() - normalize_start)
+    TRACER.count("gare.normalizzate", len(gara_rows))
+    norm.riepilogo()
+
+    # ------------------------- SCRITTURA -------------------------
+    if use_rpc:
+        return _write_tenders_rpc(gara_rows, rup_rows, pubblicazione_rows, avviso_rows,
+                                  lotto_rows, cat_links, index=writer.index)
+
+    for row in gara_rows.values():
+        writer.add("gara", row, on_conflict="cig")
+    gara_ids = writer.flush("gara", returning=True).ids
+    gare = len(gara_ids)
+
+    for cig, row in rup_rows.items():
+        if cig in gara_ids:
+            writer.add("rup", {"gara_id": gara_ids[cig], **row}, on_conflict="gara_id")
+    for cig, row in pubblicazione_rows.items():
+        if cig in gara_ids:
+            writer.add("pubblicazione", {"gara_id": gara_ids[cig], **row}, on_conflict="gara_id")
+    for cig, row in avviso_rows:
+        if cig in gara_ids:
+            writer.add("avviso_gara", {**row, "gara_id": gara_ids[cig]}, on_conflict="id")
+    for cig, row in lotto_rows.items():
+        if cig in gara_ids:
+            writer.add("lotto", {"gara_id": gara_ids[cig], **row}, on_conflict="cig")
+
+    rup = writer.flush("rup")
+    pubblicazioni_scritte = writer.flush("pubblicazione")
+    avvisi_scritti = writer.flush("avviso_gara").written
+    avvisi = len(avvisi_scritti)
+    lotto_ids = writer.flush("lotto", returning=True).ids
+    lotti = len(lotto_ids)
+
+    for cig, cat_list in cat_links.items():
+        lotto_id = lotto_ids.get(cig)
+        if lotto_id is None:
+            continue
+        for cat_id, ruolo in cat_list:
+            writer.add("lotto_categoria_opera", {
                 "lotto_id": lotto_id,
                 "categoria_opera_id": cat_id,
                 "ruolo": ruolo,
-            }
-            try:
-                supabase.table("lotto_categoria_opera").upsert(
-                    link_payload,
-                    on_conflict="lotto_id,categoria_opera_id",
-                    returning="minimal",
-                ).execute()
-                links += 1
-            except Exception as exc:
-                print(f"      ↳ errore link lotto {lotto_id}-cat {cat_id}: {exc}")
+            }, on_conflict="lotto_id,categoria_opera_id")
+    links = len(writer.flush("lotto_categoria_opera").written)
 
     print(f"✔  Inserite/aggiornate {gare} gare, {lotti} lotti, "
-          f"{avvisi} avvisi e {links} collegamenti lotto-categoria")
+          f"{avvisi} avvisi e {links} collegamenti lotto-categoria "
+          f"({len(rup.written)} RUP, {len(pubblicazioni_scritte.written)} pubblicazioni)")
+    return avvisi_scritti
+
+
+def _write_tenders_rpc(gara_rows: Dict[str, Dict], rup_rows: Dict[str, Dict],
+                       pubblicazione_rows: Dict[str, Dict], avviso_rows: List[Tuple[str, Dict]],
+                       lotto_rows: Dict[str, Dict], cat_links: Dict[str, List[Tuple[int, str]]],
+                       index: Optional[ChangeIndex] = None) -> List[str]:
+    """Scrive le gare con la funzione ``upsert_tenders`` (sql/upsert_tenders.sql):
+    un documento annidato per gara, ``TENDER_RPC_BATCH`` gare per chiamata,
+    ciascuna chiamata in una sola transazione lato server. Con ``index`` i
+    documenti identici a quelli già scritti non vengono inviati."""
+    avvisi_by_cig: Dict[str, List[Dict]] = {}
+    for cig, row in avviso_rows:
+        avvisi_by_cig.setdefault(cig, []).append(row)
+    tenders = [
+        {
+            "gara": gara,
+            "rup": rup_rows.get(cig),
+            "pubblicazione": pubblicazione_rows.get(cig),
+            "avvisi": avvisi_by_cig.get(cig, []),
+            "lotto": lotto_rows.get(cig),
+            "categorie": [{"categoria_opera_id": cat_id, "ruolo": ruolo}
+                          for cat_id, ruolo in cat_links.get(cig, [])],
+        }
+        for cig, gara in gara_rows.items()
+    ]
+    result = rpc_batched(supabase, "upsert_tenders", "tenders", tenders,
+                         key=lambda doc: (doc.get("gara") or doc).get("cig"),
+                         chunk_size=TENDER_RPC_BATCH, index=index)
+    written = set(result.written)
+    gare = len(written)
+    lotti = sum(1 for row in result.ids.values() if row.get("lotto_id") is not None)
+    avvisi = sum(len(avvisi_by_cig.get(cig, [])) for cig in written)
+    links = sum(len(cat_links.get(cig, [])) for cig in written if cig in lotto_rows)
+    print(f"✔  Inserite/aggiornate {gare} gare, {lotti} lotti, "
+          f"{avvisi} avvisi e {links} collegamenti lotto-categoria "
+          f"({result.requests} chiamate upsert_tenders)")
+    return [row["id"] for cig in written for row in avvisi_by_cig.get(cig, [])]
 
 
 # ---------------------------------------------------------------------------
 # MAIN
 # ---------------------------------------------------------------------------
 
-def main():
-    parser = argparse.ArgumentParser(description="Pipeline unificata ANAC → Supabase")
-    parser.add_argument("--date", required=True, help="Data target in formato YYYY-MM-DD")
-    parser.add_argument("--skip-download", action="store_true", help="Salta il download dettagli CIG")
-    parser.add_argument("--skip-upload", action="store_true", help="Salta l'upload su Supabase e termina dopo il merge locale")
-    args = parser.parse_args()
+@dataclass
+class RunState:
+    """Stato condiviso fra i giorni di un run (anche in parallelo).
 
+    Le mappe di lookup vengono lette da Supabase una sola volta; enti e CPV
+    già caricati da un altro giorno dello stesso run non vengono riscritti.
+    """
+    args: argparse.Namespace
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    lookup: Optional[Tuple[Dict[str, int], ...]] = None
+    enti_map: Dict[str, int] = field(default_factory=dict)
+    cpv_map: Dict[str, int] = field(default_factory=dict)
+    refresh_left: int = 0
+    watermark: Optional[AvvisiWatermark] = None   # None = run completo (--full)
+    index: Optional[ChangeIndex] = None
+    journal: Optional[RunJournal] = None          # unità completate, per --resume
+
+    def claim_refresh(self, cigs: Set[str]) -> int:
+        """Riserva parte del budget di refresh del run per i CIG scaduti di un giorno."""
+        with self.lock:
+            if self.refresh_left <= 0:
+                return 0
+            claimed = min(self.refresh_left,
+                          len(cig_store.stale_cigs(cigs, limit=self.refresh_left)))
+            self.refresh_left -= claimed
+            return claimed
+
+    def lookup_maps(self) -> Tuple[Dict[str, int], ...]:
+        """(cat_map, natura_map, criterio_map, stato_map, tipo_procedura_map)"""
+        with self.lock:
+            if self.lookup is None:
+                with TRACER.span("lookup"):
+                    cat_map = process_categorie_opera([])
+                    self.lookup = (cat_map, *get_lookup_maps())
+            return self.lookup
+
+
+class StreamUploader:
+    """Carica i bandi uniti a micro-batch mentre arrivano dal fetcher.
+
+    Un micro-batch parte quando raggiunge ``UPLOAD_BATCH`` bandi oppure
+    quando sono passati ``UPLOAD_MAX_WAIT`` secondi dal precedente, così le
+    prime righe arrivano su Supabase subito e in memoria resta solo il batch
+    corrente. Con ``writer`` (es. ``PgUpserter``) tutti i batch finiscono
+    nella stessa transazione: enti e CPV entrano nelle mappe condivise del
+    run, e gli avvisi scritti nel registro incrementale e nel giornale del
+    run, solo con ``publish``, dopo il commit. ``shared`` scrive enti e CPV,
+    condivisi con gli altri giorni, fuori da quella transazione (vedi
+    ``PgUpserter.connect``).
+    """
+
+    def __init__(self, state: RunState, writer: Optional[BatchUpserter] = None,
+                 shared: Optional[BatchUpserter] = None):
+        self.state = state
+        self.transactional = writer is not None
+        self.writer = writer or BatchUpserter(supabase, index=state.index)
+        self.shared = shared or self.writer
+        self.batch: List[Bando] = []
+        self.enti_map: Dict[str, int] = {}
+        self.cpv_map: Dict[str, int] = {}
+        self.scritti: List[Avviso] = []
+        self.attesi: Set[str] = set()      # idAvviso ricevuti e scrivibili
+        self.confermati: Set[str] = set()  # idAvviso scritti (e pubblicati)
+        self.uploaded = 0
+        self._last_flush = time.monotonic()
+
+    @staticmethod
+    def _scrivibile(merged: Bando) -> bool:
+        """L'avviso ha ciò che serve a ``process_gare_e_lotti`` per scriverlo:
+        un dettaglio CIG (senza CIG o con il CIG nella cache negativa non verrà
+        mai confermato) e un ente identificabile."""
+        detail = merged.detail
+        return bool(detail and detail.cig and detail.ente
+                    and detail.ente.denominazione and detail.ente.codice_fiscale)
+
+    def add(self, merged: Bando) -> None:
+        if merged.avviso.id_avviso and self._scrivibile(merged):
+            self.attesi.add(merged.avviso.id_avviso)
+        self.batch.append(merged)
+        if (len(self.batch) >= UPLOAD_BATCH
+                or time.monotonic() - self._last_flush >= UPLOAD_MAX_WAIT):
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        with TRACER.span("upload.batch"):
+            self._upload(batch)
+        self.uploaded += len(batch)
+        TRACER.count("bandi.caricati", len(batch))
+        if not self.transactional:
+            self.publish()
+
+    def _upload(self, batch: List[Bando]) -> None:
+        cat_map, natura_map, criterio_map, stato_map, tipo_procedura_map = self.state.lookup_maps()
+        with self.state.lock:
+            known_enti = {**self.state.enti_map, **self.enti_map}
+            known_cpv = {**self.state.cpv_map, **self.cpv_map}
+        enti_map = process_enti_appaltanti(batch, known=known_enti, writer=self.shared)
+        cpv_map = process_categorie_cpv(batch, known=known_cpv, writer=self.shared)
+        self.enti_map.update(enti_map)
+        self.cpv_map.update(cpv_map)
+        scritti = process_gare_e_lotti(batch, enti_map, cat_map, cpv_map, natura_map, criterio_map,
+                                       stato_map, tipo_procedura_map, writer=self.writer,
+                                       use_rpc=self.state.args.loader == "rpc")
+        by_id = {b.avviso.id_avviso: b.avviso for b in batch}
+        self.scritti.extend(by_id[i] for i in scritti if i in by_id)
+
+    def publish(self) -> None:
+        with self.state.lock:
+            self.state.enti_map.update(self.enti_map)
+            self.state.cpv_map.update(self.cpv_map)
+        if self.scritti:
+            if self.state.watermark is not None:
+                self.state.watermark.mark(self.scritti)
+            if self.state.journal is not None:
+                self.state.journal.record("avviso", (a.id_avviso for a in self.scritti))
+            self.confermati.update(a.id_avviso for a in self.scritti)
+            self.scritti = []
+
+    @property
+    def completo(self) -> bool:
+        """Tutti gli avvisi scrivibili ricevuti sono stati scritti e pubblicati."""
+        return self.attesi <= self.confermati
+
+
+def run_day(target_date: dt.date, state: RunState, merged_path: Path) -> bool:
+    """Esegue download, merge e upload per un singolo giorno.
+
+    Le fasi si sovrappongono: ogni bando viene unito, salvato e accodato per
+    l'upload appena arriva il dettaglio del suo CIG (vedi
+    ``stream_cig_details`` e ``StreamUploader``). Con ``state.journal`` i
+    giorni, gli avvisi e i CIG già completati da un run interrotto vengono
+    saltati (``--resume``).
+    """
+    args = state.args
+    journal = state.journal
     start = time.time()
-    print(f"🚀  Pipeline avviata per {args.date}")
-
-    target_date = (dt.datetime.strptime(args.date, "%Y-%m-%d").date()
-                if args.date else dt.date.today())
-    bandi = fetch_avvisi_legali(target_date)
-
-    # Estrai CIG unici
-    cig_set = {extract_cig_from_bando(b) for b in bandi if extract_cig_from_bando(b)}
-    print(f"→ {len(cig_set)} CIG individuati")
-
-    cig_files = {}
-    if not args.skip_download and cig_set:
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
-            futures = {}
-            for cig in cig_set:
-                futures[pool.submit(download_cig_wrapper, cig)] = cig
-            for fut in futures:
-                path = fut.result()
-                if path:
-                    cig_files[futures[fut]] = path
-        print(f"→ scaricati {len(cig_files)}/{len(cig_set)} dettagli CIG")
-
-    # Merge
-    merged = []
+    day = target_date.isoformat()
+    if journal is not None and journal.done("giorno", [day]):
+        print(f"↷  {day} già completato dal run interrotto: saltato")
+        TRACER.count("ripresa.giorni")
+        return True
+    print(f"🚀  Pipeline avviata per {day}")
+
+    try:
+        with TRACER.span("avvisi.fetch"):
+            bandi = fetch_avvisi_legali(target_date)
+    except IncompleteDownloadError as exc:
+        print(f"❌  Download avvisi incompleto per {target_date} ({exc}): giorno saltato")
+        return False
+    TRACER.count("avvisi", len(bandi))
+    if state.watermark is not None:
+        # Budget letto senza riservarlo: lo riserva claim_refresh più sotto
+        bandi = filter_incremental(bandi, state.watermark, state.index,
+                                   refresh_limit=0 if args.skip_download else state.refresh_left)
+    if journal is not None and not args.skip_upload:
+        ripresi = journal.done("avviso", (b.id_avviso for b in bandi if b.id_avviso))
+        if ripresi:
+            bandi = [b for b in bandi if b.id_avviso not in ripresi]
+            TRACER.count("ripresa.avvisi", len(ripresi))
+            print(f"↷  {len(ripresi)} avvisi già scritti dal run interrotto, {len(bandi)} da elaborare")
+
+    # Bandi raggruppati per CIG: escono dalla memoria man mano che vengono uniti
+    bandi_by_cig: Dict[str, List[Avviso]] = {}
+    senza_cig: List[Avviso] = []
     for b in bandi:
         cig = extract_cig_from_bando(b)
-        cig_json = None
         if cig:
-            cig_path = CIG_CACHE_DIR / f"{cig}.json"
-            if cig_path.exists():
-                with open(cig_path, "r", encoding="utf-8") as fp:
-                    cig_json = json.load(fp)
-        merged.append(merge_data(b, cig_json))
-    merged_path = LOCAL_DIR / "bandi_completi.json"
-    with merged_path.open("w", encoding="utf-8") as fp:
-        json.dump(merged, fp, ensure_ascii=False, indent=2)
-    print(f"→ salvato merge in {merged_path}")
-
-    if args.skip_upload:
-        print("⏩  Upload saltato per scelta utente")
-        sys.exit(0)
-
-    # Upload
-    enti_map = process_enti_appaltanti(merged)
-    cat_map = process_categorie_opera(merged)
-    cpv_map = process_categorie_cpv(merged)
-    natura_map, criterio_map, stato_map, tipo_procedura_map = get_lookup_maps()
-    process_gare_e_lotti(merged, enti_map, cat_map, cpv_map, natura_map, criterio_map, stato_map, tipo_procedura_map)
-
-    print(f"✅  Pipeline completata in {time.time() - start:.1f}s")
+            bandi_by_cig.setdefault(cig, []).append(b)
+        else:
+            senza_cig.append(b)
+    del bandi
+    print(f"→ {len(bandi_by_cig)} CIG individuati")
+
+    cigs = set(bandi_by_cig)
+    # CIG già consegnati dal run interrotto: solo dalla cache, senza refresh
+    scaricati = journal.done("cig", cigs) if journal is not None else set()
+    refresh_budget = 0 if args.skip_download else state.claim_refresh(cigs - scaricati)
+    details = stream_cig_details(cigs - scaricati, args.superset_batch, refresh_budget,
+                                 from_cache_only=args.skip_download)
+    if scaricati:
+        TRACER.count("ripresa.cig", len(scaricati))
+        details = itertools.chain(stream_cig_details(scaricati, from_cache_only=True), details)
+    found = 0
+
+    with contextlib.ExitStack() as stack:
+        uploader = None
+        if args.skip_upload:
+            print("⏩  Upload saltato per scelta utente")
+        elif args.loader == "pg":
+            # Tutto il giorno in una transazione; enti e CPV, condivisi con
+            # gli altri giorni in parallelo, confermati a ogni blocco
+            uploader = StreamUploader(state, stack.enter_context(
+                PgUpserter.connect(args.db_url, index=state.index)), stack.enter_context(
+                PgUpserter.connect(args.db_url, index=state.index, transaction=False)))
+        else:
+            uploader = StreamUploader(state)
+        out = stack.enter_context(NdjsonWriter(merged_path))
+
+        def _emit(group: List[Avviso], detail: Optional[CigDetail]) -> None:
+            for b in group:
+                merged = merge_data(b, detail)
+                out.write(merged)
+                if uploader:
+                    uploader.add(merged)
+
+        _emit(senza_cig, None)
+        for cig, cig_data in details:
+            found += cig_data is not None
+            # Un solo dettaglio per CIG, condiviso dai suoi bandi; la
+            # risposta Superset completa non resta in memoria
+            with TRACER.span("merge"):
+                detail = CigDetail.from_record(CigRecord.from_superset(cig_data))
+            _emit(bandi_by_cig.pop(cig, []), detail)
+            if journal is not None and cig_data is not None and cig not in scaricati:
+                # Solo i dettagli arrivati: un CIG fallito va ritentato alla ripresa
+                journal.record("cig", [cig])
+        for group in bandi_by_cig.values():  # CIG mai consegnati dal fetcher
+            _emit(group, None)
+        if uploader:
+            uploader.flush()
+    if uploader:
+        uploader.publish()
+        if journal is not None and uploader.completo:
+            journal.record("giorno", [day])
+
+    TRACER.count("bandi.uniti", out.count)
+    print(f"→ dettagli CIG disponibili per {found} CIG, "
+          f"{out.count} bandi salvati in {merged_path}")
+    if uploader:
+        print(f"→ {uploader.uploaded} bandi caricati")
+    print(f"✅  {day} completato in {time.time() - start:.1f}s")
+    return True
+
+
+def upload_merged(path: Path, state: RunState) -> bool:
+    """Carica su Supabase un file di bandi uniti già salvato (``--upload-only``),
+    leggendolo un record alla volta."""
+    args = state.args
+    start = time.time()
+    print(f"🚀  Upload di {path}")
+    if not path.exists():
+        print(f"❌  File non trovato: {path}")
+        return False
+    with contextlib.ExitStack() as stack:
+        writer = shared = None
+        if args.loader == "pg":
+            writer = stack.enter_context(PgUpserter.connect(args.db_url, index=state.index))
+            shared = stack.enter_context(
+                PgUpserter.connect(args.db_url, index=state.index, transaction=False))
+        uploader = StreamUploader(state, writer, shared)
+        for record in iter_records(path):
+            uploader.add(Bando.from_dict(record))
+        uploader.flush()
+    uploader.publish()
+    print(f"✅  {uploader.uploaded} bandi caricati in {time.time() - start:.1f}s")
+    return True
+
+
+def _parse_date(value: str) -> dt.date:
+    try:
+        return dt.datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"data non valida: {value} (usa YYYY-MM-DD)")
 
-# ---------------------------------------------------------------------------
-# Helper per download CIG in thread‑pool
-# ---------------------------------------------------------------------------
 
-def download_cig_wrapper(cig: str) -> Optional[Path]:
-    path = CIG_CACHE_DIR / f"{cig}.json"
-    if path.exists():
-        return path
-    data = fetch_cig_details(cig)
-    if not data:
-        return None
-    return path
+def date_range(date_from: dt.date, date_to: dt.date) -> List[dt.date]:
+    """Giorni da ``date_from`` a ``date_to`` inclusi."""
+    return [date_from + dt.timedelta(days=i)
+            for i in range((date_to - date_from).days + 1)]
+
 
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline unificata ANAC → Supabase")
+    parser.add_argument("--date", type=_parse_date, help="Data target in formato YYYY-MM-DD (default: oggi)")
+    parser.add_argument("--from", dest="date_from", type=_parse_date,
+                        help="Backfill: primo giorno dell'intervallo (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", type=_parse_date,
+                        help="Backfill: ultimo giorno dell'intervallo, incluso (default: oggi)")
+    parser.add_argument("--parallel-days", type=int, default=PARALLEL_DAYS, metavar="N",
+                        help="Giorni elaborati in parallelo durante il backfill")
+    parser.add_argument("--skip-download", action="store_true", help="Salta il download dettagli CIG")
+    parser.add_argument("--skip-upload", action="store_true", help="Salta l'upload su Supabase e termina dopo il merge locale")
+    parser.add_argument("--full", action="store_true",
+                        help="Rielabora tutti gli avvisi, anche quelli già caricati da un run "
+                             "precedente, e riscrive anche le righe invariate "
+                             "(senza: solo avvisi nuovi o modificati, solo righe cambiate)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Riprende un run interrotto con le stesse date: salta giorni, avvisi "
+                             "e CIG già completati secondo il giornale del run (vedi run_journal.py)")
+    parser.add_argument("--upload-only", nargs="+", type=Path, metavar="FILE",
+                        help=f"Carica file di bandi uniti già salvati (*{MERGED_SUFFIX}) "
+                             "senza scaricare né unire")
+    parser.add_argument("--superset-batch", type=int, default=0, metavar="N",
+                        help="Richiedi a Superset N CIG per query (0 = una query per CIG)")
+    parser.add_argument("--refresh-budget", type=int, default=REFRESH_BUDGET, metavar="N",
+                        help="Massimo di CIG in cache scaduti da riscaricare nel run")
+    parser.add_argument("--loader", choices=("postgrest", "rpc", "pg"), default="postgrest",
+                        help="Backend di scrittura: upsert PostgREST, funzione RPC upsert_tenders "
+                             "(sql/upsert_tenders.sql) o COPY diretto su PostgreSQL")
+    parser.add_argument("--db-url", default=default_dsn(),
+                        help=f"Connection string PostgreSQL per --loader pg (default: ${DB_URL_ENV})")
+    parser.add_argument("--log-level", choices=sorted(LEVELS, key=LEVELS.get), default=None,
+                        help="Livello dei messaggi (default: $PIPELINE_LOG_LEVEL o info)")
+    parser.add_argument("--report", type=Path, metavar="FILE",
+                        help="Report JSON del run con latenze, contatori ed errori "
+                             "(default: run_report_<data-ora>.json in LOCAL_DIR)")
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument("--record", type=Path, metavar="FILE",
+                         help="Registra le risposte di Pubblicità Legale e Superset in un archivio "
+                              "(vedi http_archive.py)")
+    archive.add_argument("--replay", type=Path, metavar="FILE",
+                         help="Riproduce le risposte da un archivio registrato, senza rete")
+    args = parser.parse_args()
 
-def process_enti_appaltanti(bandi: List[Dict]) -> Dict[str, int]:
+    if args.date and (args.date_from or args.date_to):
+        parser.error("--date non è combinabile con --from/--to")
+    if args.date_to and not args.date_from:
+        parser.error("--to richiede --from")
+    if args.loader == "pg" and not args.db_url:
+        parser.error(f"--loader pg richiede --db-url o la variabile {DB_URL_ENV}")
+    if args.upload_only and (args.date or args.date_from or args.skip_upload or args.resume):
+        parser.error("--upload-only non è combinabile con --date, --from/--to, --skip-upload o --resume")
+    if args.date_from and (args.date_to or dt.date.today()) < args.date_from:
+        parser.error("--from deve precedere --to")
+    if args.log_level:
+        set_level(args.log_level)
+
+    if args.replay and not args.replay.exists():
+        parser.error(f"archivio non trovato: {args.replay}")
+
+    TRACER.reset()
+    http_archive.configure("record" if args.record else "replay" if args.replay else None,
+                           args.record or args.replay)
+    code = 1
+    try:
+        code = run(args)
+    finally:
+        http_archive.close()
+        report_path = args.report or LOCAL_DIR / f"run_report_{time.strftime('%Y%m%d_%H%M%S')}.json"
+        try:
+            report = TRACER.write_report(report_path, argv=sys.argv[1:], exit_code=code)
+        except OSError as exc:
+            print(f"⚠️  report del run non salvato: {exc}")
+        else:
+            print_summary(report)
+            print(f"📄  Report del run salvato in {report_path}")
+    sys.exit(code)
+
+
+def run(args: argparse.Namespace) -> int:
+    """Esegue il run richiesto da ``args``; restituisce il codice di uscita."""
+    start = time.time()
+    state = RunState(args, refresh_left=args.refresh_budget,
+                     index=ChangeIndex(CHANGE_INDEX_PATH, skip_unchanged=not args.full))
+    if not args.full and not args.skip_upload:
+        # Con --skip-upload il risultato è solo il file locale: serve il giorno intero
+        state.watermark = AvvisiWatermark(WATERMARK_PATH)
+
+    if args.upload_only:
+        ok = all([upload_merged(path, state) for path in args.upload_only])
+        return 0 if ok else 2
+
+    days = (date_range(args.date_from, args.date_to or dt.date.today()) if args.date_from
+            else [args.date or dt.date.today()])
+    with RunJournal(journal_path(LOCAL_DIR, "bandi", days[0].isoformat(), days[-1].isoformat()),
+                    resume=args.resume) as journal:
+        state.journal = journal
+        return run_days(days, state, start)
+
+
+def run_days(days: List[dt.date], state: RunState, start: float) -> int:
+    """Elabora un giorno o, con ``--from``, il backfill di ``days``."""
+    args = state.args
+    if not args.date_from:
+        ok = run_day(days[0], state, LOCAL_DIR / f"bandi_completi{MERGED_SUFFIX}")
+        return 0 if ok else 2
+
+    print(f"🚀  Backfill di {len(days)} giorni "
+          f"({days[0].isoformat()} → {days[-1].isoformat()}), {args.parallel_days} in parallelo")
+
+    with ThreadPoolExecutor(max_workers=max(1, args.parallel_days)) as pool:
+        futures = {
+            pool.submit(run_day, day, state,
+                        LOCAL_DIR / f"bandi_completi_{day.isoformat()}{MERGED_SUFFIX}"): day
+            for day in days
+        }
+        failed = []
+        for fut in as_completed(futures):
+            try:
+                ok = fut.result()
+            except Exception as exc:
+                print(f"❌  Errore per {futures[fut]}: {exc}")
+                ok = False
+            if not ok:
+                failed.append(futures[fut])
+
+    print(f"✅  Backfill completato in {time.time() - start:.1f}s: "
+          f"{len(days) - len(failed)}/{len(days)} giorni elaborati")
+    if failed:
+        print(f"❌  Giorni da rieseguire: {', '.join(d.isoformat() for d in sorted(failed))}")
+        print("💡  Con --resume e le stesse date si riprende da dove il run si è fermato")
+        return 2
+    return 0
+
+def process_enti_appaltanti(bandi: List[Bando], known: Optional[Dict[str, int]] = None,
+                            writer: Optional[BatchUpserter] = None) -> Dict[str, int]:
     """
-    Deduplica gli enti appaltanti (codice_fiscale), esegue upsert su `ente_appaltante`
+    Deduplica gli enti appaltanti (codice_fiscale), esegue upsert a blocchi su `ente_appaltante`
     e restituisce una mappa codice_fiscale → id (PK autoincrement di Supabase).
+    Gli enti già presenti in ``known`` (caricati in questo run) non vengono riscritti.
     """
-    print("Elaborazione enti appaltanti…")
+    debug("Elaborazione enti appaltanti…")
     seen: Dict[str, Dict] = {}  # codice_fiscale → dati completi
     
-    for item in bandi:
-        sa = item.get("cig_details", {}).get("stazione_appaltante", {})
-        if not sa:
-            continue
-            
-        if isinstance(sa, str):  # alcune API restituiscono stringa JSON
-            try:
-                if sa.strip().upper() == "N/A":
-                    continue
-                sa = json.loads(sa)
-            except json.JSONDecodeError:
-                continue
-                
-        # Estrai i campi necessari con gestione di nomi di campo alternativi
-        cf = (sa.get("CF_AMMINISTRAZIONE_APPALTANTE") or 
-              sa.get("codice_fiscale"))
-        denominazione = (sa.get("DENOMINAZIONE_AMMINISTRAZIONE_APPALTANTE") or 
-                         sa.get("denominazione_amministrazione"))
-        citta = sa.get("CITTA") or ""
-        regione = sa.get("REGIONE") or ""
-        
-        if cf and denominazione:
-            seen[cf] = {
-                "codice_fiscale": cf,
-                "denominazione": denominazione,
-                "citta": citta,
-                "regione": regione
-            }
-
-    enti_map: Dict[str, int] = {}
+    for bando in bandi:
+        ente = bando.detail.ente if bando.detail else None
+        if ente and ente.denominazione:
+            seen[ente.codice_fiscale] = asdict(ente)
+
+    enti_map: Dict[str, int] = {cf: known[cf] for cf in seen if known and cf in known}
+    writer = writer or BatchUpserter(supabase)
     for cf, ente_data in seen.items():
-        try:
-            res = (
-                supabase
-                .table("ente_appaltante")
-                .upsert(ente_data, on_conflict="codice_fiscale",
-                        returning="representation")
-                .execute()
-            )
-            enti_map[cf] = res.data[0]["id"]
-        except Exception as exc:
-            print(f"  ↳ errore ente {cf}: {exc}")
+        if cf not in enti_map:
+            writer.add("ente_appaltante", ente_data, on_conflict="codice_fiscale")
+    enti_map.update(writer.flush("ente_appaltante", returning=True).ids)
 
     print(f"✔  {len(enti_map)} enti appaltanti inseriti/aggiornati")
     return enti_map